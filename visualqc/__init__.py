@@ -7,10 +7,33 @@ __all__ = ['outlier_advisory']
 __author__ = """Pradeep Reddy Raamana"""
 __email__ = 'raamana@gmail.com'
 
+import sys
+
 from ._version import get_versions
 __version__ = get_versions()['version']
 del get_versions
 
-from visualqc.readers import gather_freesurfer_data, read_aparc_stats_in_hemi, \
-    read_aseg_stats, read_aparc_stats_wholebrain
-from visualqc.outliers import outlier_advisory
+# public functions are imported on first access, so the command line interfaces
+#   do not have to pay for importing scikit-learn etc. when they are not needed.
+_lazy_attributes = {'gather_freesurfer_data'     : 'visualqc.readers',
+                    'read_aparc_stats_in_hemi'   : 'visualqc.readers',
+                    'read_aseg_stats'            : 'visualqc.readers',
+                    'read_aparc_stats_wholebrain': 'visualqc.readers',
+                    'outlier_advisory'           : 'visualqc.outliers'}
+
+
+def __getattr__(name):
+    """Imports the public functions lazily."""
+
+    if name in _lazy_attributes:
+        from importlib import import_module
+        return getattr(import_module(_lazy_attributes[name]), name)
+
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+if sys.version_info < (3, 7):
+    # module-level __getattr__ (PEP 562) is ignored before python 3.7
+    from visualqc.readers import gather_freesurfer_data, read_aparc_stats_in_hemi, \
+        read_aseg_stats, read_aparc_stats_wholebrain
+    from visualqc.outliers import outlier_advisory
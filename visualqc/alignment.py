@@ -13,10 +13,6 @@ import warnings
 from abc import ABC
 import numpy as np
 from functools import partial
-from scipy.ndimage import grey_erosion, sobel, \
-    grey_opening, binary_opening
-from scipy.ndimage.filters import median_filter, minimum_filter, maximum_filter
-from scipy.signal import medfilt2d, medfilt
 
 import matplotlib
 matplotlib.interactive(True)
@@ -30,8 +26,8 @@ from visualqc import config as cfg
 from visualqc.interfaces import BaseReviewInterface
 from visualqc.utils import check_finite_int, check_id_list, check_input_dir_alignment, \
     check_out_dir, check_outlier_params, check_views, get_axis, pick_slices, read_image, \
-    scale_0to1, check_time
-from visualqc.workflows import BaseWorkflowVisualQC
+    scale_0to1, check_time, check_num_bytes, check_prefetch_params
+from visualqc.workflows import BaseWorkflowVisualQC, add_review_session_args
 from visualqc.image_utils import overlay_edges, mix_color, diff_image, mix_slices_in_checkers
 
 # each rating is a set of labels, join them with a plus delimiter
@@ -252,7 +248,7 @@ class AlignmentRatingWorkflow(BaseWorkflowVisualQC, ABC):
                  out_dir,
                  issue_list=cfg.default_rating_list,
                  in_dir_type='generic',
-                 prepare_first=True,
+                 prepare_first=False,
                  vis_type=cfg.alignment_default_vis_type,
                  delay_in_animation=cfg.delay_in_animation,
                  outlier_method=cfg.default_outlier_detection_method,
@@ -262,12 +258,22 @@ class AlignmentRatingWorkflow(BaseWorkflowVisualQC, ABC):
                  views=cfg.default_views,
                  num_slices_per_view=cfg.default_num_slices,
                  num_rows_per_view=cfg.default_num_rows,
+                 prefetch_depth=cfg.default_prefetch_depth,
+                 prefetch_max_memory=cfg.default_prefetch_max_memory,
+                 unit_cache_max_bytes=cfg.default_unit_cache_max_bytes,
+                 image_cache_max_bytes=cfg.default_image_cache_max_bytes,
+                 ratings_backend=cfg.default_ratings_backend,
                  ):
         """Constructor"""
 
         super().__init__(id_list, in_dir, out_dir,
                          outlier_method, outlier_fraction,
-                         outlier_feat_types, disable_outlier_detection)
+                         outlier_feat_types, disable_outlier_detection,
+                         prefetch_depth=prefetch_depth,
+                         prefetch_max_memory=prefetch_max_memory,
+                         unit_cache_max_bytes=unit_cache_max_bytes,
+                         image_cache_max_bytes=image_cache_max_bytes,
+                         ratings_backend=ratings_backend)
 
         self.vis_type = vis_type
         self.current_cmap = cfg.alignment_cmap[self.vis_type]
@@ -451,34 +457,40 @@ class AlignmentRatingWorkflow(BaseWorkflowVisualQC, ABC):
             self.current_alert_msg = None
 
 
+    def get_unit_reader(self, unit_id):
+        """Reader for the pair of images of a given unit, mixed as currently chosen."""
+
+        image1_path, image2_path = self.path_getter_inputs(unit_id)
+        return partial(read_alignment_unit, image1_path, image2_path,
+                       self.views, self.num_slices_per_view,
+                       padding=self.padding, vis_type=self.vis_type,
+                       mixer=self.mixer, image_cache=self.image_cache)
+
+
     def load_unit(self, unit_id):
         """Loads the image data for display."""
 
-        image1_path, image2_path = self.path_getter_inputs(unit_id)
-        self.image_one = read_image(image1_path, error_msg='first image')
-        self.image_two = read_image(image2_path, error_msg='second image')
+        unit_data = self.fetch_unit(unit_id)
+        self.image_one = unit_data['image_one']
+        self.image_two = unit_data['image_two']
 
         skip_subject = False
-        if np.count_nonzero(self.image_one) == 0:
+        if unit_data['image_one_is_empty']:
             skip_subject = True
             print(
                 'image {} of {} is empty!'.format(self.image1_name, self.current_unit_id))
 
-        if np.count_nonzero(self.image_two) == 0:
+        if unit_data['image_two_is_empty']:
             skip_subject = True
             print(
                 'image {} of {} is empty!'.format(self.image2_name, self.current_unit_id))
 
         if not skip_subject:
-            # crop and rescale
-            self.image_one, self.image_two = crop_to_seg_extents(self.image_one,
-                                                                 self.image_two,
-                                                                 self.padding)
-            self.image_one = scale_0to1(self.image_one)
-            self.image_two = scale_0to1(self.image_two)
-
-            self.slices = pick_slices(self.image_one, self.views,
-                                      self.num_slices_per_view)
+            self.slices = unit_data['slices']
+            # mixed slices are computed only once for each vis type
+            self.mixed_slices = dict()
+            if 'mixed_slices' in unit_data:
+                self.mixed_slices[unit_data['vis_type']] = unit_data['mixed_slices']
             # flag to keep track of whether data has been changed.
             self._histogram_updated = False
 
@@ -529,11 +541,12 @@ class AlignmentRatingWorkflow(BaseWorkflowVisualQC, ABC):
     def mix_and_display(self):
         """Static mix and display."""
 
-        # TODO maintain a dict mixed[vis_type] to do computation only once
-        for ax_index, (dim_index, slice_index) in enumerate(self.slices):
-            slice_one = get_axis(self.image_one, dim_index, slice_index)
-            slice_two = get_axis(self.image_two, dim_index, slice_index)
-            mixed_slice = self.mixer(slice_one, slice_two)
+        if self.vis_type not in self.mixed_slices:
+            self.mixed_slices[self.vis_type] = mix_slices(
+                self.image_one, self.image_two, self.slices, self.mixer)
+
+        for ax_index, ((dim_index, slice_index), mixed_slice) in enumerate(
+                zip(self.slices, self.mixed_slices[self.vis_type])):
             # mixed_slice is already in RGB mode m x p x 3, so
             #   prev. cmap (gray) has no effect on color_mixed data
             self.h_images[ax_index].set(data=mixed_slice, cmap=self.current_cmap)
@@ -616,6 +629,49 @@ class AlignmentRatingWorkflow(BaseWorkflowVisualQC, ABC):
         self.anim_loop.close()
 
 
+def read_alignment_unit(image1_path, image2_path, views, num_slices_per_view,
+                        padding=cfg.default_padding, vis_type=None, mixer=None,
+                        image_cache=None):
+    """
+    Reads the two images, crops and rescales them, picks the slices to display,
+    and mixes them with the given mixer, if any.
+    """
+
+    image_one = read_image(image1_path, error_msg='first image', image_cache=image_cache)
+    image_two = read_image(image2_path, error_msg='second image', image_cache=image_cache)
+
+    unit_data = dict(image_one=image_one, image_two=image_two,
+                     image_one_is_empty=np.count_nonzero(image_one) == 0,
+                     image_two_is_empty=np.count_nonzero(image_two) == 0)
+    if unit_data['image_one_is_empty'] or unit_data['image_two_is_empty']:
+        return unit_data
+
+    # crop and rescale
+    image_one, image_two = crop_to_seg_extents(image_one, image_two, padding)
+    image_one = scale_0to1(image_one)
+    image_two = scale_0to1(image_two)
+    slices = pick_slices(image_one, views, num_slices_per_view)
+
+    unit_data.update(image_one=image_one, image_two=image_two, slices=slices)
+    if mixer is not None:
+        unit_data['vis_type'] = vis_type
+        unit_data['mixed_slices'] = mix_slices(image_one, image_two, slices, mixer)
+
+    return unit_data
+
+
+def mix_slices(image_one, image_two, slices, mixer):
+    """Mixes the chosen slices of the two images."""
+
+    mixed_slices = list()
+    for dim_index, slice_index in slices:
+        slice_one = get_axis(image_one, dim_index, slice_index)
+        slice_two = get_axis(image_two, dim_index, slice_index)
+        mixed_slices.append(mixer(slice_one, slice_two))
+
+    return mixed_slices
+
+
 def get_parser():
     """Parser to specify arguments and their defaults."""
 
@@ -685,12 +741,14 @@ def get_parser():
     \n""".format(cfg.default_num_rows))
 
     help_text_prepare = textwrap.dedent("""
-    This flag does the heavy preprocessing first, prior to starting any review and rating operations.
-    Heavy processing can include computation of registration quality metrics and outlier detection etc. 
-    This makes the switch from one subject to the next, even more seamless (saving few seconds :) ).
+    This flag prepares the data for all the units prior to starting any review
+    and rating operations: images are read, cropped and rescaled, and stats, carpets
+    etc are computed in parallel, and saved to disk within the output folder
+    (in {}). This makes the switch from one subject to the next, even more
+    seamless, and the prepared data is reused when the review is resumed later on.
 
-    Default: False.
-    \n""")
+    Default: False (data for each unit is prepared on demand, a few units ahead).
+    \n""".format(cfg.unit_cache_dir_name))
 
     help_text_outlier_detection_method = textwrap.dedent("""
     Method used to detect the outliers.
@@ -786,6 +844,8 @@ def get_parser():
                          dest="prepare_first",
                          help=help_text_prepare)
 
+    add_review_session_args(parser)
+
     return parser
 
 
@@ -829,6 +889,15 @@ def make_workflow_from_user_options():
         user_args.disable_outlier_detection,
         id_list, vis_type, type_of_features)
 
+    prefetch_depth, prefetch_max_memory = check_prefetch_params(
+        user_args.prefetch_depth, user_args.prefetch_max_memory)
+
+    unit_cache_max_bytes = check_num_bytes(user_args.unit_cache_max_bytes,
+                                           'unit_cache_max_bytes')
+
+    image_cache_max_bytes = check_num_bytes(user_args.image_cache_max_bytes,
+                                            'image_cache_max_bytes')
+
     wf = AlignmentRatingWorkflow(id_list,
                                  in_dir,
                                  image1,
@@ -844,7 +913,12 @@ def make_workflow_from_user_options():
                                  disable_outlier_detection=disable_outlier_detection,
                                  views=views,
                                  num_slices_per_view=num_slices_per_view,
-                                 num_rows_per_view=num_rows_per_view)
+                                 num_rows_per_view=num_rows_per_view,
+                                 prefetch_depth=prefetch_depth,
+                                 prefetch_max_memory=prefetch_max_memory,
+                                 unit_cache_max_bytes=unit_cache_max_bytes,
+                                 image_cache_max_bytes=image_cache_max_bytes,
+                                 ratings_backend=user_args.ratings_backend)
 
     return wf
 
@@ -0,0 +1,487 @@
+"""
+
+Module to cache the data prepared for the review of each unit on disk,
+so it can be computed in advance (in parallel), and reused across sessions.
+
+"""
+
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from os import makedirs
+from os.path import basename, exists as pexists, join as pjoin, realpath
+
+import numpy as np
+
+from visualqc import config as cfg
+
+
+class UnitDataCache(object):
+    """
+    Content-addressed on-disk cache for the data prepared for the review of each unit.
+
+    Each entry is a folder under ``cache_dir``, identified by the reader
+    (function and parameters) that produced it, as well as the size and
+    modification time of input files, so changes to inputs or parameters are
+    never served stale. Arrays are stored as uncompressed .npy files, and are
+    memory-mapped when loaded. Least recently used entries are evicted to keep
+    the total size within the given budget.
+
+    """
+
+
+    def __init__(self, cache_dir, max_bytes=cfg.default_unit_cache_max_bytes):
+        """Constructor"""
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        makedirs(self.cache_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # key --> [last used, number of bytes]
+        self._index = dict()
+        for entry in os.scandir(self.cache_dir):
+            manifest_path = pjoin(entry.path, cfg.cache_manifest_name)
+            if entry.is_dir() and pexists(manifest_path):
+                self._index[entry.name] = [os.stat(manifest_path).st_mtime,
+                                           _folder_size(entry.path)]
+
+
+    def entry_path(self, reader):
+        """Folder where the data produced by the given reader is stored."""
+
+        return pjoin(self.cache_dir, reader_key(reader))
+
+
+    def get(self, reader):
+        """Returns the data previously saved for this reader, or None if unavailable."""
+
+        entry_dir = self.entry_path(reader)
+        manifest_path = pjoin(entry_dir, cfg.cache_manifest_name)
+        if not pexists(manifest_path):
+            return None
+
+        try:
+            unit_data = load_unit_data(entry_dir)
+        except:
+            # incomplete or corrupt entry: recompute
+            traceback.print_exc()
+            return None
+
+        self._touch(entry_dir)
+
+        return unit_data
+
+
+    def put(self, reader, unit_data):
+        """Saves the data produced by the given reader, and evicts old entries if needed."""
+
+        entry_dir = self.entry_path(reader)
+        save_unit_data(entry_dir, unit_data)
+        self._touch(entry_dir)
+        self.evict()
+
+
+    def read(self, reader):
+        """Returns the saved data for this reader, reading and saving it if not available."""
+
+        unit_data = self.get(reader)
+        if unit_data is None:
+            unit_data = reader()
+            self.put(reader, unit_data)
+
+        return unit_data
+
+
+    def evict(self):
+        """Removes the least recently used entries, until within the budget."""
+
+        with self._lock:
+            total_bytes = sum(num_bytes for _, num_bytes in self._index.values())
+            if total_bytes <= self.max_bytes:
+                return
+
+            by_last_use = sorted(self._index.items(), key=lambda item: item[1][0])
+            for key, (_, num_bytes) in by_last_use:
+                if total_bytes <= self.max_bytes:
+                    break
+                shutil.rmtree(pjoin(self.cache_dir, key), ignore_errors=True)
+                self._index.pop(key)
+                total_bytes -= num_bytes
+
+
+    def _touch(self, entry_dir):
+        """Records the use of an entry."""
+
+        # time of last use is also kept on disk, to persist across sessions
+        last_used = time.time()
+        os.utime(pjoin(entry_dir, cfg.cache_manifest_name), (last_used, last_used))
+        with self._lock:
+            key = os.path.basename(entry_dir)
+            if key in self._index:
+                self._index[key][0] = last_used
+            else:
+                self._index[key] = [last_used, _folder_size(entry_dir)]
+
+
+    def precompute(self, reader_by_unit, num_procs=cfg.default_num_procs_prepare):
+        """
+        Runs the readers for all units in parallel (in separate processes),
+        and saves their data to disk. Units saved already are skipped.
+
+        Parameters
+        ----------
+        reader_by_unit : dict
+            reader (picklable callable without any args) for each unit id,
+            in the order they would be reviewed.
+
+        num_procs : int or None
+            Number of processes to use. None implies all the CPUs available.
+
+        Returns
+        -------
+        failed : list
+            ids of units for which the reader failed.
+
+        """
+
+        pending = {unit_id: reader for unit_id, reader in reader_by_unit.items()
+                   if not pexists(pjoin(self.entry_path(reader),
+                                        cfg.cache_manifest_name))}
+        num_units = len(reader_by_unit)
+        print('Preparing data for {} units ({} done already) .. '
+              ''.format(num_units, num_units - len(pending)))
+
+        failed = list()
+        if len(pending) > 0:
+            failed = self._run_in_parallel(pending, num_procs)
+
+        # marking the units to be reviewed first as the most recently used,
+        #   so they are the last to be evicted, if the budget is exceeded.
+        for unit_id, reader in reversed(list(reader_by_unit.items())):
+            entry_dir = self.entry_path(reader)
+            if pexists(pjoin(entry_dir, cfg.cache_manifest_name)):
+                self._touch(entry_dir)
+        self.evict()
+
+        return failed
+
+
+    def _run_in_parallel(self, pending, num_procs):
+        """Runs the pending readers in a pool of processes."""
+
+        failed = list()
+        # spawning fresh processes, as forking after a GUI backend has been
+        #   initialized (figure is created in some workflows already) is unsafe
+        with ProcessPoolExecutor(max_workers=num_procs,
+                                 mp_context=multiprocessing.get_context('spawn')) \
+            as executor:
+            future_to_unit = {executor.submit(_read_and_save, reader,
+                                              self.entry_path(reader)): unit_id
+                              for unit_id, reader in pending.items()}
+            for counter, future in enumerate(as_completed(future_to_unit), 1):
+                unit_id = future_to_unit[future]
+                try:
+                    future.result()
+                except Exception as exc:
+                    failed.append(unit_id)
+                    print('Unable to prepare data for {} : {}'.format(unit_id, exc))
+                else:
+                    print('\t{}/{} prepared : {}'.format(counter, len(pending), unit_id))
+
+        if len(failed) > 0:
+            print('Data for {} units could not be prepared - they will be loaded '
+                  'again during the review.'.format(len(failed)))
+
+        return failed
+
+
+def reader_key(reader):
+    """
+    Unique identifier for the reader function, the parameters bound to it,
+    and the current state (size and modification time) of any input files.
+    """
+
+    func = getattr(reader, 'func', reader)
+    args = getattr(reader, 'args', tuple())
+    kwargs = getattr(reader, 'keywords', dict())
+    spec = ('{}.{}'.format(func.__module__, func.__qualname__),
+            _fingerprint(args),
+            sorted((name, _fingerprint(value)) for name, value in kwargs.items()))
+
+    return hashlib.sha1(pickle.dumps(spec, protocol=4)).hexdigest()
+
+
+def _fingerprint(value):
+    """
+    Adds size and modification time to paths to existing files,
+    and ignores caches of images.
+    """
+
+    if isinstance(value, str) and os.path.isfile(value):
+        stat = os.stat(value)
+        return realpath(value), stat.st_size, stat.st_mtime_ns
+    elif isinstance(value, (list, tuple)):
+        return tuple(_fingerprint(elem) for elem in value)
+    elif isinstance(value, DecompressedImageCache):
+        # where the images are read from does not change the data
+        return None
+
+    return value
+
+
+def _folder_size(folder):
+    """Total size of the files in a folder"""
+
+    return sum(entry.stat().st_size for entry in os.scandir(folder) if entry.is_file())
+
+
+def _read_and_save(reader, entry_dir):
+    """Worker to read the data for one unit, and save it."""
+
+    save_unit_data(entry_dir, reader())
+
+
+def save_unit_data(entry_dir, unit_data):
+    """
+    Saves the data for a unit (dict of arrays and simple values) in a given folder.
+
+    Each array is saved as a separate (uncompressed) .npy file, lists of arrays
+    as numbered .npy files, and the rest in a JSON manifest, which is written last.
+    The folder is written in a temporary location first, and moved into place
+    once complete, to never leave partial entries behind.
+
+    """
+
+    tmp_dir = '{}.tmp{}_{}'.format(entry_dir, os.getpid(), threading.get_ident())
+    if pexists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    makedirs(tmp_dir)
+
+    manifest = dict()
+    for name, value in unit_data.items():
+        if isinstance(value, np.ndarray):
+            np.save(pjoin(tmp_dir, '{}.npy'.format(name)), value)
+            manifest[name] = dict(kind='array')
+        elif isinstance(value, (list, tuple)) and len(value) > 0 \
+            and all(isinstance(elem, np.ndarray) for elem in value):
+            for index, elem in enumerate(value):
+                np.save(pjoin(tmp_dir, '{}.{}.npy'.format(name, index)), elem)
+            manifest[name] = dict(kind='array_list', length=len(value))
+        else:
+            manifest[name] = dict(kind='value', value=value)
+
+    with open(pjoin(tmp_dir, cfg.cache_manifest_name), 'w') as mf:
+        json.dump(manifest, mf, default=_to_builtin)
+
+    try:
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        # saved already by someone else
+        shutil.rmtree(tmp_dir)
+
+
+def load_unit_data(entry_dir):
+    """
+    Loads the data for a unit saved by :func:`save_unit_data`.
+
+    Arrays are memory-mapped read-only, so only the parts accessed are read
+    from disk. Make a copy before modifying them in-place.
+    """
+
+    with open(pjoin(entry_dir, cfg.cache_manifest_name)) as mf:
+        manifest = json.load(mf)
+
+    unit_data = dict()
+    for name, spec in manifest.items():
+        if spec['kind'] == 'array':
+            unit_data[name] = np.load(pjoin(entry_dir, '{}.npy'.format(name)),
+                                      mmap_mode='r')
+        elif spec['kind'] == 'array_list':
+            unit_data[name] = [np.load(pjoin(entry_dir, '{}.{}.npy'.format(name, index)),
+                                       mmap_mode='r')
+                               for index in range(spec['length'])]
+        else:
+            unit_data[name] = spec['value']
+
+    return unit_data
+
+
+class DecompressedImageCache(object):
+    """
+    Uncompressed copies of compressed images (such as .nii.gz or .mgz),
+    reoriented to the closest canonical orientation, saved as NIfTI on first
+    read, so they can be memory-mapped in later reads, instead of paying for
+    the decompression again.
+
+    Each copy is identified by the path, size and modification time of the
+    original image. Least recently used copies are evicted to keep the total
+    size within the given budget.
+
+    """
+
+
+    def __init__(self, cache_dir, max_bytes=cfg.default_image_cache_max_bytes):
+        """Constructor"""
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        makedirs(self.cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+
+
+    def __getstate__(self):
+        """Pickled without the lock, to be passed to the processes preparing units."""
+
+        state = self.__dict__.copy()
+        state.pop('_lock')
+        return state
+
+
+    def __setstate__(self, state):
+        """Restores the state, with a new lock."""
+
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+    def path_for(self, img_path):
+        """Path to the uncompressed copy of an image, creating it if needed."""
+
+        key = hashlib.sha1(pickle.dumps(_fingerprint(img_path), protocol=4)).hexdigest()
+        cached_path = pjoin(self.cache_dir, '{}.nii'.format(key))
+        if pexists(cached_path):
+            os.utime(cached_path)
+            return cached_path
+
+        tmp_path = pjoin(self.cache_dir, '{}.tmp{}_{}.nii'.format(
+            key, os.getpid(), threading.get_ident()))
+        decompress_canonical(img_path, tmp_path)
+        os.replace(tmp_path, cached_path)
+        self.evict(keep=cached_path)
+
+        return cached_path
+
+
+    def evict(self, keep=None):
+        """Removes the least recently used images, until within the budget."""
+
+        with self._lock:
+            entries = [(entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                       for entry in os.scandir(self.cache_dir)
+                       if entry.is_file() and entry.name.endswith('.nii')
+                       and '.tmp' not in entry.name]
+            total_bytes = sum(num_bytes for _, num_bytes, _ in entries)
+            for _, num_bytes, path in sorted(entries):
+                if total_bytes <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                except OSError:
+                    # removed already by another process
+                    pass
+                total_bytes -= num_bytes
+
+
+def uncompressed_path(img_path, image_cache=None):
+    """
+    Returns the path to the uncompressed copy of an image from the given cache
+    (a DecompressedImageCache), if any and the image is compressed,
+    or the original path otherwise.
+    """
+
+    if image_cache is None or not str(img_path).endswith(cfg.compressed_image_exts):
+        return img_path
+
+    return image_cache.path_for(img_path)
+
+
+@contextmanager
+def uncompressed_copy(img_path, image_cache=None):
+    """
+    Path to an uncompressed copy of an image, to read it in several passes
+    without decompressing it again in each: the copy in the given image_cache
+    (a DecompressedImageCache), if any, or a temporary copy otherwise,
+    removed on exit. Uncompressed images are read as they are.
+    """
+
+    if image_cache is not None or not str(img_path).endswith(cfg.compressed_image_exts):
+        yield uncompressed_path(img_path, image_cache)
+        return
+
+    with tempfile.TemporaryDirectory(prefix='visualqc_') as tmp_dir:
+        tmp_path = pjoin(tmp_dir, _uncompressed_name(img_path))
+        decompress(img_path, tmp_path)
+        yield tmp_path
+
+
+def decompress(img_path, out_path):
+    """
+    Decompresses an image (gzipped, as .nii.gz or .mgz) as is, without loading it:
+    its header is untouched, and its data is streamed through in blocks.
+    """
+
+    with gzip.open(img_path, 'rb') as in_file, open(out_path, 'wb') as out_file:
+        shutil.copyfileobj(in_file, out_file, cfg.num_bytes_per_block_decompress)
+
+
+def _uncompressed_name(img_path):
+    """Name of the image once decompressed, in the same format (.nii or .mgh)."""
+
+    name = basename(str(img_path))
+    if name.endswith('.mgz'):
+        return '{}.mgh'.format(name[:-len('.mgz')])
+
+    return name[:-len('.gz')]
+
+
+def decompress_canonical(img_path, out_path):
+    """
+    Saves an image as uncompressed NIfTI, in the closest canonical orientation,
+    keeping its data type and scaling as is.
+    """
+
+    import nibabel as nib
+
+    img = nib.load(img_path)
+    ornt = nib.io_orientation(img.affine)
+    if hasattr(img.dataobj, 'get_unscaled'):
+        data = img.dataobj.get_unscaled()
+        slope, inter = img.dataobj.slope, img.dataobj.inter
+    else:
+        data = np.asanyarray(img.dataobj)
+        slope, inter = 1.0, 0.0
+    data = nib.apply_orientation(data, ornt)
+    affine = img.affine.dot(nib.orientations.inv_ornt_aff(ornt, img.shape))
+
+    header = img.header if isinstance(img, nib.Nifti1Image) else None
+    out_img = nib.Nifti1Image(data, affine, header=header)
+    out_img.header.set_data_dtype(data.dtype)
+    out_img.header.set_slope_inter(slope, inter)
+    # keeping the voxel sizes in any extra dims (e.g. TR of functional MRI)
+    out_img.header.set_zooms(out_img.header.get_zooms()[:3] +
+                             tuple(img.header.get_zooms()[3:]))
+    nib.save(out_img, out_path)
+
+
+def _to_builtin(value):
+    """Converts numpy types to their builtin equivalents for JSON."""
+
+    if isinstance(value, np.generic):
+        return value.item()
+    elif isinstance(value, np.ndarray):
+        return value.tolist()
+
+    raise TypeError('{} can not be saved to cache'.format(type(value)))
@@ -0,0 +1,320 @@
+"""
+
+Module to build carpet plots (voxels x time points or gradients) for display,
+binned down to the pixels available to show them.
+
+"""
+
+import numpy as np
+
+from visualqc import config as cfg
+
+
+def carpet_size_in_pixels(figsize=cfg.default_review_figsize, dpi=None):
+    """
+    Number of pixels (rows, columns) available to show the carpet,
+    which spans the default subplot area of the review figure.
+    """
+
+    from matplotlib import rcParams
+
+    if dpi is None:
+        dpi = rcParams['figure.dpi']
+    width = figsize[0] * dpi * (rcParams['figure.subplot.right'] -
+                                rcParams['figure.subplot.left'])
+    height = figsize[1] * dpi * (rcParams['figure.subplot.top'] -
+                                 rcParams['figure.subplot.bottom'])
+
+    return int(np.ceil(height)), int(np.ceil(width))
+
+
+def detrend_carpet(carpet, TR=None,
+                   order=cfg.carpet_detrend_order,
+                   high_pass=cfg.carpet_high_pass_cutoff,
+                   num_rows_per_chunk=cfg.num_voxels_per_chunk_carpet):
+    """
+    Removes polynomial trends (and optionally, slow drifts) from each row
+    (voxel) of the carpet, in place.
+
+    All the rows are projected out of the same basis, orthonormalized once,
+    so this is a couple of matrix products per chunk of rows.
+
+    Parameters
+    ----------
+    carpet : ndarray
+        num_voxels x num_time_points, float32
+
+    TR : float
+        repetition time in seconds, needed only for high-pass filtering.
+
+    order : int
+        Order of the polynomial trends to remove (1 : constant and linear).
+
+    high_pass : float or None
+        Cutoff frequency (Hz) of the high-pass filter, implemented by removing
+        the discrete cosine (DCT) bases below it. Default: None, no filtering.
+
+    num_rows_per_chunk : int
+        Number of rows detrended at a time, to limit the temporary copies.
+
+    Returns
+    -------
+    carpet : ndarray
+        the same carpet, detrended.
+
+    """
+
+    num_time_points = carpet.shape[1]
+    basis = _detrending_basis(num_time_points, TR, order, high_pass)
+    basis = basis.astype(carpet.dtype)
+
+    for start in range(0, carpet.shape[0], num_rows_per_chunk):
+        chunk = carpet[start:start + num_rows_per_chunk, :]
+        chunk -= (chunk @ basis) @ basis.T
+
+    return carpet
+
+
+def rescale_rows(carpet, num_rows_per_chunk=cfg.num_voxels_per_chunk_carpet):
+    """
+    Rescales each row (voxel) of the carpet to [0, 1], in place.
+
+    Rows with no variation are only shifted to 0. Carpets of integer type are
+    converted to float32 first, which is the only copy made.
+    """
+
+    if not np.issubdtype(carpet.dtype, np.floating):
+        carpet = carpet.astype('float32')
+    # avoiding any numerical difficulties
+    eps = np.finfo(carpet.dtype).eps
+
+    for start in range(0, carpet.shape[0], num_rows_per_chunk):
+        chunk = carpet[start:start + num_rows_per_chunk, :]
+        min_ = chunk.min(axis=1, keepdims=True)
+        range_ = chunk.max(axis=1, keepdims=True) - min_
+        range_[range_ < eps] = 1.0
+        chunk -= min_
+        chunk /= range_
+
+    return carpet
+
+
+def _detrending_basis(num_time_points, TR=None, order=1, high_pass=None):
+    """Orthonormal basis of polynomials (and DCT bases below high_pass) over time."""
+
+    time_points = np.linspace(-1.0, 1.0, num_time_points)
+    regressors = [time_points ** power for power in range(order + 1)]
+
+    if high_pass is not None:
+        if TR is None or TR <= 0:
+            raise ValueError('TR must be known to apply a high-pass filter!')
+        # same number of cosines as SPM and nilearn, for this cutoff
+        num_cosines = min(num_time_points - 1,
+                          int(np.floor(2 * num_time_points * high_pass * TR)))
+        frames = np.arange(num_time_points)
+        for k in range(1, num_cosines + 1):
+            regressors.append(np.cos(np.pi * (frames + 0.5) * k / num_time_points))
+
+    basis, _ = np.linalg.qr(np.column_stack(regressors))
+
+    return basis
+
+
+def bin_carpet(carpet, carpet_size,
+               row_method=cfg.carpet_row_aggregation,
+               col_method=cfg.carpet_col_aggregation):
+    """
+    Bins the rows (voxels) and columns (time points or gradients) of the carpet
+    down to the number of pixels available, if there are more than that.
+
+    Parameters
+    ----------
+    carpet : ndarray
+        num_voxels x num_time_points
+
+    carpet_size : tuple
+        max. number of (rows, columns) to bin down to.
+
+    row_method, col_method : str
+        Aggregation of the rows or columns within each bin: one of
+        'mean', 'min', 'max', or 'extreme' (min or max, whichever is farther
+        from the mean, so short spikes in either direction remain visible).
+
+    Returns
+    -------
+    binned : ndarray
+        at most num_rows x num_cols
+
+    """
+
+    carpet = _bin_axis(carpet, carpet_size[0], 0, row_method)
+    carpet = _bin_axis(carpet, carpet_size[1], 1, col_method)
+
+    return carpet
+
+
+def _bin_axis(matrix, num_bins, axis, method):
+    """Aggregates the values along an axis into (nearly) equal sized bins."""
+
+    size = matrix.shape[axis]
+    if size <= num_bins:
+        return matrix
+
+    return _reduce_bins(matrix, _bin_starts(size, num_bins), axis, method)
+
+
+def _bin_starts(size, num_bins):
+    """Start of each of the (nearly) equal sized bins."""
+
+    return np.linspace(0, size, num_bins, endpoint=False).astype('int64')
+
+
+def _reduce_bins(matrix, starts, axis, method):
+    """Aggregates the values along an axis within bins starting at the given indices."""
+
+    size = matrix.shape[axis]
+    num_bins = len(starts)
+    if method in ('min', ):
+        return np.minimum.reduceat(matrix, starts, axis=axis)
+    elif method in ('max', ):
+        return np.maximum.reduceat(matrix, starts, axis=axis)
+    elif method not in ('mean', 'extreme'):
+        raise ValueError('Invalid aggregation method {}. Choose one of '
+                         'mean, min, max or extreme'.format(method))
+
+    counts = np.diff(np.append(starts, size))
+    count_shape = [1, 1]
+    count_shape[axis] = num_bins
+    mean = np.add.reduceat(matrix, starts, axis=axis) / counts.reshape(count_shape)
+    if method in ('mean', ):
+        return mean
+
+    lowest = np.minimum.reduceat(matrix, starts, axis=axis)
+    highest = np.maximum.reduceat(matrix, starts, axis=axis)
+
+    return np.where(highest - mean > mean - lowest, highest, lowest)
+
+
+def carpet_of_frames(img4d, mask, carpet_size, detrend=False, TR=None,
+                     num_frames_per_chunk=cfg.num_frames_per_chunk_stats,
+                     extrema=None):
+    """
+    Makes the carpet of the voxels within the mask (rows) over the frames
+    (columns) of a 4D image, reading it in chunks of frames.
+
+    Rows are detrended (if requested) as :func:`detrend_carpet` does, rescaled
+    to [0, 1] as :func:`rescale_rows` does, binned down to carpet_size as
+    :func:`bin_carpet` does, and stored in 8 bits. The full carpet is never
+    held in memory: the image is read three times (twice without detrending,
+    and once if its extrema are given), keeping only a few values per voxel
+    in between, along with the binned carpet.
+
+    Parameters
+    ----------
+    img4d : ndarray
+        4D image, or anything that can be sliced like it (memmap, image proxy etc)
+
+    mask : ndarray
+        3D mask identifying the voxels to be shown
+
+    carpet_size : tuple
+        max. number of (rows, columns) to bin down to.
+
+    detrend : bool
+        Whether to remove polynomial trends (and slow drifts, as configured).
+
+    TR : float
+        repetition time in seconds, needed only for high-pass filtering.
+
+    num_frames_per_chunk : int
+        Number of frames to read and process at a time (approx.)
+
+    extrema : tuple
+        3D volumes of the voxel-wise (min, max) over frames, if computed already
+        (e.g. by :func:`stats_over_frames`). Not used when detrending, as the
+        rows are rescaled to the range of their residuals.
+
+    Returns
+    -------
+    carpet : ndarray
+        at most num_rows x num_cols, in 8 bits
+
+    """
+
+    mask = np.asarray(mask) > 0
+    num_frames = img4d.shape[3]
+    chunks = _chunks_of_whole_bins(num_frames, carpet_size[1], num_frames_per_chunk)
+
+    # projection of each row onto the basis of trends over time
+    basis, coefs = None, None
+    if detrend:
+        basis = _detrending_basis(num_frames, TR, cfg.carpet_detrend_order,
+                                  cfg.carpet_high_pass_cutoff)
+        coefs = np.zeros((np.count_nonzero(mask), basis.shape[1]))
+        for start, end in chunks:
+            coefs += _rows_of_frames(img4d, mask, start, end) @ basis[start:end, :]
+
+    if extrema is not None and not detrend:
+        min_, max_ = (np.asarray(extreme)[mask].astype('float32') for extreme in extrema)
+    else:
+        min_ = np.full(np.count_nonzero(mask), np.inf, dtype='float32')
+        max_ = np.full(np.count_nonzero(mask), -np.inf, dtype='float32')
+        for start, end in chunks:
+            rows = _rows_of_frames(img4d, mask, start, end, coefs, basis)
+            np.fmin(min_, rows.min(axis=1), out=min_)
+            np.fmax(max_, rows.max(axis=1), out=max_)
+
+    range_ = max_ - min_
+    range_[range_ < np.finfo('float32').eps] = 1.0
+
+    binned = list()
+    for start, end in chunks:
+        rows = _rows_of_frames(img4d, mask, start, end, coefs, basis)
+        rows -= min_[:, np.newaxis]
+        rows /= range_[:, np.newaxis]
+        rows = _bin_axis(rows, carpet_size[0], 0, cfg.carpet_row_aggregation)
+        if num_frames > carpet_size[1]:
+            col_starts = _bin_starts(num_frames, carpet_size[1])
+            in_chunk = col_starts[(col_starts >= start) & (col_starts < end)] - start
+            rows = _reduce_bins(rows, in_chunk, 1, cfg.carpet_col_aggregation)
+        binned.append(rows)
+
+    return quantize_carpet(np.concatenate(binned, axis=1))
+
+
+def _chunks_of_whole_bins(num_frames, num_cols, num_frames_per_chunk):
+    """
+    Start and end of chunks of about num_frames_per_chunk frames, made of
+    whole bins of frames (columns) when they are to be binned.
+    """
+
+    if num_frames <= num_cols:
+        edges = np.arange(0, num_frames, num_frames_per_chunk)
+    else:
+        col_starts = _bin_starts(num_frames, num_cols)
+        edges = [col_starts[0]]
+        for col_start in col_starts[1:]:
+            if col_start - edges[-1] >= num_frames_per_chunk:
+                edges.append(col_start)
+    edges = np.append(edges, num_frames)
+
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def _rows_of_frames(img4d, mask, start, end, coefs=None, basis=None):
+    """
+    Voxels within the mask (rows) over the given frames, in float32,
+    with the trends of the given coefs over the basis removed, if any.
+    """
+
+    rows = np.asarray(img4d[:, :, :, start:end])[mask, :].astype('float32', copy=False)
+    if coefs is not None:
+        rows -= coefs @ basis[start:end, :].T
+
+    return rows
+
+
+def quantize_carpet(normed_carpet):
+    """Stores a carpet rescaled to [0, 1] in 8 bits, which is all that is displayed."""
+
+    return np.around(np.clip(normed_carpet, 0.0, 1.0) * 255).astype('uint8')
@@ -44,6 +44,9 @@ default_outlier_fraction = 0.2
 avail_outlier_detection_methods = ('isolation_forest',)
 # OLD -> OutLier Detection
 avail_OLD_source_of_features = ('freesurfer', 't1_mri', 'func_mri', 'diffusion_mri')
+# number of subjects to read the features of in parallel (in threads),
+#   as this mostly waits on file I/O e.g. from network drives
+default_num_workers_gather_features = 16
 
 default_freesurfer_dir = None
 cortical_types = ('cortical_volumetric', 'cortical_contour')
@@ -64,6 +67,13 @@ default_label_set = None
 default_bids_dir = None
 default_user_dir = None
 
+# index of the BIDS layout is saved in out_dir, to be reused when resuming
+bids_layout_db_name = 'bids_layout_db'
+file_name_bids_layout_fingerprint = 'dataset_fingerprint.txt'
+# folders at the top of a BIDS dataset not indexed by pybids (as are hidden folders),
+#   which are left out of its fingerprint, as is out_dir if within the dataset
+bids_folders_not_indexed = ('derivatives', 'code', 'stimuli', 'sourcedata', 'models')
+
 default_alpha_mri = 1.0
 default_alpha_seg = 0.7
 default_alpha_set = (default_alpha_mri, default_alpha_seg)
@@ -71,11 +81,19 @@ default_alpha_set = (default_alpha_mri, default_alpha_seg)
 min_cmap_range_t1_mri = 0
 max_cmap_range_t1_mri = 1
 
+# voxels sampled (regularly) across an image to estimate its intensity range,
+#   when only a part of it is read from the disk
+max_num_voxels_intensity_sample = 2 ** 20
+
 mri_zorder_freesurfer = 0
 seg_zorder_freesurfer = 1
 
 background_value = 0 # for segmentations or MRI
 
+# segmentations with (non-negative integer) labels up to this value are remapped
+#   with a lookup table indexed by label, instead of sorting all their voxels
+max_label_for_lookup_table = 2 ** 16
+
 default_views = (0, 1, 2)
 default_num_slices = 12
 default_num_rows = 2
@@ -149,6 +167,17 @@ no_blank_area = dict(left=0.01, right=0.99,
 suffix_ratings_dir = 'ratings'
 file_name_ratings = 'ratings.all.csv'
 prefix_backup = 'backup'
+# each rating is appended to this journal right away, and the journal is
+#   merged into the ratings file every so often, as well as at the end.
+suffix_ratings_journal = '.journal'
+num_ratings_between_compaction = 100
+# ratings can optionally be stored in a SQLite database instead,
+#   which is faster to resume from, and can be shared by multiple reviewers.
+ratings_backends = ('csv', 'sqlite')
+default_ratings_backend = 'csv'
+file_name_ratings_db = 'ratings.sqlite'
+# seconds to wait for a write by another reviewer to finish
+ratings_db_timeout = 30
 
 # visualization layout
 zoomed_position = [0.15, 0.15, 0.7, 0.7]
@@ -231,7 +260,23 @@ func_mri_default_rating_list_shortform = abbreviation_func_mri_default_issue_lis
 
 func_outlier_features = None
 
-func_mri_BIDS_filters = dict(modalities='func', types='bold')
+func_mri_BIDS_filters = dict(modalities='func', suffix=('bold', 'events'))
+
+# carpet plots (of functional and diffusion MRI) are binned down to the pixels
+#   available to show them, aggregating each bin by 'mean', 'min', 'max', or
+#   'extreme' (min or max, whichever is farther from the mean)
+carpet_row_aggregation = 'mean'
+# to keep short spikes visible, even when many time points share a pixel
+carpet_col_aggregation = 'extreme'
+
+# polynomial trends removed from the fMRI carpet, unless --no_preproc (1 : linear)
+carpet_detrend_order = 1
+# cutoff (Hz) of the high-pass filter (DCT bases) applied to the fMRI carpet
+#   along with detrending. None means no filtering, 0.01 is typical.
+carpet_high_pass_cutoff = None
+# voxels detrended or rescaled at a time, to limit temporary copies
+num_voxels_per_chunk_carpet = 4096
+
 # usually done in analyses to try keep the numbers in numerical calculations away from small values
 # not important here, just for display, doing it anyways.
 scale_factor_BOLD = 1000
@@ -249,6 +294,9 @@ default_name_pattern = '*.nii'
 func_mri_features_OLD = ('dvars',)
 colormap_stdev_fmri = 'seismic'
 
+# frames read at a time, to compute the stats over time in a single pass
+num_frames_per_chunk_stats = 8
+
 ## ----------------------------------------------------------------------------
 #           Diffusion mri specific
 ## ----------------------------------------------------------------------------
@@ -278,7 +326,7 @@ diffusion_mri_default_rating_list_shortform = abbreviation_diffusion_mri_default
 
 diffusion_outlier_features = None
 
-diffusion_mri_BIDS_filters = dict(modalities='dwi', types='dwi')
+diffusion_mri_BIDS_filters = dict(modalities='dwi', suffix='dwi')
 # usually done in analyses to try keep the numbers in numerical calculations away from small values
 # not important here, just for display, doing it anyways.
 scale_factor_diffusion = 1000
@@ -370,6 +418,8 @@ alignment_groupwise_default_vis_type = 'Std. dev map' # 'Checkerboard' # 'Animat
 ## ----------------------------------------------------------------------------
 
 outlier_feature_folder_name = 'features_outlier_detection'
+# features of new subjects are saved to the cohort store in batches of this size
+num_subjects_per_feature_store_update = 100
 features_outlier_detection = freesurfer_features_outlier_detection + t1_mri_features_OLD + func_mri_features_OLD
 
 
@@ -406,3 +456,47 @@ vis_choices_defacing = ('Defaced only',
                         'Mixed')
 
 defacing_trim_percentile = 1
+
+## ----------------------------------------------------------------------------
+#          review session: loading data in advance
+## ----------------------------------------------------------------------------
+
+# number of upcoming units to be loaded in the background, during the review
+#   of the current unit. 0 disables it.
+default_prefetch_depth = 2
+# max. memory (in bytes) to be held by the units loaded in advance
+default_prefetch_max_memory = 2 * 1024 ** 3
+
+# data prepared for the review of each unit is cached in this folder within
+#   the output folder, to be reused across sessions. With --prepare_first,
+#   data for all units is prepared in advance (in parallel).
+unit_cache_dir_name = 'cache_units'
+cache_manifest_name = 'manifest.json'
+# max. size (in bytes) of the cache: least recently used units are removed
+#   to stay within this budget. 0 disables the cache.
+#   Units hold only the derived arrays (stats, carpet etc) and no 4D volumes,
+#   so a small budget holds a large number of them.
+default_unit_cache_max_bytes = 2 * 1024 ** 3
+# None implies all the CPUs available
+default_num_procs_prepare = None
+
+# compressed images (.nii.gz, .mgz) are decompressed (and reoriented to canonical)
+#   on first read, into this folder within the output folder, to be
+#   memory-mapped in later reads, instead of decompressing them again.
+image_cache_dir_name = 'cache_images'
+# max. size (in bytes) of the decompressed images: least recently used images
+#   are removed to stay within this budget. 0 disables the cache, which is
+#   the default, as the copies can be several times larger than the inputs.
+default_image_cache_max_bytes = 0
+compressed_image_exts = ('.gz', '.mgz')
+# compressed 4D images (functional and diffusion MRI) are read in several passes,
+#   so they are decompressed once to a temporary copy, in blocks of this size
+num_bytes_per_block_decompress = 1024 ** 2
+
+## ----------------------------------------------------------------------------
+#          review session: time spent in different stages
+## ----------------------------------------------------------------------------
+
+# wall time and memory for each stage of the review, per unit (JSON lines)
+file_name_timings = 'timings_per_stage.jsonl'
+stage_waiting_for_reviewer = 'show_fig_and_wait'
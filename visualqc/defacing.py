@@ -9,6 +9,7 @@ import sys
 import textwrap
 import warnings
 from abc import ABC
+from functools import partial
 
 import numpy as np
 from matplotlib import pyplot as plt
@@ -18,9 +19,10 @@ from mrivis.base import Collage, SlicePicker
 from visualqc import config as cfg
 from visualqc.image_utils import rescale_without_outliers
 from visualqc.interfaces import BaseReviewInterface
-from visualqc.utils import (check_inputs_defacing, check_out_dir,
-                            compute_cell_extents_grid, read_image)
-from visualqc.workflows import BaseWorkflowVisualQC
+from visualqc.utils import (check_inputs_defacing, check_num_bytes, check_out_dir,
+                            check_prefetch_params, compute_cell_extents_grid,
+                            read_image)
+from visualqc.workflows import BaseWorkflowVisualQC, add_review_session_args
 
 
 class DefacingInterface(BaseReviewInterface):
@@ -282,14 +284,24 @@ class RatingWorkflowDefacing(BaseWorkflowVisualQC, ABC):
                  mri_name,
                  render_name,
                  issue_list=cfg.defacing_default_issue_list,
-                 vis_type='defacing'):
+                 vis_type='defacing',
+                 prefetch_depth=cfg.default_prefetch_depth,
+                 prefetch_max_memory=cfg.default_prefetch_max_memory,
+                 unit_cache_max_bytes=cfg.default_unit_cache_max_bytes,
+                 image_cache_max_bytes=cfg.default_image_cache_max_bytes,
+                 ratings_backend=cfg.default_ratings_backend):
         """Constructor"""
 
         super().__init__(id_list, in_dir, out_dir,
                          show_unit_id=False, # preventing bias/batch-effects
                          outlier_method=None, outlier_fraction=None,
                          outlier_feat_types=None,
-                         disable_outlier_detection=None)
+                         disable_outlier_detection=None,
+                         prefetch_depth=prefetch_depth,
+                         prefetch_max_memory=prefetch_max_memory,
+                         unit_cache_max_bytes=unit_cache_max_bytes,
+                         image_cache_max_bytes=image_cache_max_bytes,
+                         ratings_backend=ratings_backend)
 
         self.vis_type = vis_type
         self.issue_list = issue_list
@@ -381,6 +393,16 @@ class RatingWorkflowDefacing(BaseWorkflowVisualQC, ABC):
         self.fig.set_size_inches(self.figsize)
 
 
+    def get_unit_reader(self, unit_id):
+        """Reader for the defaced and original MRI, and renders of a given unit."""
+
+        return partial(read_defacing_unit,
+                       self.images_for_id[unit_id]['defaced'],
+                       self.images_for_id[unit_id]['original'],
+                       self.images_for_id[unit_id]['render'],
+                       padding=self.padding, image_cache=self.image_cache)
+
+
     def load_unit(self, unit_id):
         """Loads the image data for display."""
 
@@ -389,26 +411,10 @@ class RatingWorkflowDefacing(BaseWorkflowVisualQC, ABC):
             if hasattr(self, attr):
                 delattr(self, attr)
 
-        self.defaced_img = read_image(self.images_for_id[unit_id]['defaced'],
-                                      error_msg='defaced mri')
-        self.orig_img = read_image(self.images_for_id[unit_id]['original'],
-                                   error_msg='T1 mri')
-
-        self.render_img_list = list()
-        for rimg_path in self.images_for_id[unit_id]['render']:
-            try:
-                self.render_img_list.append(imread(rimg_path))
-            except:
-                raise IOError('Unable to read the 3D rendered image @\n {}'
-                              ''.format(rimg_path))
-
-        # crop, trim, and rescale
-        self.defaced_img = rescale_without_outliers(
-            self.defaced_img, padding=self.padding,
-            trim_percentile=cfg.defacing_trim_percentile)
-        self.orig_img = rescale_without_outliers(
-            self.orig_img, padding=self.padding,
-            trim_percentile=cfg.defacing_trim_percentile)
+        unit_data = self.fetch_unit(unit_id)
+        self.defaced_img = unit_data['defaced_img']
+        self.orig_img = unit_data['orig_img']
+        self.render_img_list = unit_data['render_img_list']
         self.currently_showing = None
 
         skip_subject = False
@@ -531,6 +537,34 @@ class RatingWorkflowDefacing(BaseWorkflowVisualQC, ABC):
         plt.close('all')
 
 
+def read_defacing_unit(defaced_path, orig_path, render_paths,
+                       padding=cfg.default_padding, image_cache=None):
+    """Reads the defaced and original MRI, as well as the 3D renders."""
+
+    defaced_img = read_image(defaced_path, error_msg='defaced mri',
+                             image_cache=image_cache)
+    orig_img = read_image(orig_path, error_msg='T1 mri', image_cache=image_cache)
+
+    render_img_list = list()
+    for rimg_path in render_paths:
+        try:
+            render_img_list.append(imread(rimg_path))
+        except:
+            raise IOError('Unable to read the 3D rendered image @\n {}'
+                          ''.format(rimg_path))
+
+    # crop, trim, and rescale
+    defaced_img = rescale_without_outliers(
+        defaced_img, padding=padding,
+        trim_percentile=cfg.defacing_trim_percentile)
+    orig_img = rescale_without_outliers(
+        orig_img, padding=padding,
+        trim_percentile=cfg.defacing_trim_percentile)
+
+    return dict(defaced_img=defaced_img, orig_img=orig_img,
+                render_img_list=render_img_list)
+
+
 def get_parser():
     """Parser to specify arguments and their defaults."""
 
@@ -612,6 +646,8 @@ def get_parser():
     in_out.add_argument("-i", "--id_list", action="store", dest="id_list",
                         default=None, required=False, help=help_text_id_list)
 
+    add_review_session_args(parser)
+
     return parser
 
 
@@ -640,9 +676,23 @@ def make_workflow_from_user_options():
 
     out_dir = check_out_dir(user_args.out_dir, user_dir)
 
+    prefetch_depth, prefetch_max_memory = check_prefetch_params(
+        user_args.prefetch_depth, user_args.prefetch_max_memory)
+
+    unit_cache_max_bytes = check_num_bytes(user_args.unit_cache_max_bytes,
+                                           'unit_cache_max_bytes')
+
+    image_cache_max_bytes = check_num_bytes(user_args.image_cache_max_bytes,
+                                            'image_cache_max_bytes')
+
     wf = RatingWorkflowDefacing(id_list, images_for_id, user_dir, out_dir,
                                 defaced_name, mri_name, render_name,
-                                cfg.defacing_default_issue_list, vis_type)
+                                cfg.defacing_default_issue_list, vis_type,
+                                prefetch_depth=prefetch_depth,
+                                prefetch_max_memory=prefetch_max_memory,
+                                unit_cache_max_bytes=unit_cache_max_bytes,
+                                image_cache_max_bytes=image_cache_max_bytes,
+                                ratings_backend=user_args.ratings_backend)
 
     return wf
 
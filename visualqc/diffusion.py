@@ -10,22 +10,25 @@ import textwrap
 import time
 import warnings
 from abc import ABC
+from functools import partial
 from textwrap import wrap
 
-import nibabel as nib
 import numpy as np
 from matplotlib import pyplot as plt
 from matplotlib.widgets import CheckButtons, RadioButtons
 from mrivis.utils import crop_image
 from os.path import basename, join as pjoin
 from visualqc import config as cfg
-from visualqc.image_utils import dwi_overlay_edges
-from visualqc.readers import diffusion_traverse_bids
+from visualqc.cache import uncompressed_copy
+from visualqc.carpet import carpet_of_frames, carpet_size_in_pixels
+from visualqc.image_stats import SelectedFrames, stats_over_frames
+from visualqc.image_utils import dwi_overlay_edges, mask_image
+from visualqc.readers import diffusion_traverse_bids, load_bids_layout
 from visualqc.t1_mri import T1MriInterface
-from visualqc.utils import check_bids_dir, check_finite_int, check_image_is_4d, \
-    check_out_dir, check_outlier_params, check_time, check_views, get_axis, pick_slices, \
-    scale_0to1
-from visualqc.workflows import BaseWorkflowVisualQC
+from visualqc.utils import check_bids_dir, check_finite_int, check_num_bytes, \
+    check_out_dir, check_outlier_params, check_prefetch_params, check_time, \
+    check_views, get_axis, pick_slices, read_image, scale_0to1
+from visualqc.workflows import BaseWorkflowVisualQC, add_review_session_args
 
 _z_score = lambda x: (x - np.mean(x)) / np.std(x)
 
@@ -286,7 +289,12 @@ class DiffusionRatingWorkflow(BaseWorkflowVisualQC, ABC):
                  vis_type=None,
                  views=cfg.default_views_diffusion,
                  num_slices_per_view=cfg.default_num_slices_diffusion,
-                 num_rows_per_view=cfg.default_num_rows_diffusion):
+                 num_rows_per_view=cfg.default_num_rows_diffusion,
+                 prefetch_depth=cfg.default_prefetch_depth,
+                 prefetch_max_memory=cfg.default_prefetch_max_memory,
+                 unit_cache_max_bytes=cfg.default_unit_cache_max_bytes,
+                 image_cache_max_bytes=cfg.default_image_cache_max_bytes,
+                 ratings_backend=cfg.default_ratings_backend):
         """
         Constructor.
 
@@ -311,7 +319,12 @@ class DiffusionRatingWorkflow(BaseWorkflowVisualQC, ABC):
 
         super().__init__(id_list, in_dir, out_dir,
                          outlier_method, outlier_fraction,
-                         outlier_feat_types, disable_outlier_detection)
+                         outlier_feat_types, disable_outlier_detection,
+                         prefetch_depth=prefetch_depth,
+                         prefetch_max_memory=prefetch_max_memory,
+                         unit_cache_max_bytes=unit_cache_max_bytes,
+                         image_cache_max_bytes=image_cache_max_bytes,
+                         ratings_backend=ratings_backend)
 
         # basic cleaning before display
         # whether to remove and detrend before making carpet plot
@@ -368,6 +381,7 @@ class DiffusionRatingWorkflow(BaseWorkflowVisualQC, ABC):
         self.num_rows = len(self.views) * self.num_rows_per_view
         self.num_cols = int((len(self.views) * self.num_slices_per_view) / self.num_rows)
         self.padding = padding
+        self.carpet_size = carpet_size_in_pixels(cfg.default_review_figsize)
 
 
     def init_getters(self):
@@ -377,8 +391,7 @@ class DiffusionRatingWorkflow(BaseWorkflowVisualQC, ABC):
         self.feature_extractor = diffusion_mri_features
 
         if 'BIDS' in self.in_dir_type.upper():
-            from bids import BIDSLayout
-            self.bids_layout = BIDSLayout(self.in_dir)
+            self.bids_layout = load_bids_layout(self.in_dir, self.out_dir)
             self.units = diffusion_traverse_bids(self.bids_layout)
             # file name of each scan is the unique identifier,
             #   as it essentially contains all the key info.
@@ -417,9 +430,9 @@ class DiffusionRatingWorkflow(BaseWorkflowVisualQC, ABC):
                                          ' {}'.format(self.in_dir))
 
         self.ax_carpet.set_zorder(self.layer_order_carpet)
-        #   vmin/vmax are controlled, because we rescale all to [0, 1]
+        #   vmin/vmax are controlled, because we rescale all to [0, 1] in 8 bits
         self.imshow_params_carpet = dict(interpolation='none', aspect='auto',
-                                         origin='lower', cmap='gray', vmin=0.0, vmax=1.0)
+                                         origin='lower', cmap='gray', vmin=0, vmax=255)
 
         self.ax_carpet.yaxis.set_visible(False)
         self.ax_carpet.set_xlabel('gradient')
@@ -570,49 +583,62 @@ class DiffusionRatingWorkflow(BaseWorkflowVisualQC, ABC):
             self.current_alert_msg = None
 
 
+    def get_unit_reader(self, unit_id):
+        """Reader for the DWI of a given unit, along with its stats and carpet."""
+
+        return partial(read_dwi_unit,
+                       self.unit_by_id[unit_id]['image'],
+                       self.unit_by_id[unit_id]['bval'],
+                       apply_preproc=self.apply_preproc, carpet_size=self.carpet_size,
+                       image_cache=self.image_cache)
+
+
     def load_unit(self, unit_id):
         """Loads the image data for display."""
 
         img_path = self.unit_by_id[unit_id]['image']
-        bval_path = self.unit_by_id[unit_id]['bval']
         try:
-            hdr = nib.load(img_path)
-            self.hdr_this_unit = nib.as_closest_canonical(hdr)
-            self.img_this_unit_raw = self.hdr_this_unit.get_data()
-            self.b_values_this_unit = np.loadtxt(bval_path).flatten()
+            unit_data = self.fetch_unit(unit_id)
         except Exception as exc:
             print(exc)
             print('Unable to read image at \n\t{}'.format(img_path))
             skip_subject = True
         else:
-            check_image_is_4d(self.img_this_unit_raw)
-
-            self.b0_indices = np.flatnonzero(self.b_values_this_unit == 0)
+            self.b_values_this_unit = unit_data['b_values']
+            self.b0_indices = unit_data['b0_indices']
             if len(self.b0_indices) < 1:
                 skip_subject = True
                 print('There are no b=0 volumes for {}! Skipping it..'.format(unit_id))
                 return skip_subject
 
-            if len(self.b0_indices) == 1:
-                self.b0_volume = self.img_this_unit_raw[..., self.b0_indices].squeeze()
-            else:
+            if len(self.b0_indices) > 1:
                 # TODO which is the correct b=0 volumes are available
                 # TODO is there a way to reduce multiple into one
                 print('Multiple b=0 volumes found for {} '
                       '- choosing the first!'.format(unit_id))
-                self.b0_volume = self.img_this_unit_raw[..., self.b0_indices[0]].squeeze()
+            self.b0_volume = unit_data['b0_volume']
             # need more thorough checks on whether image loaded is indeed DWI
 
-            self.dw_indices = np.flatnonzero(self.b_values_this_unit != 0)
-            self.dw_volumes = self.img_this_unit_raw[:, :, :, self.dw_indices]
+            self.dw_indices = unit_data['dw_indices']
+            # gradients are read from disk only when shown
+            self.img_this_unit = read_image(img_path, num_dims=4, proxy=True,
+                                            image_cache=self.image_cache)
+            self.dw_volumes = SelectedFrames(self.img_this_unit, self.dw_indices)
             self.num_gradients = self.dw_volumes.shape[3]
             # to check alignment
             self.current_grad_index = 0
 
             skip_subject = False
-            if np.count_nonzero(self.img_this_unit_raw) == 0:
+            if unit_data['is_empty']:
                 skip_subject = True
                 print('Diffusion image is empty!')
+            else:
+                self.mean_this_unit = unit_data['mean_img']
+                self.stdev_this_unit = unit_data['stdev_img']
+                self.carpet = unit_data['carpet']
+                self.mean_signal_spatial = unit_data['mean_signal_spatial']
+                self.stdev_signal_spatial = unit_data['stdev_signal_spatial']
+                self.dvars = unit_data['dvars']
 
         return skip_subject
 
@@ -620,32 +646,22 @@ class DiffusionRatingWorkflow(BaseWorkflowVisualQC, ABC):
     def display_unit(self):
         """Adds multi-layered composite."""
 
-        # TODO show median signal instead of mean - or option for both?
-        self.stdev_this_unit, self.mean_this_unit = self.stats_over_gradients()
-
         # TODO what about slice timing correction?
 
-        num_voxels = np.prod(self.dw_volumes.shape[0:3])
         # TODO better way to label each gradient would be with unit vector/direction
         gradients = list(range(self.num_gradients))
 
-        # 1. compute necessary stats/composites
-        carpet, mean_signal_spatial, stdev_signal_spatial, dvars = self.compute_stats()
-
-        # 2. display/update the data
-        self.carpet_handle.set_data(carpet)
-        self.stats_handles[0].set_data(gradients, mean_signal_spatial)
-        self.stats_handles[1].set_data(gradients, stdev_signal_spatial)
+        # display/update the data computed already when loading the unit
+        self.carpet_handle.set_data(self.carpet)
+        self.stats_handles[0].set_data(gradients, self.mean_signal_spatial)
+        self.stats_handles[1].set_data(gradients, self.stdev_signal_spatial)
         # not displaying DVARS for t=0, as its always 0
-        self.stats_handles[2].set_data(gradients[1:], dvars[1:])
+        self.stats_handles[2].set_data(gradients[1:], self.dvars[1:])
 
-        # 3. updating axes limits and views
-        self.update_axes_limits(self.num_gradients, carpet.shape[0])
+        # updating axes limits and views
+        self.update_axes_limits(self.num_gradients, self.carpet.shape[0])
         self.refresh_layer_order()
 
-        # clean up
-        del carpet, mean_signal_spatial, stdev_signal_spatial, dvars
-
 
     def zoom_in_on_gradient(self, event):
         """Brings up selected time point"""
@@ -782,7 +798,7 @@ class DiffusionRatingWorkflow(BaseWorkflowVisualQC, ABC):
 
         # not cropping to help checking align in full FOV
         overlaid = scale_0to1(self.b0_volume)
-        base_img = scale_0to1(self.dw_volumes[..., self.current_grad_index].squeeze())
+        base_img = scale_0to1(self.dw_volumes[:, :, :, self.current_grad_index].squeeze())
         slices = pick_slices(base_img, self.views, self.num_slices_per_view)
         for ax_index, (dim_index, slice_index) in enumerate(slices):
             mixed = dwi_overlay_edges(get_axis(base_img, dim_index, slice_index),
@@ -917,85 +933,19 @@ class DiffusionRatingWorkflow(BaseWorkflowVisualQC, ABC):
             self.images_fg_label[ax_index].set_text(str(slice_index))
 
 
-    def compute_stats(self):
-        """Computes the necessary stats to be displayed."""
-
-        mean_signal_spatial, stdev_signal_spatial = spatial_stats(self.dw_volumes)
-        dvars = self.compute_DVARS()
-
-        for stat, sname in zip((mean_signal_spatial, stdev_signal_spatial, dvars),
-                               ('mean_signal_spatial', 'stdev_signal_spatial', 'dvars')):
-            if len(stat) != self.dw_volumes.shape[3]:
-                raise ValueError('ERROR: lengths of different stats do not match!')
-            if any(np.isnan(stat)):
-                raise ValueError('ERROR: invalid values in stat : {}'.format(sname))
-
-        carpet = self.make_carpet()
-
-        return carpet, mean_signal_spatial, stdev_signal_spatial, dvars
-
-
-    def make_carpet(self, row_order=None):
-        """Makes the carpet image
-        """
-
-        carpet = self.dw_volumes.reshape(-1, self.dw_volumes.shape[3])
-        if self.apply_preproc:
-            # no cleaning implemented so far
-            raise NotImplementedError
-
-        # TODO is rescaled over gradients allowed?
-        carpet = _rescale_over_gradients(carpet)
-
-        # TODO reorder the carper in interesting groups of rows?
-
-        return carpet
-
-
     def stats_over_b0(self, indices_b0):
         """Computes voxel-wise stats over B=0 volumes (no diffusion) data
             --> single volume over space.
         """
 
         # TODO connect this
-        b0_subset = self.dw_volumes[:, :, :, self.b0_indices]
+        b0_subset = SelectedFrames(self.img_this_unit, self.b0_indices)[:]
         mean_img = np.mean(b0_subset, axis=3)
         sd_img = np.std(b0_subset, axis=3)
 
         return mean_img, sd_img
 
 
-    def stats_over_gradients(self):
-        """Computes voxel-wise stats over gradients of diffusion data
-            --> single volume over space.
-        """
-
-        mean_img = np.mean(self.dw_volumes, axis=3)
-        sd_img = np.std(self.dw_volumes, axis=3)
-
-        return mean_img, sd_img
-
-
-    def compute_DVARS(self):
-        """
-        Computes the DVARS for a given diffusion image.
-        Statistic adapted from the fMRI world.
-        """
-        # TODO need to use a common function across usecases
-
-        RMS_diff = lambda img2, img1: np.sqrt(np.mean(np.square(img2 - img1)))
-        DVARS_1_to_N = [RMS_diff(self.dw_volumes[:, :, :, grad_idx],
-                                 self.dw_volumes[:, :, :, grad_idx - 1])
-                        for grad_idx in range(1, self.dw_volumes.shape[-1])]
-
-        DVARS = np.full(self.dw_volumes.shape[-1], np.nan)
-        # dvars value at time point 0 is set to 0
-        DVARS[0] = 0.0
-        DVARS[1:] = DVARS_1_to_N
-
-        return DVARS
-
-
     def update_axes_limits(self, num_gradients, num_voxels_shown):
         """Synchronizes the x-axis limits and updates the carpet image extents"""
 
@@ -1048,6 +998,94 @@ class DiffusionRatingWorkflow(BaseWorkflowVisualQC, ABC):
         self.anim_loop.close()
 
 
+def read_dwi_unit(img_path, bval_path, apply_preproc=False, carpet_size=None,
+                  image_cache=None):
+    """
+    Reads the DWI and its b-values, separating the b=0 volume from the DW volumes,
+    and computes everything necessary for display: stats, DVARS and the carpet.
+
+    The DW volumes are read in chunks, and are not returned, to keep the cached
+    and prefetched data small: the gradients to be shown are read from disk
+    on demand. Compressed images are decompressed once (to a temporary copy,
+    unless cached), as they are read in several passes.
+    """
+
+    b_values = np.loadtxt(bval_path).flatten()
+    b0_indices = np.flatnonzero(b_values == 0)
+    unit_data = dict(b_values=b_values, b0_indices=b0_indices)
+    if len(b0_indices) < 1:
+        return unit_data
+
+    with uncompressed_copy(img_path, image_cache) as local_path:
+        return _read_dwi_volumes(local_path, unit_data, apply_preproc, carpet_size)
+
+
+def _read_dwi_volumes(img_path, unit_data, apply_preproc, carpet_size):
+    """Reads the (uncompressed) DWI, as described in read_dwi_unit."""
+
+    img_raw = read_image(img_path, error_msg='diffusion MRI', num_dims=4, proxy=True)
+    b_values, b0_indices = unit_data['b_values'], unit_data['b0_indices']
+    dw_indices = np.flatnonzero(b_values != 0)
+    dw_volumes = SelectedFrames(img_raw, dw_indices)
+    b0_volume = img_raw[:, :, :, b0_indices[0]]
+    unit_data.update(b0_volume=b0_volume, dw_indices=dw_indices)
+
+    # TODO show median signal instead of mean - or option for both?
+    mean_img, stdev_img, mean_signal_spatial, stdev_signal_spatial, dvars, \
+        min_img, max_img = stats_over_frames(dw_volumes, extrema=True)
+
+    # no variation over gradients, at zero: every volume is empty
+    unit_data['is_empty'] = np.count_nonzero(b0_volume) == 0 and \
+                            np.count_nonzero(mean_img) == 0 and \
+                            np.count_nonzero(stdev_img) == 0
+    if unit_data['is_empty']:
+        return unit_data
+
+    for stat, sname in zip((mean_signal_spatial, stdev_signal_spatial, dvars),
+                           ('mean_signal_spatial', 'stdev_signal_spatial', 'dvars')):
+        if len(stat) != dw_volumes.shape[3]:
+            raise ValueError('ERROR: lengths of different stats do not match!')
+        if any(np.isnan(stat)):
+            raise ValueError('ERROR: invalid values in stat : {}'.format(sname))
+
+    # excluding the background from the carpet
+    mask = mask_image(mean_img, update_factor=0.9, init_percentile=5)
+    carpet = make_carpet(dw_volumes, mask, apply_preproc=apply_preproc,
+                         carpet_size=carpet_size, extrema=(min_img, max_img))
+
+    unit_data.update(mean_img=mean_img, stdev_img=stdev_img, carpet=carpet,
+                     mean_signal_spatial=mean_signal_spatial,
+                     stdev_signal_spatial=stdev_signal_spatial,
+                     dvars=dvars)
+
+    return unit_data
+
+
+def make_carpet(dw_volumes, mask, apply_preproc=False, row_order=None,
+                carpet_size=None, extrema=None):
+    """Makes the carpet image of the voxels within the mask,
+        binned down to carpet_size (rows, columns) and stored in 8 bits.
+        The DW volumes are read in chunks of gradients, once if their
+        voxel-wise (min, max) over gradients are given as extrema.
+    """
+
+    if apply_preproc:
+        # no cleaning implemented so far
+        raise NotImplementedError
+
+    # TODO is rescaled over gradients allowed?
+    if np.count_nonzero(mask) <= dw_volumes.shape[3]:
+        raise ValueError('Number of voxels is less than the number of gradients!! '
+                         'Are you sure data is reshaped correctly?')
+
+    # TODO reorder the carper in interesting groups of rows?
+
+    if carpet_size is None:
+        carpet_size = carpet_size_in_pixels()
+
+    return carpet_of_frames(dw_volumes, mask, carpet_size, extrema=extrema)
+
+
 def pis_map(diffn_img, index_low_b_val, index_high_b_val):
     """
     Produces the physically implausible signal (PIS) map [1].
@@ -1079,45 +1117,6 @@ def pis_map(diffn_img, index_low_b_val, index_high_b_val):
     return pis
 
 
-def spatial_stats(diffn_img):
-    """Computes volume-wise stats over space of diffusion data
-        --> single vector over time.
-    """
-
-    num_gradients = diffn_img.shape[3]
-    mean_signal = np.array(
-        [np.nanmean(diffn_img[:, :, :, t]) for t in range(num_gradients)])
-    stdev_signal = np.array(
-        [np.nanstd(diffn_img[:, :, :, t]) for t in range(num_gradients)])
-
-    return mean_signal, stdev_signal
-
-
-def _rescale_over_gradients(matrix):
-    """
-    Voxel-wise normalization over gradients.
-
-    Input: num_voxels x num_gradients
-    """
-
-    if matrix.shape[0] <= matrix.shape[1]:
-        raise ValueError('Number of voxels is less than the number of gradients!! '
-                         'Are you sure data is reshaped correctly?')
-
-    min_ = matrix.min(axis=1)
-    range_ = matrix.ptp(axis=1)  # ptp : peak to peak, max-min
-    min_tile = np.tile(min_, (matrix.shape[1], 1)).T
-    range_tile = np.tile(range_, (matrix.shape[1], 1)).T
-    # avoiding any numerical difficulties
-    range_tile[range_tile < np.finfo(np.float).eps] = 1.0
-
-    normed = (matrix - min_tile) / range_tile
-
-    del min_, range_, min_tile, range_tile
-
-    return normed
-
-
 def _within_frame_rescale(matrix):
     """Rescaling within a given grame"""
 
@@ -1213,12 +1212,14 @@ def get_parser():
     \n""".format(cfg.default_num_rows))
 
     help_text_prepare = textwrap.dedent("""
-    This flag enables batch-generation of 3d surface visualizations, prior to starting any review and rating operations.
+    This flag prepares the data for all the units prior to starting any review
+    and rating operations: images are read, cropped and rescaled, and stats, carpets
+    etc are computed in parallel, and saved to disk within the output folder
+    (in {}). This makes the switch from one subject to the next, even more
+    seamless, and the prepared data is reused when the review is resumed later on.
 
-    This makes the switch from one subject to the next, even more seamless (saving few seconds :) ).
-
-    Default: False (required visualizations are generated only on demand, which can take 5-10 seconds for each subject).
-    \n""")
+    Default: False (data for each unit is prepared on demand, a few units ahead).
+    \n""".format(cfg.unit_cache_dir_name))
 
     help_text_outlier_detection_method = textwrap.dedent("""
     Method used to detect the outliers.
@@ -1339,6 +1340,8 @@ def get_parser():
                          dest="prepare_first",
                          help=help_text_prepare)
 
+    add_review_session_args(parser)
+
     return parser
 
 
@@ -1389,6 +1392,15 @@ def make_workflow_from_user_options():
         user_args.outlier_feat_types, user_args.disable_outlier_detection,
         id_list, vis_type, type_of_features)
 
+    prefetch_depth, prefetch_max_memory = check_prefetch_params(
+        user_args.prefetch_depth, user_args.prefetch_max_memory)
+
+    unit_cache_max_bytes = check_num_bytes(user_args.unit_cache_max_bytes,
+                                           'unit_cache_max_bytes')
+
+    image_cache_max_bytes = check_num_bytes(user_args.image_cache_max_bytes,
+                                            'image_cache_max_bytes')
+
     wf = DiffusionRatingWorkflow(in_dir, out_dir,
                                  id_list=id_list,
                                  images_for_id=images_for_id,
@@ -1402,7 +1414,12 @@ def make_workflow_from_user_options():
                                  disable_outlier_detection=disable_outlier_detection,
                                  prepare_first=user_args.prepare_first, vis_type=vis_type,
                                  views=views, num_slices_per_view=num_slices_per_view,
-                                 num_rows_per_view=num_rows_per_view)
+                                 num_rows_per_view=num_rows_per_view,
+                                 prefetch_depth=prefetch_depth,
+                                 prefetch_max_memory=prefetch_max_memory,
+                                 unit_cache_max_bytes=unit_cache_max_bytes,
+                                 image_cache_max_bytes=image_cache_max_bytes,
+                                 ratings_backend=user_args.ratings_backend)
 
     return wf
 
@@ -0,0 +1,151 @@
+"""
+
+Module to store the features of a cohort for outlier detection,
+as a single matrix (one row per subject) along with an index of ids.
+
+"""
+
+import os
+from os.path import exists as pexists
+
+import numpy as np
+
+
+class CohortFeatureStore(object):
+    """
+    Features of all subjects in a cohort, of a given type, saved on disk
+    as one (uncompressed) .npy matrix and a text file with the id for each row.
+
+    The matrix is memory-mapped when read, so gathering the features of any
+    subset of subjects only reads their rows. Features for new subjects are
+    appended to it, without recomputing the existing ones.
+
+    """
+
+
+    def __init__(self, matrix_path, ids_path):
+        """
+        Constructor.
+
+        Parameters
+        ----------
+        matrix_path : str
+            path to the .npy file containing the matrix of features.
+
+        ids_path : str
+            path to the text file with the id of the subject in each row.
+
+        """
+
+        self.matrix_path = matrix_path
+        self.ids_path = ids_path
+
+        self.ids = list()
+        if pexists(self.ids_path) and pexists(self.matrix_path):
+            with open(self.ids_path) as idf:
+                self.ids = [line.strip() for line in idf if line.strip()]
+        self._row_of = {sid: row for row, sid in enumerate(self.ids)}
+
+
+    def __len__(self):
+        """Number of subjects in the store"""
+
+        return len(self.ids)
+
+
+    def __contains__(self, sid):
+        """Whether the features for a given subject are available."""
+
+        return sid in self._row_of
+
+
+    def matrix(self):
+        """Matrix of features for all the subjects, memory-mapped read-only."""
+
+        # rows beyond those in the index are room for subjects to be added later
+        return np.load(self.matrix_path, mmap_mode='r')[:len(self.ids)]
+
+
+    def update(self, features_by_id):
+        """
+        Appends the features for new subjects (dict of id --> 1D array),
+        replacing the features of subjects present already.
+
+        Rows are written in place, into the room left at the end of the matrix.
+        When it runs out, the matrix is copied into a new one twice as large,
+        so adding N subjects in batches costs O(N) writes overall.
+        The index of ids is updated last, so rows written before a crash are
+        simply ignored.
+        """
+
+        if len(features_by_id) < 1:
+            return
+
+        new_ids = [sid for sid in features_by_id if sid not in self._row_of]
+        num_features = len(next(iter(features_by_id.values())))
+        all_ids = self.ids + new_ids
+        row_of = {sid: row for row, sid in enumerate(all_ids)}
+
+        num_rows = 0
+        if len(self.ids) > 0:
+            num_rows, num_features_in_store = np.load(self.matrix_path,
+                                                      mmap_mode='r').shape
+            if num_features_in_store != num_features:
+                raise ValueError('Number of features ({}) does not match those '
+                                 'in the store ({})!'.format(num_features,
+                                                             num_features_in_store))
+
+        if num_rows < len(all_ids):
+            self._grow(max(len(all_ids), 2 * len(self.ids)), num_features)
+
+        matrix = np.load(self.matrix_path, mmap_mode='r+')
+        for sid, features in features_by_id.items():
+            matrix[row_of[sid], :] = features
+        matrix.flush()
+        del matrix
+
+        tmp_ids_path = '{}.tmp{}'.format(self.ids_path, os.getpid())
+        with open(tmp_ids_path, 'w') as idf:
+            idf.write('\n'.join(all_ids))
+        os.replace(tmp_ids_path, self.ids_path)
+
+        self.ids = all_ids
+        self._row_of = row_of
+
+
+    def _grow(self, num_rows, num_features):
+        """Moves the features in the store into a new matrix with the given number of rows."""
+
+        # written to a temporary file first, and moved into place once complete
+        tmp_path = '{}.tmp{}.npy'.format(self.matrix_path, os.getpid())
+        matrix = np.lib.format.open_memmap(tmp_path, mode='w+', dtype='float64',
+                                           shape=(num_rows, num_features))
+        matrix[len(self.ids):, :] = np.nan
+        if len(self.ids) > 0:
+            matrix[:len(self.ids), :] = self.matrix()
+        matrix.flush()
+        del matrix
+        os.replace(tmp_path, self.matrix_path)
+
+
+    def rows(self, id_list):
+        """
+        Features for the given subjects, in the same order.
+
+        Rows for subjects not in the store are filled with NaN.
+        """
+
+        if len(self.ids) < 1:
+            raise IOError('No features saved in {} yet!'.format(self.matrix_path))
+
+        matrix = self.matrix()
+        features = np.full((len(id_list), matrix.shape[1]), np.nan)
+        available = [(index, self._row_of[sid]) for index, sid in enumerate(id_list)
+                     if sid in self._row_of]
+        if len(available) > 0:
+            out_rows, store_rows = map(np.array, zip(*available))
+            # sorted reads are sequential on disk
+            order = np.argsort(store_rows)
+            features[out_rows[order], :] = matrix[store_rows[order], :]
+
+        return features
@@ -9,11 +9,13 @@ import numpy as np
 from os.path import exists as pexists, join as pjoin, splitext
 
 from visualqc import config as cfg
+from visualqc.feature_store import CohortFeatureStore
 from visualqc.utils import read_image, scale_0to1
 
 
 def t1_histogram_whole_scan(in_mri_path,
-                            num_bins=cfg.num_bins_histogram_intensity_distribution):
+                            num_bins=cfg.num_bins_histogram_intensity_distribution,
+                            image_cache=None):
     """
     Computes histogram over the intensity distribution over the entire scan, including brain, skull and background.
 
@@ -23,6 +25,9 @@ def t1_histogram_whole_scan(in_mri_path,
     in_mri_path : str
         Path to an MRI scan readable by Nibabel
 
+    image_cache : DecompressedImageCache
+        Cache to read compressed scans from, if any.
+
     Returns
     -------
     hist : ndarray
@@ -30,7 +35,7 @@ def t1_histogram_whole_scan(in_mri_path,
 
     """
 
-    img = read_image(in_mri_path)
+    img = read_image(in_mri_path, image_cache=image_cache)
     # scaled, and reshaped
     arr_0to1 = scale_0to1(img).flatten()
     # compute prob. density
@@ -53,8 +58,8 @@ def extract_T1_features(wf, feature_type='histogram_whole_scan'):
 
     Returns
     -------
-    feature_paths : dict
-        Dict containing paths to files with extracted features.
+    feature_store : CohortFeatureStore
+        Store containing the extracted features for all subjects.
 
     """
 
@@ -64,11 +69,14 @@ def extract_T1_features(wf, feature_type='histogram_whole_scan'):
         prefix = basename(wf.mri_name)+'_'
     else:
         prefix = ''
-    out_csv_name = '{}{}_features.csv'.format(prefix, feature_type)
+    out_name = '{}{}_features'.format(prefix, feature_type)
 
     feat_dir = pjoin(wf.out_dir, cfg.outlier_feature_folder_name)
     makedirs(feat_dir, exist_ok=True)
-    path_to_csv = lambda sid: pjoin(feat_dir, sid, out_csv_name)
+    # per-subject CSVs saved by previous versions are reused, if available
+    path_to_csv = lambda sid: pjoin(feat_dir, sid, '{}.csv'.format(out_name))
+    store = CohortFeatureStore(pjoin(feat_dir, '{}.npy'.format(out_name)),
+                               pjoin(feat_dir, '{}_ids.txt'.format(out_name)))
 
     if feature_type in ['histogram_whole_scan', ]:
         extract_method = t1_histogram_whole_scan
@@ -77,22 +85,36 @@ def extract_T1_features(wf, feature_type='histogram_whole_scan'):
                                   '\tAllowed options : {} '
                                   ''.format(feature_type, cfg.t1_mri_features_OLD))
 
-    feature_paths = dict()
+    pending = [sid for sid in wf.id_list if sid not in store]
     num_subjects = len(wf.id_list)
-    for counter, sid in enumerate(wf.id_list):
-        print('{} : {}/{}'.format(sid, counter + 1, num_subjects))
-        makedirs(pjoin(feat_dir, sid), exist_ok=True)
-        feat_file = path_to_csv(sid)
-        if not pexists(feat_file):
-            features = extract_method(wf.path_getter_inputs(sid))
-            try:
-                np.savetxt(feat_file, features, delimiter='\n', header=feature_type)
-            except:
-                raise IOError('Unable to save extracted features to disk!')
-
-        feature_paths[sid] = feat_file
-
-    return feature_paths
+    print('{} features available already for {}/{} subjects.'
+          ''.format(feature_type, num_subjects - len(pending), num_subjects))
+
+    new_features = dict()
+    for counter, sid in enumerate(pending):
+        print('{} : {}/{}'.format(sid, counter + 1, len(pending)))
+        if pexists(path_to_csv(sid)):
+            new_features[sid] = np.genfromtxt(path_to_csv(sid))
+        else:
+            new_features[sid] = extract_method(wf.path_getter_inputs(sid),
+                                               image_cache=wf.image_cache)
+
+        if len(new_features) >= cfg.num_subjects_per_feature_store_update:
+            _save_to_store(store, new_features)
+            new_features = dict()
+
+    _save_to_store(store, new_features)
+
+    return store
+
+
+def _save_to_store(store, new_features):
+    """Helper to save a batch of new features to the store."""
+
+    try:
+        store.update(new_features)
+    except:
+        raise IOError('Unable to save extracted features to disk!')
 
 
 def functional_mri_features(*args):
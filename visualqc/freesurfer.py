@@ -11,6 +11,7 @@ import textwrap
 import traceback
 import warnings
 from abc import ABC
+from functools import partial
 from os import makedirs
 from subprocess import check_output
 
@@ -20,17 +21,20 @@ from matplotlib import cm, colors, pyplot as plt
 from matplotlib.colors import is_color_like
 from matplotlib.widgets import RadioButtons, Slider
 from mrivis.color_maps import get_freesurfer_cmap
-from mrivis.utils import crop_to_seg_extents
+from mrivis.utils import crop_coords
 from os.path import exists as pexists, join as pjoin
 
 from visualqc import config as cfg
 from visualqc.interfaces import BaseReviewInterface
 from visualqc.readers import read_aparc_stats_wholebrain
+from visualqc.timing import timed_stage
 from visualqc.utils import check_alpha_set, check_finite_int, check_id_list, \
-    check_input_dir, check_labels, check_out_dir, check_outlier_params, check_views, \
-    freesurfer_installed, get_axis, get_freesurfer_mri_path, get_label_set, pick_slices, \
-    read_image, scale_0to1, void_subcortical_symmetrize_cortical
-from visualqc.workflows import BaseWorkflowVisualQC
+    check_input_dir, check_labels, check_num_bytes, check_out_dir, \
+    check_outlier_params, check_prefetch_params, check_views, freesurfer_installed, \
+    get_axis, get_freesurfer_mri_path, get_label_set, intensities_to_rgba, \
+    labels_to_rgba, pick_slices, read_image, rgba_lookup_table, \
+    void_subcortical_symmetrize_cortical
+from visualqc.workflows import BaseWorkflowVisualQC, add_review_session_args
 
 # each rating is a set of labels, join them with a plus delimiter
 _plus_join = lambda label_set: '+'.join(label_set)
@@ -273,12 +277,22 @@ class FreesurferRatingWorkflow(BaseWorkflowVisualQC, ABC):
                  no_surface_vis=False,
                  views=cfg.default_views,
                  num_slices_per_view=cfg.default_num_slices,
-                 num_rows_per_view=cfg.default_num_rows):
+                 num_rows_per_view=cfg.default_num_rows,
+                 prefetch_depth=cfg.default_prefetch_depth,
+                 prefetch_max_memory=cfg.default_prefetch_max_memory,
+                 unit_cache_max_bytes=cfg.default_unit_cache_max_bytes,
+                 image_cache_max_bytes=cfg.default_image_cache_max_bytes,
+                 ratings_backend=cfg.default_ratings_backend):
         """Constructor"""
 
         super().__init__(id_list, in_dir, out_dir,
                          outlier_method, outlier_fraction,
-                         outlier_feat_types, disable_outlier_detection)
+                         outlier_feat_types, disable_outlier_detection,
+                         prefetch_depth=prefetch_depth,
+                         prefetch_max_memory=prefetch_max_memory,
+                         unit_cache_max_bytes=unit_cache_max_bytes,
+                         image_cache_max_bytes=image_cache_max_bytes,
+                         ratings_backend=ratings_backend)
 
         self.issue_list = issue_list
         # in_dir_type must be freesurfer; vis_type must be freesurfer
@@ -321,6 +335,7 @@ class FreesurferRatingWorkflow(BaseWorkflowVisualQC, ABC):
             self.generate_surface_vis()
 
 
+    @timed_stage('generate_surface_vis')
     def generate_surface_vis(self):
         """Generates surface visualizations."""
 
@@ -392,12 +407,11 @@ class FreesurferRatingWorkflow(BaseWorkflowVisualQC, ABC):
         self.fig.canvas.set_window_title('VisualQC {} {} : {}'
                                          ' '.format(self.vis_type, self.seg_name, self.in_dir))
 
+        # alpha is part of the colors, as looked up for each slice
         self.display_params_mri = dict(interpolation='none', aspect='equal',
-                                       origin='lower',
-                                       alpha=self.alpha_mri)
+                                       origin='lower')
         self.display_params_seg = dict(interpolation='none', aspect='equal',
-                                       origin='lower',
-                                       alpha=self.alpha_seg)
+                                       origin='lower')
 
         normalize_mri = colors.Normalize(vmin=cfg.min_cmap_range_t1_mri,
                                          vmax=cfg.max_cmap_range_t1_mri, clip=True)
@@ -438,6 +452,15 @@ class FreesurferRatingWorkflow(BaseWorkflowVisualQC, ABC):
 
         self.seg_mapper = cm.ScalarMappable(norm=normalize_labels, cmap=fs_cmap)
 
+        # colors of all MRI intensities and labels are looked up in these tables,
+        #   instead of mapping each slice via to_rgba (in float64)
+        self.mri_lut = rgba_lookup_table(self.mri_mapper, alpha=self.alpha_mri)
+        # labels are from 0 to L, and any beyond get the color of L, as in Normalize
+        self.seg_lut = rgba_lookup_table(self.seg_mapper,
+                                         np.arange(normalize_labels.vmax + 1),
+                                         alpha=self.alpha_seg)
+        self.rgba_buffers = dict()
+
         # removing background - 0 stays 0
         self.unique_labels_display = np.setdiff1d(unique_labels, 0)
         if len(self.unique_labels_display) == 1:
@@ -449,18 +472,16 @@ class FreesurferRatingWorkflow(BaseWorkflowVisualQC, ABC):
         # specifying 3rd dim for empty_image to avoid any color mapping
         empty_image = np.full((10, 10, 3), 0.0)
 
-        self.h_surfaces = [None]*cfg.num_cortical_surface_vis
-
-        num_volumetric_panels = len(self.axes) - cfg.num_cortical_surface_vis
-        for ix, ax in enumerate(self.axes[:cfg.num_cortical_surface_vis]):
+        # images in each panel are created once, and updated for each unit
+        self.h_surfaces = [None] * self.volumetric_start_index
+        for ix, ax in enumerate(self.axes[:self.volumetric_start_index]):
             ax.axis('off')
             self.h_surfaces[ix] = ax.imshow(empty_image)
 
+        num_volumetric_panels = len(self.axes) - self.volumetric_start_index
         self.h_images_mri = [None] * num_volumetric_panels
-        if 'volumetric' in self.vis_type:
-            self.h_images_seg = [None] * num_volumetric_panels
-
-        for ix, ax in enumerate(self.axes[cfg.num_cortical_surface_vis:]):
+        self.h_images_seg = [None] * num_volumetric_panels
+        for ix, ax in enumerate(self.axes[self.volumetric_start_index:]):
             ax.axis('off')
             self.h_images_mri[ix] = ax.imshow(empty_image, **self.display_params_mri)
             if 'volumetric' in self.vis_type:
@@ -551,50 +572,30 @@ class FreesurferRatingWorkflow(BaseWorkflowVisualQC, ABC):
             self.current_alert_msg = None
 
 
-    def load_unit(self, unit_id):
-        """Loads the image data for display."""
+    def get_unit_reader(self, unit_id):
+        """Reader for the MRI and segmentation of a given unit."""
 
-        t1_mri_path = get_freesurfer_mri_path(self.in_dir, unit_id, self.mri_name)
-        fs_seg_path = get_freesurfer_mri_path(self.in_dir, unit_id, self.seg_name)
+        return partial(read_freesurfer_unit,
+                       get_freesurfer_mri_path(self.in_dir, unit_id, self.mri_name),
+                       get_freesurfer_mri_path(self.in_dir, unit_id, self.seg_name),
+                       self.vis_type, label_set=self.label_set, padding=self.padding,
+                       image_cache=self.image_cache)
 
-        temp_t1_mri = read_image(t1_mri_path, error_msg='T1 mri')
-        temp_fs_seg = read_image(fs_seg_path, error_msg='segmentation')
 
-        if temp_t1_mri.shape != temp_fs_seg.shape:
-            raise ValueError('size mismatch! MRI: {} Seg: {}\n'
-                             'Size must match in all dimensions.'.format(
-                self.current_t1_mri.shape,
-                temp_fs_seg.shape))
+    def load_unit(self, unit_id):
+        """Loads the image data for display."""
 
-        skip_subject = False
-        if self.vis_type in ('cortical_volumetric', 'cortical_contour'):
-            temp_seg_uncropped, roi_set_is_empty = void_subcortical_symmetrize_cortical(temp_fs_seg)
-        elif self.vis_type in ('labels_volumetric', 'labels_contour'):
-            if self.label_set is not None:
-                # TODO same colors for same labels is not guaranteed
-                #   if one subject fewer labels than others
-                #   due to remapping of labels for each subject
-                temp_seg_uncropped, roi_set_is_empty = get_label_set(temp_fs_seg,
-                                                                     self.label_set)
-            else:
-                raise ValueError('--label_set must be specified for visualization types: '
-                                 ' labels_volumetric and labels_contour')
-        else:
-            raise NotImplementedError('Invalid visualization type - '
-                                      'choose from: {}'.format(
-                cfg.visualization_combination_choices))
+        unit_data = self.fetch_unit(unit_id)
 
-        if roi_set_is_empty:
+        skip_subject = False
+        if unit_data['roi_set_is_empty']:
             skip_subject = True
             print('segmentation image for {} '
                   'does not contain requested label set!'.format(unit_id))
             return skip_subject
 
-        # T1 mri must be rescaled - to avoid strange distributions skewing plots
-        rescaled_t1_mri = scale_0to1(temp_t1_mri, cfg.max_cmap_range_t1_mri)
-        self.current_t1_mri, self.current_seg = crop_to_seg_extents(rescaled_t1_mri,
-                                                                    temp_seg_uncropped,
-                                                                    self.padding)
+        self.current_t1_mri = unit_data['t1_mri']
+        self.current_seg = unit_data['seg']
 
         out_vis_path = pjoin(self.out_dir,
                              'visual_qc_{}_{}_{}'.format(self.vis_type, self.suffix,
@@ -607,40 +608,42 @@ class FreesurferRatingWorkflow(BaseWorkflowVisualQC, ABC):
         """Adds slice collage, with seg overlays on MRI in each panel."""
 
         if 'cortical' in self.vis_type:
+            for h_surf in self.h_surfaces:
+                h_surf.set_visible(False)
             if not self.no_surface_vis and self.current_unit_id in self.surface_vis_paths:
                 surf_paths = self.surface_vis_paths[self.current_unit_id] # is a dict of paths
                 for sf_ax_index, ((hemi, view), spath) in enumerate(surf_paths.items()):
-                    plt.sca(self.axes[sf_ax_index])
                     img = mpimg.imread(spath)
                     # img = crop_image(img)
-                    h_surf = plt.imshow(img)
-                    self.axes[sf_ax_index].text(0, 0, '{} {}'.format(hemi, view))
-                    self.UI.data_handles.append(h_surf)
+                    _update_image(self.h_surfaces[sf_ax_index], img)
+                    h_text = self.axes[sf_ax_index].text(0, 0, '{} {}'.format(hemi, view))
+                    self.UI.data_handles.append(h_text)
             else:
                 msg = 'no surface visualizations\navailable or disabled'
                 print('{} for {}'.format(msg, self.current_unit_id))
-                self.axes[1].text(0.5, 0.5, msg)
+                h_text = self.axes[1].text(0.5, 0.5, msg)
+                self.UI.data_handles.append(h_text)
 
         slices = pick_slices(self.current_seg, self.views, self.num_slices_per_view)
         for vol_ax_index, (dim_index, slice_index) in enumerate(slices):
             panel_index = self.volumetric_start_index + vol_ax_index
-            plt.sca(self.axes[panel_index])
             slice_mri = get_axis(self.current_t1_mri, dim_index, slice_index)
             slice_seg = get_axis(self.current_seg, dim_index, slice_index)
 
-            mri_rgba = self.mri_mapper.to_rgba(slice_mri, alpha=self.alpha_mri)
-            # self.h_images_mri[ax_index].set_data(mri_rgb)
-            h_m = plt.imshow(mri_rgba, interpolation='none',
-                             aspect='equal', origin='lower')
-            self.UI.data_handles.append(h_m)
+            mri_rgba = intensities_to_rgba(slice_mri, self.mri_lut,
+                                           cfg.min_cmap_range_t1_mri,
+                                           cfg.max_cmap_range_t1_mri,
+                                           out=self._rgba_buffer('mri', slice_mri.shape))
+            _update_image(self.h_images_mri[vol_ax_index], mri_rgba)
 
             if 'volumetric' in self.vis_type:
-                seg_rgba = self.seg_mapper.to_rgba(slice_seg, alpha=self.alpha_seg)
-                # self.h_images_seg[ax_index].set_data(seg_rgb)
-                h_seg = plt.imshow(seg_rgba, interpolation='none',
-                                   aspect='equal', origin='lower')
+                seg_rgba = labels_to_rgba(slice_seg, self.seg_lut,
+                                          out=self._rgba_buffer('seg', slice_seg.shape))
+                h_seg = self.h_images_seg[vol_ax_index]
+                _update_image(h_seg, seg_rgba)
+                # back to the alpha in its colors, in case it was changed via the UI
+                h_seg.set_alpha(None)
                 self.togglable_handles.append(h_seg)
-                # self.UI.data_handles.append(h_seg)
                 del seg_rgba
             elif 'contour' in self.vis_type:
                 h_seg = self.plot_contours_in_slice(slice_seg, self.axes[panel_index])
@@ -651,11 +654,32 @@ class FreesurferRatingWorkflow(BaseWorkflowVisualQC, ABC):
 
             del slice_seg, slice_mri, mri_rgba
 
+        # hiding the panels left over, when there are fewer slices for this unit
+        for h_mri, h_seg in zip(self.h_images_mri[len(slices):],
+                                self.h_images_seg[len(slices):]):
+            h_mri.set_visible(False)
+            if h_seg is not None:
+                h_seg.set_visible(False)
+
         # histogram shown only for cortical parcellation QC
         if self.vis_type in cfg.cortical_types:
             self.update_histogram()
 
 
+    def _rgba_buffer(self, name, shape):
+        """
+        Preallocated uint8 RGBA image for slices of the given shape, grown
+        as needed and reused across panels and units, as imshow keeps a copy
+        of what it is given.
+        """
+
+        size = 4 * int(np.prod(shape))
+        if name not in self.rgba_buffers or self.rgba_buffers[name].size < size:
+            self.rgba_buffers[name] = np.empty(size, dtype='uint8')
+
+        return self.rgba_buffers[name][:size].reshape(tuple(shape) + (4, ))
+
+
     def plot_contours_in_slice(self, slice_seg, target_axis):
         """Plots contour around the data in slice (after binarization)"""
 
@@ -687,6 +711,77 @@ class FreesurferRatingWorkflow(BaseWorkflowVisualQC, ABC):
         plt.close('all')
 
 
+def _update_image(h_image, image):
+    """Shows a new image in an existing artist, updating its extent to match."""
+
+    num_rows, num_cols = image.shape[:2]
+    if h_image.origin == 'lower':
+        extent = (-0.5, num_cols - 0.5, -0.5, num_rows - 0.5)
+    else:
+        extent = (-0.5, num_cols - 0.5, num_rows - 0.5, -0.5)
+
+    h_image.set_data(image)
+    h_image.set_extent(extent)
+    h_image.set_visible(True)
+
+
+def read_freesurfer_unit(t1_mri_path, fs_seg_path, vis_type,
+                         label_set=None, padding=cfg.default_padding,
+                         image_cache=None):
+    """
+    Reads the MRI and segmentation, selects the labels to be shown,
+    and crops both to the extents of the chosen labels.
+
+    Only the part of the MRI within those extents is read, and its intensity
+    range is estimated from a regular sample of voxels across the whole MRI.
+    """
+
+    temp_t1_mri = read_image(t1_mri_path, error_msg='T1 mri', proxy=True,
+                             image_cache=image_cache)
+    temp_fs_seg = read_image(fs_seg_path, error_msg='segmentation', labels=True,
+                             image_cache=image_cache)
+
+    if temp_t1_mri.shape != temp_fs_seg.shape:
+        raise ValueError('size mismatch! MRI: {} Seg: {}\n'
+                         'Size must match in all dimensions.'.format(
+            temp_t1_mri.shape,
+            temp_fs_seg.shape))
+
+    if vis_type in ('cortical_volumetric', 'cortical_contour'):
+        temp_seg_uncropped, roi_set_is_empty = void_subcortical_symmetrize_cortical(temp_fs_seg)
+    elif vis_type in ('labels_volumetric', 'labels_contour'):
+        if label_set is not None:
+            # TODO same colors for same labels is not guaranteed
+            #   if one subject fewer labels than others
+            #   due to remapping of labels for each subject
+            temp_seg_uncropped, roi_set_is_empty = get_label_set(temp_fs_seg,
+                                                                 label_set)
+        else:
+            raise ValueError('--label_set must be specified for visualization types: '
+                             ' labels_volumetric and labels_contour')
+    else:
+        raise NotImplementedError('Invalid visualization type - '
+                                  'choose from: {}'.format(
+            cfg.visualization_combination_choices))
+
+    if roi_set_is_empty:
+        return dict(roi_set_is_empty=roi_set_is_empty)
+
+    beg_coords, end_coords = crop_coords(temp_seg_uncropped, padding)
+    extents = tuple(slice(beg, end) for beg, end in zip(beg_coords, end_coords))
+    t1_mri = temp_t1_mri[extents]
+    seg = temp_seg_uncropped[extents]
+
+    # T1 mri must be rescaled - to avoid strange distributions skewing plots
+    #   excluding the darkest 1% of voxels, as scale_0to1 would
+    intensity_sample = temp_t1_mri.sample()
+    min_value = np.percentile(intensity_sample, cfg.max_cmap_range_t1_mri)
+    max_value = max(intensity_sample.max(), t1_mri.max())
+    t1_mri = (np.fmax(t1_mri, min_value) - min_value) / (max_value - min_value)
+
+    return dict(roi_set_is_empty=roi_set_is_empty, t1_mri=t1_mri, seg=seg)
+
+
 def make_vis_pial_surface(in_dir, subject_id, out_dir,
                           FREESURFER_INSTALLED,
                           annot_file='aparc.annot'):
@@ -996,6 +1091,8 @@ def get_parser():
     wf_args.add_argument("-ns", "--no_surface_vis", action="store_true",
                          dest="no_surface_vis", help=help_text_no_surface_vis)
 
+    add_review_session_args(parser)
+
     return parser
 
 
@@ -1041,6 +1138,15 @@ def make_workflow_from_user_options():
                              user_args.disable_outlier_detection,
                              id_list, vis_type, source_of_features)
 
+    prefetch_depth, prefetch_max_memory = check_prefetch_params(
+        user_args.prefetch_depth, user_args.prefetch_max_memory)
+
+    unit_cache_max_bytes = check_num_bytes(user_args.unit_cache_max_bytes,
+                                           'unit_cache_max_bytes')
+
+    image_cache_max_bytes = check_num_bytes(user_args.image_cache_max_bytes,
+                                            'image_cache_max_bytes')
+
     wf = FreesurferRatingWorkflow(id_list,
                                   images_for_id,
                                   in_dir,
@@ -1059,7 +1165,12 @@ def make_workflow_from_user_options():
                                   no_surface_vis=user_args.no_surface_vis,
                                   views=views,
                                   num_slices_per_view=num_slices,
-                                  num_rows_per_view=num_rows)
+                                  num_rows_per_view=num_rows,
+                                  prefetch_depth=prefetch_depth,
+                                  prefetch_max_memory=prefetch_max_memory,
+                                  unit_cache_max_bytes=unit_cache_max_bytes,
+                                  image_cache_max_bytes=image_cache_max_bytes,
+                                  ratings_backend=user_args.ratings_backend)
 
     return wf
 
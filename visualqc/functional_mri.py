@@ -8,9 +8,9 @@ import sys
 import textwrap
 import warnings
 from abc import ABC
+from functools import partial
 from textwrap import wrap
 
-import nibabel as nib
 import numpy as np
 from matplotlib import pyplot as plt
 from matplotlib.widgets import CheckButtons
@@ -18,13 +18,16 @@ from mrivis.utils import crop_image
 from os.path import basename, join as pjoin, realpath, splitext
 
 from visualqc import config as cfg
+from visualqc.cache import uncompressed_copy
+from visualqc.carpet import carpet_of_frames, carpet_size_in_pixels
+from visualqc.image_stats import SelectedFrames, stats_over_frames
 from visualqc.image_utils import mask_image
-from visualqc.readers import func_mri_traverse_bids
+from visualqc.readers import func_mri_traverse_bids, load_bids_layout
 from visualqc.t1_mri import T1MriInterface
 from visualqc.utils import check_bids_dir, check_finite_int, check_id_list_with_regex, \
-    check_image_is_4d, check_out_dir, check_outlier_params, check_views, get_axis, \
-    pick_slices, scale_0to1
-from visualqc.workflows import BaseWorkflowVisualQC
+    check_num_bytes, check_out_dir, check_outlier_params, \
+    check_prefetch_params, check_views, get_axis, pick_slices, read_image, scale_0to1
+from visualqc.workflows import BaseWorkflowVisualQC, add_review_session_args
 
 
 def _unbidsify(filename, max_width = 18):
@@ -242,7 +245,12 @@ class FmriRatingWorkflow(BaseWorkflowVisualQC, ABC):
                  vis_type=None,
                  views=cfg.default_views_fmri,
                  num_slices_per_view=cfg.default_num_slices_fmri,
-                 num_rows_per_view=cfg.default_num_rows_fmri):
+                 num_rows_per_view=cfg.default_num_rows_fmri,
+                 prefetch_depth=cfg.default_prefetch_depth,
+                 prefetch_max_memory=cfg.default_prefetch_max_memory,
+                 unit_cache_max_bytes=cfg.default_unit_cache_max_bytes,
+                 image_cache_max_bytes=cfg.default_image_cache_max_bytes,
+                 ratings_backend=cfg.default_ratings_backend):
         """
         Constructor.
 
@@ -268,7 +276,12 @@ class FmriRatingWorkflow(BaseWorkflowVisualQC, ABC):
 
         super().__init__(id_list, in_dir, out_dir,
                          outlier_method, outlier_fraction,
-                         outlier_feat_types, disable_outlier_detection)
+                         outlier_feat_types, disable_outlier_detection,
+                         prefetch_depth=prefetch_depth,
+                         prefetch_max_memory=prefetch_max_memory,
+                         unit_cache_max_bytes=unit_cache_max_bytes,
+                         image_cache_max_bytes=image_cache_max_bytes,
+                         ratings_backend=ratings_backend)
 
         # proper checks
         self.drop_start = drop_start
@@ -332,6 +345,7 @@ class FmriRatingWorkflow(BaseWorkflowVisualQC, ABC):
         self.num_rows = len(self.views) * self.num_rows_per_view
         self.num_cols = int((len(self.views) * self.num_slices_per_view) / self.num_rows)
         self.padding = padding
+        self.carpet_size = carpet_size_in_pixels(cfg.default_review_figsize)
 
 
     def init_getters(self):
@@ -341,8 +355,7 @@ class FmriRatingWorkflow(BaseWorkflowVisualQC, ABC):
         self.feature_extractor = functional_mri_features
 
         if 'BIDS' in self.in_dir_type.upper():
-            from bids import BIDSLayout
-            self.bids_layout = BIDSLayout(self.in_dir)
+            self.bids_layout = load_bids_layout(self.in_dir, self.out_dir)
             self.units = func_mri_traverse_bids(self.bids_layout,
                                                 **cfg.func_mri_BIDS_filters)
 
@@ -389,10 +402,10 @@ class FmriRatingWorkflow(BaseWorkflowVisualQC, ABC):
                                          ' {}'.format(self.in_dir))
 
         self.ax_carpet.set_zorder(self.layer_order_carpet)
-        #   vmin/vmax are controlled, because we rescale all to [0, 1]
+        #   vmin/vmax are controlled, because we rescale all to [0, 1] in 8 bits
         self.imshow_params_carpet = dict(interpolation='none', aspect='auto',
                                          origin='lower', cmap='gray',
-                                         vmin=0.0, vmax=1.0)
+                                         vmin=0, vmax=255)
 
         self.ax_carpet.yaxis.set_visible(False)
         self.ax_carpet.set_xlabel('time point')
@@ -529,27 +542,43 @@ class FmriRatingWorkflow(BaseWorkflowVisualQC, ABC):
             self.current_alert_msg = None
 
 
+    def get_unit_reader(self, unit_id):
+        """Reader for the BOLD scan of a given unit, along with its stats and carpet."""
+
+        return partial(read_fmri_unit, self.unit_by_id[unit_id]['image'],
+                       drop_start=self.drop_start, drop_end=self.drop_end,
+                       no_preproc=self.no_preproc, carpet_size=self.carpet_size,
+                       image_cache=self.image_cache)
+
+
     def load_unit(self, unit_id):
         """Loads the image data for display."""
 
         img_path = self.unit_by_id[unit_id]['image']
-        params_path = self.unit_by_id[unit_id]['params']
         try:
-            hdr = nib.load(img_path)
-            self.hdr_this_unit = nib.as_closest_canonical(hdr)
-            self.img_this_unit_raw = self.hdr_this_unit.get_data()
+            unit_data = self.fetch_unit(unit_id)
         except Exception as exc:
             print(exc)
             print('Unable to read image at \n\t{}'.format(img_path))
             skip_subject = True
         else:
-            check_image_is_4d(self.img_this_unit_raw)
-            self.TR_this_unit = self.hdr_this_unit.header.get_zooms()[-1]
+            self.TR_this_unit = unit_data['TR']
+            self.num_frames_this_unit = unit_data['num_frames']
+            # frames are read from disk only when zoomed in on
+            self.img_this_unit = read_image(img_path, num_dims=4, proxy=True,
+                                            image_cache=self.image_cache)
 
             skip_subject = False
-            if np.count_nonzero(self.img_this_unit_raw) == 0:
+            if unit_data['is_empty']:
                 skip_subject = True
                 print('Functional image is empty!')
+            else:
+                self.mean_this_unit = unit_data['mean_img']
+                self.stdev_this_unit = unit_data['stdev_img']
+                self.carpet = unit_data['carpet']
+                self.mean_signal_spatial = unit_data['mean_signal_spatial']
+                self.stdev_signal_spatial = unit_data['stdev_signal_spatial']
+                self.dvars = unit_data['dvars']
 
         return skip_subject
 
@@ -557,78 +586,26 @@ class FmriRatingWorkflow(BaseWorkflowVisualQC, ABC):
     def display_unit(self):
         """Adds multi-layered composite."""
 
-        # if frames are to be dropped
-        end_frame = self.img_this_unit_raw.shape[3] - self.drop_end
-        self.img_this_unit = self.img_this_unit_raw[:, :, :, self.drop_start:end_frame]
-        # TODO show median signal instead of mean - or option for both?
-        self.stdev_this_unit, self.mean_this_unit = temporal_stats(self.img_this_unit)
-
         # TODO should we perform head motion correction before any display at all?
         # TODO what about slice timing correction?
 
-        num_voxels = np.prod(self.img_this_unit.shape[0:3])
-        num_time_points = self.img_this_unit.shape[3]
+        num_time_points = self.num_frames_this_unit
         time_points = list(range(num_time_points))
 
-        # 1. compute necessary stats/composites
-        carpet, mean_signal_spatial, stdev_signal_spatial, dvars = self.compute_stats()
-
-        # 2. display/update the data
-        self.carpet_handle.set_data(carpet)
-        self.stats_handles[0].set_data(time_points, mean_signal_spatial)
-        self.stats_handles[1].set_data(time_points, stdev_signal_spatial)
+        # display/update the data computed already when loading the unit
+        self.carpet_handle.set_data(self.carpet)
+        self.stats_handles[0].set_data(time_points, self.mean_signal_spatial)
+        self.stats_handles[1].set_data(time_points, self.stdev_signal_spatial)
         # not displaying DVARS for t=0, as its always 0
-        self.stats_handles[2].set_data(time_points[1:], dvars[1:])
+        self.stats_handles[2].set_data(time_points[1:], self.dvars[1:])
 
-        # 3. updating axes limits and views
-        self.update_axes_limits(num_time_points, carpet.shape[0])
+        # updating axes limits and views
+        self.update_axes_limits(num_time_points, self.carpet.shape[0])
         self.refresh_layer_order()
 
-        # clean up
-        del carpet, mean_signal_spatial, stdev_signal_spatial, dvars
-
         print()
 
 
-    def make_carpet(self, mask, row_order=None):
-        """
-        Makes the carpet image
-
-
-        Parameters
-        ----------
-        func_img
-
-        Returns
-        -------
-
-        """
-
-        carpet = self.img_this_unit.reshape(-1, self.img_this_unit.shape[3])
-        if not self.no_preproc:
-            from nilearn.signal import clean
-            # notice the transpose before clean and after
-            carpet = clean(carpet.T, t_r=self.TR_this_unit,
-                           detrend=True, standardize=False).T
-
-        # Removes voxels with low variance
-        cropped_carpet = np.delete(carpet, np.where(mask.flatten() == 0), axis=0)
-        normed_carpet = _rescale_over_time(cropped_carpet)
-
-        del carpet, cropped_carpet
-
-        # TODO blurring within tissue segmentations and other deeper subcortical areas
-        # TODO reorder rows either using anatomical seg, or using clustering
-
-        # dropping alternating voxels if it gets too big
-        # to save on memory and avoid losing signal
-        if normed_carpet.shape[1] > 600:
-            print('Too many frames (n={}) to display: dropping alternating frames'.format(normed_carpet.shape[1]))
-            normed_carpet = normed_carpet[:, ::2]
-
-        return normed_carpet
-
-
     def zoom_in_on_time_point(self, event):
         """Brings up selected time point"""
 
@@ -639,17 +616,17 @@ class FmriRatingWorkflow(BaseWorkflowVisualQC, ABC):
         x_in_carpet, _y = self._event_location_in_axis(event, self.ax_carpet)
         # clipping it to [0, T]
         self.current_time_point = max(0,
-                                      min(self.img_this_unit.shape[3],
+                                      min(self.num_frames_this_unit,
                                           int(round(x_in_carpet))))
         self.show_timepoint(self.current_time_point)
 
 
     def show_next_time_point(self):
 
-        if self.current_time_point == self.img_this_unit.shape[3] - 1:
+        if self.current_time_point == self.num_frames_this_unit - 1:
             return  # do nothing
 
-        self.current_time_point = min(self.img_this_unit.shape[3] - 1,
+        self.current_time_point = min(self.num_frames_this_unit - 1,
                                       self.current_time_point + 1)
         self.show_timepoint(self.current_time_point)
 
@@ -682,13 +659,13 @@ class FmriRatingWorkflow(BaseWorkflowVisualQC, ABC):
     def show_timepoint(self, time_pt):
         """Exhibits a selected timepoint on top of stats/carpet"""
 
-        if time_pt < 0 or time_pt >= self.img_this_unit.shape[3]:
+        if time_pt < 0 or time_pt >= self.num_frames_this_unit:
             print('Requested time point outside '
-                  'range [0, {}]'.format(self.img_this_unit.shape[3]))
+                  'range [0, {}]'.format(self.num_frames_this_unit))
             return
 
         # print('Time point zoomed-in {}'.format(time_pt))
-        image3d = np.squeeze(self.img_this_unit[:, :, :, time_pt])
+        image3d = self.img_this_unit[:, :, :, self.drop_start + time_pt]
         self.attach_image_to_foreground_axes(image3d)
         self._identify_foreground('zoomed-in time point {}'.format(time_pt))
         # this state flag in important
@@ -723,26 +700,6 @@ class FmriRatingWorkflow(BaseWorkflowVisualQC, ABC):
             ax.set(visible=True, zorder=self.layer_order_zoomedin)
 
 
-    def compute_stats(self):
-        """Computes the necessary stats to be displayed."""
-
-        mean_img_temporal, stdev_img_temporal = temporal_stats(self.img_this_unit)
-        mean_signal_spatial, stdev_signal_spatial = spatial_stats(self.img_this_unit)
-        dvars = compute_DVARS(self.img_this_unit)
-
-        for stat, sname in zip((mean_signal_spatial, stdev_signal_spatial, dvars),
-                               ('mean_signal_spatial', 'stdev_signal_spatial', 'dvars')):
-            if len(stat) != self.img_this_unit.shape[3]:
-                raise ValueError('ERROR: lengths of different stats do not match!')
-            if any(np.isnan(stat)):
-                raise ValueError('ERROR: invalid values in stat : {}'.format(sname))
-
-        mask = mask_image(mean_img_temporal, update_factor=0.9, init_percentile=5)
-        carpet = self.make_carpet(mask)
-
-        return carpet, mean_signal_spatial, stdev_signal_spatial, dvars
-
-
     def update_axes_limits(self, num_time_points, num_voxels_shown):
         """Synchronizes the x-axis limits and updates the carpet image extents"""
 
@@ -794,75 +751,112 @@ class FmriRatingWorkflow(BaseWorkflowVisualQC, ABC):
         plt.close('all')
 
 
-def compute_DVARS(func_img, mean_img=None, mask=None, apply_mask=False):
-    """Computes the DVARS for a given fMRI image."""
+def read_fmri_unit(img_path, drop_start=0, drop_end=0, no_preproc=False,
+                   carpet_size=None, image_cache=None):
+    """
+    Reads the BOLD scan, drops the requested frames, and computes everything
+    necessary for its display: temporal and spatial stats, DVARS and the carpet.
+
+    The scan is read in chunks of frames, and never held in memory as a whole,
+    whether it is compressed or not. Compressed scans are decompressed once
+    (to a temporary copy, unless cached), as they are read in several passes.
+    The scan is not returned either, to keep the cached and prefetched data
+    small: the frames to be shown are read from disk on demand.
+    """
 
-    if mean_img is None:
-        mean_img = np.mean(func_img, axis=3)
+    with uncompressed_copy(img_path, image_cache) as local_path:
+        return _read_fmri_frames(local_path, drop_start, drop_end,
+                                 no_preproc, carpet_size)
 
-    if apply_mask:
-        if mask is None:
-            mask = mask_image(mean_img)
-        mean_img[np.logical_not(mask)] = 0.0
 
-    num_time_points = func_img.shape[3]
+def _read_fmri_frames(img_path, drop_start, drop_end, no_preproc, carpet_size):
+    """Reads the (uncompressed) BOLD scan, as described in read_fmri_unit."""
 
-    RMS_diff = lambda img2, img1: np.sqrt(np.mean(np.square(img2 - img1)))
-    DVARS_1_to_N = [RMS_diff(func_img[:, :, :, t], func_img[:, :, :, t - 1]) for t in
-                    range(1, num_time_points)]
+    img_raw = read_image(img_path, error_msg='functional MRI', num_dims=4, proxy=True)
+    TR = img_raw.header.get_zooms()[-1]
 
-    DVARS = np.full(num_time_points, np.nan)
-    # dvars value at time point 0 is set to 0
-    DVARS[0] = 0.0
-    DVARS[1:] = DVARS_1_to_N
+    # if frames are to be dropped
+    end_frame = img_raw.shape[3] - drop_end
+    func_img = SelectedFrames(img_raw, range(drop_start, end_frame))
 
-    return DVARS
+    # TODO show median signal instead of mean - or option for both?
+    mean_img, stdev_img, mean_signal_spatial, stdev_signal_spatial, dvars, \
+        min_img, max_img = stats_over_frames(func_img, extrema=True)
 
+    # no variation over time, at zero: every frame is empty
+    unit_data = dict(TR=TR, num_frames=func_img.shape[3],
+                     is_empty=np.count_nonzero(mean_img) == 0 and
+                              np.count_nonzero(stdev_img) == 0)
+    if unit_data['is_empty']:
+        return unit_data
 
-def temporal_stats(func_img):
-    """Computes voxel-wise temporal average of functional data --> single volume over space."""
+    for stat, sname in zip((mean_signal_spatial, stdev_signal_spatial, dvars),
+                           ('mean_signal_spatial', 'stdev_signal_spatial', 'dvars')):
+        if len(stat) != func_img.shape[3]:
+            raise ValueError('ERROR: lengths of different stats do not match!')
+        if any(np.isnan(stat)):
+            raise ValueError('ERROR: invalid values in stat : {}'.format(sname))
 
-    mean_img = np.mean(func_img, axis=3)
-    sd_img = np.std(func_img, axis=3)
+    mask = mask_image(mean_img, update_factor=0.9, init_percentile=5)
+    carpet = make_carpet(func_img, mask, TR, no_preproc=no_preproc,
+                         carpet_size=carpet_size, extrema=(min_img, max_img))
 
-    return mean_img, sd_img
+    unit_data.update(mean_img=mean_img, stdev_img=stdev_img, carpet=carpet,
+                     mean_signal_spatial=mean_signal_spatial,
+                     stdev_signal_spatial=stdev_signal_spatial,
+                     dvars=dvars)
 
+    return unit_data
 
-def spatial_stats(func_img):
-    """Computes volume-wise spatial average of functional data --> single vector over time."""
 
-    num_time_points = func_img.shape[3]
-    mean_signal = np.array(
-        [np.nanmean(func_img[:, :, :, t]) for t in range(num_time_points)])
-    stdev_signal = np.array(
-        [np.nanstd(func_img[:, :, :, t]) for t in range(num_time_points)])
+def make_carpet(func_img, mask, TR, no_preproc=False, row_order=None,
+                carpet_size=None, extrema=None):
+    """
+    Makes the carpet image
 
-    return mean_signal, stdev_signal
+    Parameters
+    ----------
+    func_img : ndarray
+        4D BOLD scan, or anything that can be sliced like it (memmap, image proxy etc),
+        read in chunks of frames.
 
+    mask : ndarray
+        3D mask identifying the voxels to be shown
 
-def _rescale_over_time(matrix):
-    """
-    Voxel-wise normalization over time.
+    TR : float
+        repetition time
+
+    no_preproc : bool
+        Flag to skip the detrending before display.
+
+    carpet_size : tuple
+        Number of pixels (rows, columns) available to display the carpet.
+        Default: as estimated for the review figure.
+
+    extrema : tuple
+        voxel-wise (min, max) over frames, if known already, to rescale the
+        carpet without reading the frames again (when not detrending).
+
+    Returns
+    -------
+    normed_carpet : ndarray
+        num_voxels x num_time_points (binned down to carpet_size), in 8 bits
 
-    Input: num_voxels x num_time_points
     """
 
-    if matrix.shape[0] <= matrix.shape[1]:
+    # Removes voxels with low variance
+    if np.count_nonzero(mask) <= func_img.shape[3]:
         raise ValueError('Number of voxels is less than the number of time points!! '
                       'Are you sure data is reshaped correctly?')
 
-    min_ = matrix.min(axis=1)
-    range_ = matrix.ptp(axis=1)  # ptp : peak to peak, max-min
-    min_tile = np.tile(min_, (matrix.shape[1], 1)).T
-    range_tile = np.tile(range_, (matrix.shape[1], 1)).T
-    # avoiding any numerical difficulties
-    range_tile[range_tile < np.finfo(np.float).eps] = 1.0
-
-    normed = (matrix - min_tile) / range_tile
+    # TODO blurring within tissue segmentations and other deeper subcortical areas
+    # TODO reorder rows either using anatomical seg, or using clustering
 
-    del min_, range_, min_tile, range_tile
+    if carpet_size is None:
+        carpet_size = carpet_size_in_pixels()
 
-    return normed
+    return carpet_of_frames(func_img, mask, carpet_size, detrend=not no_preproc, TR=TR,
+                            extrema=extrema)
 
 
 def _within_frame_rescale(matrix):
@@ -960,12 +954,14 @@ def get_parser():
     \n""".format(cfg.default_num_rows))
 
     help_text_prepare = textwrap.dedent("""
-    This flag enables batch-generation of 3d surface visualizations, prior to starting any review and rating operations.
+    This flag prepares the data for all the units prior to starting any review
+    and rating operations: images are read, cropped and rescaled, and stats, carpets
+    etc are computed in parallel, and saved to disk within the output folder
+    (in {}). This makes the switch from one subject to the next, even more
+    seamless, and the prepared data is reused when the review is resumed later on.
 
-    This makes the switch from one subject to the next, even more seamless (saving few seconds :) ).
-
-    Default: False (required visualizations are generated only on demand, which can take 5-10 seconds for each subject).
-    \n""")
+    Default: False (data for each unit is prepared on demand, a few units ahead).
+    \n""".format(cfg.unit_cache_dir_name))
 
     help_text_outlier_detection_method = textwrap.dedent("""
     Method used to detect the outliers.
@@ -1068,6 +1064,8 @@ def get_parser():
                          dest="prepare_first",
                          help=help_text_prepare)
 
+    add_review_session_args(parser)
+
     return parser
 
 
@@ -1116,6 +1114,15 @@ def make_workflow_from_user_options():
         user_args.outlier_feat_types, user_args.disable_outlier_detection,
         id_list, vis_type, type_of_features)
 
+    prefetch_depth, prefetch_max_memory = check_prefetch_params(
+        user_args.prefetch_depth, user_args.prefetch_max_memory)
+
+    unit_cache_max_bytes = check_num_bytes(user_args.unit_cache_max_bytes,
+                                           'unit_cache_max_bytes')
+
+    image_cache_max_bytes = check_num_bytes(user_args.image_cache_max_bytes,
+                                            'image_cache_max_bytes')
+
     wf = FmriRatingWorkflow(in_dir, out_dir,
                             id_list=id_list,
                             images_for_id=images_for_id,
@@ -1127,7 +1134,12 @@ def make_workflow_from_user_options():
                             disable_outlier_detection=disable_outlier_detection,
                             prepare_first=user_args.prepare_first, vis_type=vis_type,
                             views=views, num_slices_per_view=num_slices_per_view,
-                            num_rows_per_view=num_rows_per_view)
+                            num_rows_per_view=num_rows_per_view,
+                            prefetch_depth=prefetch_depth,
+                            prefetch_max_memory=prefetch_max_memory,
+                            unit_cache_max_bytes=unit_cache_max_bytes,
+                            image_cache_max_bytes=image_cache_max_bytes,
+                            ratings_backend=user_args.ratings_backend)
 
     return wf
 
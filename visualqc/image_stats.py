@@ -0,0 +1,229 @@
+"""
+
+Module to compute summary statistics of 4D images (functional or diffusion MRI)
+over time or gradients, and over space, in chunks of frames.
+
+"""
+
+import numpy as np
+
+from visualqc import config as cfg
+
+
+def stats_over_frames(img4d, num_frames_per_chunk=cfg.num_frames_per_chunk_stats,
+                      mask=None, standardize_dvars=False, extrema=False):
+    """
+    Computes the voxel-wise mean and std. dev over frames, the mean and
+    std. dev of each frame over space, and DVARS, all in a single pass.
+
+    Frames are read in chunks (e.g. from a memory-mapped image), and the
+    voxel-wise stats are accumulated in float64 by combining the mean and
+    variance of each chunk (Welford/Chan et al.), so the image need not fit
+    in memory, and peak memory used is a few chunks.
+
+    Parameters
+    ----------
+    img4d : ndarray
+        4D image, or anything that can be sliced like it (memmap, image proxy etc)
+
+    num_frames_per_chunk : int
+        Number of frames to read and process at a time.
+
+    mask : ndarray
+        3D boolean mask identifying the voxels to include in DVARS.
+        Default: all voxels.
+
+    standardize_dvars : bool
+        Whether to divide DVARS by its expected value under temporal
+        independence, following Nichols (2013): the square root of the mean
+        over voxels of the variance of their differences over frames.
+
+    extrema : bool
+        Whether to also return the voxel-wise min and max over frames
+        (e.g. to rescale the carpet, without another pass over the frames).
+
+    Returns
+    -------
+    mean_img, stdev_img : ndarray
+        3D volumes of the mean and std. dev over frames.
+
+    mean_signal, stdev_signal : ndarray
+        mean and std. dev over space (ignoring NaNs), for each frame.
+
+    dvars : ndarray
+        root mean square of the difference from the previous frame
+        (0 for the first frame).
+
+    min_img, max_img : ndarray
+        3D volumes of the min and max over frames (ignoring NaNs),
+        only when extrema=True.
+
+    """
+
+    num_frames = img4d.shape[3]
+    mean_img = np.zeros(img4d.shape[:3], dtype='float64')
+    sum_sq_dev = np.zeros(img4d.shape[:3], dtype='float64')
+    mean_signal = np.empty(num_frames)
+    stdev_signal = np.empty(num_frames)
+    dvars = np.empty(num_frames)
+    dvars[0] = 0.0
+
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+    # voxel-wise stats of the differences between frames, to standardize DVARS
+    diff_shape = img4d.shape[:3] if mask is None else (np.count_nonzero(mask), )
+    mean_diff = np.zeros(diff_shape, dtype='float64')
+    sum_sq_dev_diff = np.zeros(diff_shape, dtype='float64')
+    num_diffs = 0
+    if extrema:
+        min_img = np.full(img4d.shape[:3], np.inf, dtype='float32')
+        max_img = np.full(img4d.shape[:3], -np.inf, dtype='float32')
+
+    previous = None
+    for start, end, chunk in _chunks_of_frames(img4d, num_frames_per_chunk):
+        mean_signal[start:end], stdev_signal[start:end] = _spatial_stats_of_chunk(chunk)
+        dvars[start:end], diff = _dvars_of_chunk(chunk, previous, first=dvars[start],
+                                                 mask=mask)
+        previous = chunk[:, :, :, -1].copy()
+        if standardize_dvars and diff.shape[-1] > 0:
+            num_diffs = _merge_chunk_stats(mean_diff, sum_sq_dev_diff, num_diffs, diff)
+        del diff
+        if extrema:
+            np.fmin(min_img, np.fmin.reduce(chunk, axis=3), out=min_img, casting='unsafe')
+            np.fmax(max_img, np.fmax.reduce(chunk, axis=3), out=max_img, casting='unsafe')
+
+        # combining the stats of this chunk with those of the chunks before
+        _merge_chunk_stats(mean_img, sum_sq_dev, start, chunk)
+        del chunk
+
+    stdev_img = np.sqrt(sum_sq_dev / num_frames)
+
+    if standardize_dvars and num_diffs > 0:
+        expected = np.sqrt(np.mean(sum_sq_dev_diff / num_diffs))
+        if expected > 0:
+            dvars /= expected
+
+    if extrema:
+        return mean_img, stdev_img, mean_signal, stdev_signal, dvars, min_img, max_img
+
+    return mean_img, stdev_img, mean_signal, stdev_signal, dvars
+
+
+def _merge_chunk_stats(mean, sum_sq_dev, num_before, chunk):
+    """
+    Merges the mean and sum of squared deviations of the chunk (over its last
+    axis) into those of the num_before elements before it, in place.
+
+    Returns the number of elements merged so far.
+    """
+
+    num_in_chunk = chunk.shape[-1]
+    num_total = num_before + num_in_chunk
+    delta = chunk.mean(axis=-1, dtype='float64') - mean
+    mean += delta * (num_in_chunk / num_total)
+    sum_sq_dev += num_in_chunk * chunk.var(axis=-1, dtype='float64') + \
+                  np.square(delta) * (num_before * num_in_chunk / num_total)
+
+    return num_total
+
+
+def _chunks_of_frames(img4d, num_frames_per_chunk):
+    """
+    Yields consecutive chunks of frames, with their start and end.
+
+    Chunks are views into the image where possible (not copies), and integer
+    images are converted to float32 (to take differences). Stats are
+    computed and accumulated in float64.
+    """
+
+    num_frames = img4d.shape[3]
+    for start in range(0, num_frames, num_frames_per_chunk):
+        end = min(start + num_frames_per_chunk, num_frames)
+        chunk = np.asarray(img4d[:, :, :, start:end])
+        if not np.issubdtype(chunk.dtype, np.floating):
+            chunk = chunk.astype('float32')
+        yield start, end, chunk
+
+
+def _spatial_stats_of_chunk(chunk):
+    """Mean and std. dev over space (ignoring NaNs) of each frame in the chunk."""
+
+    mean_signal = chunk.mean(axis=(0, 1, 2), dtype='float64')
+    stdev_signal = chunk.std(axis=(0, 1, 2), dtype='float64')
+    # frames with NaNs (rare) are computed again, ignoring them
+    with_nans = np.flatnonzero(np.isnan(mean_signal))
+    if len(with_nans) > 0:
+        mean_signal[with_nans] = np.nanmean(chunk[:, :, :, with_nans],
+                                            axis=(0, 1, 2), dtype='float64')
+        stdev_signal[with_nans] = np.nanstd(chunk[:, :, :, with_nans],
+                                            axis=(0, 1, 2), dtype='float64')
+
+    return mean_signal, stdev_signal
+
+
+def _dvars_of_chunk(chunk, previous, first=0.0, mask=None):
+    """
+    DVARS for the frames in the chunk, given the last frame before it
+    (None for the first chunk, whose first value is set to first),
+    over the voxels in the mask, if given.
+
+    Also returns the differences it is computed from (for all the frames with
+    a frame before them), within the mask (voxels x frames) if given.
+    """
+
+    if mask is not None:
+        chunk = chunk[mask, :]
+        if previous is not None:
+            previous = previous[mask]
+
+    if previous is not None:
+        diff = np.empty_like(chunk)
+        np.subtract(chunk[..., 0], previous, out=diff[..., 0])
+        np.subtract(chunk[..., 1:], chunk[..., :-1], out=diff[..., 1:])
+    else:
+        diff = np.diff(chunk, axis=-1)
+
+    # sum of squares over voxels, without a squared copy of the differences
+    subscripts = 'ijkt,ijkt->t' if diff.ndim == 4 else 'vt,vt->t'
+    mean_sq_diff = np.einsum(subscripts, diff, diff, dtype='float64') / \
+                   np.prod(diff.shape[:-1])
+
+    dvars = np.empty(chunk.shape[-1])
+    dvars[chunk.shape[-1] - diff.shape[-1]:] = np.sqrt(mean_sq_diff)
+    if previous is None:
+        dvars[0] = first
+
+    return dvars, diff
+
+
+class SelectedFrames(object):
+    """
+    Selected frames of a 4D image (memmap, image proxy etc), sliced like a 4D
+    array along them, reading only the frames selected.
+    """
+
+
+    def __init__(self, img4d, frame_indices):
+        """Constructor"""
+
+        self.img4d = img4d
+        self.frame_indices = np.asarray(frame_indices, dtype='int64')
+        self.shape = tuple(img4d.shape[:3]) + (len(self.frame_indices), )
+        self.ndim = 4
+        self.dtype = img4d.dtype
+
+
+    def __getitem__(self, index):
+        """Reads the data for the given index (ints and slices only)."""
+
+        if not isinstance(index, tuple):
+            index = (index, )
+        index = index + (slice(None), ) * (self.ndim - len(index))
+        spatial, selected = index[:3], self.frame_indices[index[3]]
+        if selected.ndim == 0:
+            return self.img4d[spatial + (int(selected), )]
+
+        # reading each run of consecutive frames at once
+        runs = np.split(selected, np.flatnonzero(np.diff(selected) != 1) + 1)
+        return np.concatenate([np.asarray(self.img4d[spatial + (slice(run[0], run[-1] + 1), )])
+                               for run in runs if len(run) > 0], axis=-1)
@@ -15,7 +15,6 @@ from functools import partial
 from scipy.ndimage import sobel, binary_closing
 from scipy.ndimage.morphology import binary_fill_holes
 from scipy.ndimage.filters import median_filter, minimum_filter, maximum_filter
-from scipy.signal import medfilt2d
 
 import matplotlib
 matplotlib.interactive(True)
@@ -128,6 +127,7 @@ def overlay_edges(slice_one, slice_two, sharper=True):
         raise ValueError("slices' dimensions do not match: "
                          " {} and {} ".format(slice_one.shape, slice_two.shape))
 
+    from scipy.signal import medfilt2d
     # simple filtering to remove noise, while supposedly keeping edges
     slice_two = medfilt2d(slice_two, kernel_size=cfg.median_filter_size)
     # extracting edges
@@ -161,6 +161,7 @@ def dwi_overlay_edges(slice_one, slice_two):
         raise ValueError("slices' dimensions do not match: "
                          " {} and {} ".format(slice_one.shape, slice_two.shape))
 
+    from scipy.signal import medfilt2d
     # simple filtering to remove noise, while supposedly keeping edges
     slice_two = medfilt2d(slice_two, kernel_size=cfg.median_filter_size)
     # extracting edges
@@ -10,8 +10,6 @@ from os import makedirs
 
 import numpy as np
 from os.path import join as pjoin
-from scipy import stats
-from sklearn.ensemble import IsolationForest
 
 import visualqc.config as cfg
 from visualqc.readers import gather_freesurfer_data
@@ -96,8 +94,16 @@ def detect_outliers(features,
 def run_isolation_forest(features, id_list, fraction_of_outliers=.3):
     """Performs anomaly detection based on Isolation Forest."""
 
+    from scipy import stats
+    from sklearn.ensemble import IsolationForest
+
     rng = np.random.RandomState(1984)
 
+    # samples whose features could not be read are left out
+    usable = np.all(np.isfinite(features), axis=1)
+    features = features[usable, :]
+    id_list = np.asarray(id_list)[usable]
+
     num_samples = features.shape[0]
     iso_f = IsolationForest(max_samples=num_samples,
                             contamination=fraction_of_outliers,
@@ -0,0 +1,139 @@
+"""
+
+Module to load the upcoming units in the background, while the current one is
+being reviewed.
+
+"""
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from visualqc import config as cfg
+
+
+class UnitPrefetcher(object):
+    """
+    Reads and preprocesses the next few units in worker threads.
+
+    Reading is delegated to the callable returned by ``reader_for_unit(unit_id)``,
+    which must not touch any UI elements or workflow state, as it runs outside
+    the main thread. Most of the time is spent in decompression (zlib) and numpy,
+    both of which release the GIL, so threads are sufficient here.
+
+    """
+
+
+    def __init__(self,
+                 reader_for_unit,
+                 depth=cfg.default_prefetch_depth,
+                 max_memory=cfg.default_prefetch_max_memory):
+        """
+        Constructor.
+
+        Parameters
+        ----------
+        reader_for_unit : callable
+            Returns a callable (without any args) to read the data for a given unit.
+
+        depth : int
+            Number of upcoming units to load in advance.
+
+        max_memory : int
+            Max. number of bytes to hold in memory in prefetched units.
+            Units still loading are assumed to be as large as the last unit
+            loaded, and no new units are scheduled beyond this budget.
+
+        """
+
+        self.reader_for_unit = reader_for_unit
+        self.depth = max(0, int(depth))
+        self.max_memory = max_memory
+
+        self._pending = OrderedDict()
+        # size of the last unit loaded, as an estimate for those still loading
+        self._unit_bytes = None
+        self._executor = None
+        if self.depth > 0:
+            self._executor = ThreadPoolExecutor(max_workers=self.depth)
+
+
+    def schedule(self, upcoming_units):
+        """Starts loading the first few of the upcoming units, if not already."""
+
+        if self._executor is None:
+            return
+
+        for unit_id in upcoming_units[:self.depth]:
+            if unit_id in self._pending:
+                continue
+            in_use = self.memory_in_use()
+            if self._unit_bytes is None:
+                # size unknown: one unit at a time, until one is loaded
+                if len(self._pending) > 0:
+                    break
+            elif in_use + self._unit_bytes > self.max_memory:
+                break
+            self._pending[unit_id] = self._executor.submit(
+                self.reader_for_unit(unit_id))
+
+
+    def get(self, unit_id):
+        """
+        Returns the data for the given unit, waiting for it to be loaded if
+        it was scheduled already, or reading it right away otherwise.
+
+        Any exception raised by the reader is re-raised here.
+        """
+
+        future = self._pending.pop(unit_id, None)
+        if future is None:
+            unit_data = self.reader_for_unit(unit_id)()
+        else:
+            unit_data = future.result()
+        self._unit_bytes = _num_bytes(unit_data)
+
+        return unit_data
+
+
+    def memory_in_use(self):
+        """
+        Number of bytes held by the units already loaded, plus the estimated
+        size of those still loading.
+        """
+
+        num_bytes, num_loading = 0, 0
+        for future in self._pending.values():
+            if not future.done():
+                num_loading += 1
+            elif future.exception() is None:
+                self._unit_bytes = _num_bytes(future.result())
+                num_bytes += self._unit_bytes
+
+        return num_bytes + num_loading * (self._unit_bytes or 0)
+
+
+    def shutdown(self):
+        """Cancels any loading not yet started and releases the workers."""
+
+        for future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+def _num_bytes(unit_data):
+    """Total size of the arrays in the data read for a unit."""
+
+    if isinstance(unit_data, np.ndarray):
+        return unit_data.nbytes
+    elif isinstance(unit_data, dict):
+        return sum(_num_bytes(value) for value in unit_data.values())
+    elif isinstance(unit_data, (list, tuple)):
+        return sum(_num_bytes(value) for value in unit_data)
+    else:
+        return 0
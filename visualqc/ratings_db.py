@@ -0,0 +1,159 @@
+"""
+
+Module to store ratings and notes in a SQLite database, as an alternative to CSV.
+
+"""
+
+import getpass
+import re
+import sqlite3
+from os.path import join as pjoin
+
+from visualqc import config as cfg
+
+_schema = """
+CREATE TABLE IF NOT EXISTS ratings (
+    unit_id   TEXT NOT NULL,
+    reviewer  TEXT NOT NULL,
+    rating    TEXT NOT NULL,
+    notes     TEXT,
+    timestamp TEXT NOT NULL,
+    PRIMARY KEY (unit_id, reviewer)
+);
+CREATE INDEX IF NOT EXISTS ratings_by_rating ON ratings (rating, reviewer);
+
+CREATE TABLE IF NOT EXISTS rating_labels (
+    unit_id  TEXT NOT NULL,
+    reviewer TEXT NOT NULL,
+    label    TEXT NOT NULL,
+    PRIMARY KEY (unit_id, reviewer, label)
+);
+CREATE INDEX IF NOT EXISTS labels_by_label ON rating_labels (label, reviewer);
+"""
+
+
+class RatingsDatabase(object):
+    """
+    Ratings and notes for each unit, along with the reviewer and time of rating.
+
+    Each rating is committed right away, so nothing is lost in a crash.
+    Write-ahead logging allows multiple reviewers (processes) to share
+    the same database, each recording and resuming their own ratings.
+
+    """
+
+
+    def __init__(self, db_path, reviewer=None):
+        """
+        Constructor.
+
+        Parameters
+        ----------
+        db_path : str
+            path to the SQLite database, created if it does not exist.
+
+        reviewer : str
+            Name of the reviewer. Default: the current login name.
+
+        """
+
+        self.db_path = db_path
+        self.reviewer = reviewer if reviewer is not None else getpass.getuser()
+
+        self.connection = sqlite3.connect(self.db_path,
+                                          timeout=cfg.ratings_db_timeout)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.connection:
+            self.connection.executescript(_schema)
+
+
+    def save(self, unit_id, rating_labels, notes):
+        """Records (or replaces) the rating for a given unit."""
+
+        if isinstance(rating_labels, str):
+            rating_labels = rating_labels.split(cfg.rating_joiner)
+        rating = cfg.rating_joiner.join(rating_labels)
+
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO ratings '
+                '(unit_id, reviewer, rating, notes, timestamp) '
+                'VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)',
+                (unit_id, self.reviewer, rating, notes))
+            self.connection.execute(
+                'DELETE FROM rating_labels WHERE unit_id = ? AND reviewer = ?',
+                (unit_id, self.reviewer))
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO rating_labels (unit_id, reviewer, label) '
+                'VALUES (?, ?, ?)',
+                [(unit_id, self.reviewer, label) for label in rating_labels])
+
+
+    def load(self):
+        """Returns the ratings and notes of the current reviewer, as dicts."""
+
+        ratings = dict()
+        notes = dict()
+        cursor = self.connection.execute(
+            'SELECT unit_id, rating, notes FROM ratings WHERE reviewer = ?',
+            (self.reviewer,))
+        for unit_id, rating, note in cursor:
+            ratings[unit_id] = rating
+            notes[unit_id] = note
+
+        return ratings, notes
+
+
+    def summarize(self, out_dir=None):
+        """
+        Summarizes the counts and IDs for different unique rating labels,
+        and exports the list of IDs for each label to out_dir, if specified.
+
+        Returns a count per rating label as well as list of IDs per each label,
+        similar to :func:`visualqc.utils.summarize_ratings`.
+        """
+
+        clean = lambda lbl: re.sub(r'\W+', '_', lbl.lower())
+
+        counter = dict()
+        id_lists = dict()
+        cursor = self.connection.execute(
+            'SELECT label, unit_id FROM rating_labels WHERE reviewer = ? '
+            'ORDER BY label', (self.reviewer,))
+        for label, unit_id in cursor:
+            label = clean(label)
+            id_lists.setdefault(label, list()).append(unit_id)
+        for label, id_list in id_lists.items():
+            counter[label] = len(id_list)
+
+        if len(counter) < 1:
+            print('No ratings to summarize! Returning empty dictionaries.')
+            return counter, id_lists
+
+        max_width = 1 + max([len(label) for label in counter])
+        print('Ratings summary\n  Counts (note some IDs can have multiple ratings):')
+        for label, count in counter.items():
+            print('\t{lbl:>{mw}} : {cnt:>7}'.format(lbl=label, cnt=count, mw=max_width))
+
+        if out_dir is not None:
+            for label, id_list in id_lists.items():
+                out_path = pjoin(out_dir, 'id_list_rating_{}.txt'.format(label))
+                with open(out_path, 'w') as of:
+                    of.write('\n'.join(id_list))
+
+        return counter, id_lists
+
+
+    def export_csv(self, csv_path):
+        """Exports the ratings of the current reviewer in the CSV format."""
+
+        ratings, notes = self.load()
+        with open(csv_path, 'w') as cf:
+            cf.write('\n'.join(['{},{},{}'.format(unit_id, rating, notes[unit_id])
+                                for unit_id, rating in ratings.items()]))
+
+
+    def close(self):
+        """Closes the connection."""
+
+        self.connection.close()
@@ -3,12 +3,101 @@
 Data reader module.
 
 """
+import hashlib
+import os
+
 import numpy as np
-from os.path import exists as pexists, join as pjoin, realpath, splitext, basename
-from itertools import product
-from collections import Sequence
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from os.path import exists as pexists, join as pjoin, realpath, relpath, splitext, basename
+from itertools import zip_longest
+from collections.abc import Sequence
 from visualqc import config as cfg
 
+_measure_prefix = '# Measure '
+_col_headers_prefix = '# ColHeaders'
+_integer_columns = ('Index', 'SegId', 'NVoxels', 'NumVert')
+_measure_dtype = np.dtype([('structure', 'U100'), ('name', 'U100'),
+                           ('description', 'U200'), ('value', 'f8'), ('units', 'U10')])
+
+
+def read_freesurfer_stats(stats_file):
+    """
+    Reads a stats file produced by Freesurfer (such as aseg.stats or ?h.aparc.stats)
+    in a single pass, returning the table of stats for all ROIs, as well as
+    all the global measures (from the lines starting with ``# Measure``).
+
+    Parameters
+    ----------
+    stats_file : str
+        Path to the stats file
+
+    Returns
+    -------
+    roi_stats : ndarray
+        Structured array with a field for each column of the table, named after
+        the column headers (StructName, Volume_mm3, ThickAvg etc). Names of ROIs
+        are strings, indices and counts are integers, and the rest are floats,
+        with NaN for any missing values (integer columns with missing values
+        are returned as floats).
+
+    measures : ndarray
+        Structured array with fields ``structure``, ``name``, ``description``,
+        ``value`` and ``units``, in the order they appear in the file.
+
+    """
+
+    if not pexists(stats_file):
+        raise IOError('given path does not exist : {}'.format(stats_file))
+
+    col_names = None
+    rows = list()
+    measures = list()
+    with open(stats_file) as sf:
+        for line in sf:
+            if line.startswith('#'):
+                # e.g. # Measure Cortex, MeanThickness, Mean Thickness, 2.59632, mm
+                if line.startswith(_measure_prefix):
+                    parts = [part.strip() for part in
+                             line[len(_measure_prefix):].split(',')]
+                    measures.append((parts[0], parts[1], ','.join(parts[2:-2]),
+                                     float(parts[-2]), parts[-1]))
+                elif line.startswith(_col_headers_prefix):
+                    col_names = line[len(_col_headers_prefix):].split()
+            elif line.strip():
+                rows.append(line.split())
+
+    if col_names is None:
+        num_cols = max([len(row) for row in rows], default=0)
+        col_names = ['f{}'.format(ix) for ix in range(num_cols)]
+
+    # rows shorter than the header are filled with NaN
+    columns = zip_longest(*rows, fillvalue='nan') if rows else [()] * len(col_names)
+    col_arrays = list()
+    for name, values in zip(col_names, columns):
+        if name == 'StructName':
+            col_arrays.append(np.array(values, dtype=str))
+            continue
+
+        try:
+            values = np.array(values, dtype='float64')
+        except ValueError:
+            raise ValueError('Non-numeric values in column {} of {}'
+                             ''.format(name, stats_file))
+        # integer columns stay float only when they have missing values
+        if name in _integer_columns and np.all(np.isfinite(values)):
+            values = values.astype('int64')
+        col_arrays.append(values)
+
+    roi_stats = np.empty(len(rows), dtype=[(name, col.dtype) for name, col
+                                           in zip(col_names, col_arrays)])
+    for name, col in zip(col_names, col_arrays):
+        roi_stats[name] = col
+
+    measures = np.array(measures, dtype=_measure_dtype)
+
+    return roi_stats, measures
+
 
 def read_aseg_stats(fs_dir, subject_id, include_global_areas=False):
     """
@@ -26,17 +115,12 @@ def read_aseg_stats(fs_dir, subject_id, include_global_areas=False):
     """
 
     seg_stats_file = realpath(pjoin(fs_dir, subject_id, 'stats', 'aseg.stats'))
-    if not pexists(seg_stats_file):
-        raise IOError('given path does not exist : {}'.format(seg_stats_file))
+    roi_stats, measures = read_freesurfer_stats(seg_stats_file)
 
-    stats = np.loadtxt(seg_stats_file, dtype="i1,i1,i4,f4,S50,f4,f4,f4,f4,f4")
     # returning volumes only:
-    subcortical_data = np.array([seg[3] for seg in stats])
-    out_data = subcortical_data.flatten()
-
+    out_data = roi_stats['Volume_mm3']
     if include_global_areas:
-        wb_data = read_volumes_global_areas(seg_stats_file)
-        out_data = np.hstack((out_data, wb_data))
+        out_data = np.hstack((out_data, measures['value']))
 
     return out_data
 
@@ -50,25 +134,9 @@ def read_volumes_global_areas(seg_stats_file):
     in the original aseg.stats file (not as mentioned above).
     """
 
-    # Snippet from the relevant part of the aseg.stats
-    # Measure lhCortex, lhCortexVol, Left hemisphere cortical gray matter volume, 234615.987869, mm^3
-    # Measure rhCortex, rhCortexVol, Right hemisphere cortical gray matter volume, 260948.684264, mm^3
-    # Measure Cortex, CortexVol, Total cortical gray matter volume, 495564.672133, mm^3
-    # Measure lhCorticalWhiteMatter, lhCorticalWhiteMatterVol, Left hemisphere cortical white matter volume, 222201.531250, mm^3
-    # Measure rhCorticalWhiteMatter, rhCorticalWhiteMatterVol, Right hemisphere cortical white matter volume, 232088.671875, mm^3
-    # Measure CorticalWhiteMatter, CorticalWhiteMatterVol, Total cortical white matter volume, 454290.203125, mm^3
-    # Measure SubCortGray, SubCortGrayVol, Subcortical gray matter volume, 188561.000000, mm^3
-    # Measure TotalGray, TotalGrayVol, Total gray matter volume, 684125.672133, mm^3
-    # Measure SupraTentorial, SupraTentorialVol, Supratentorial volume, 1046623.140109, mm^3
-    # Measure IntraCranialVol, ICV, Intracranial Volume, 1137205.249190, mm^3
-
-    wb_regex_pattern = r'# Measure ([\w/+_\- ]+), ([\w/+_\- ]+), ([\w/+_\- ]+), ' \
-                       r'([\d\.]+), ([\w/+_\-^]+)'
-    datatypes = np.dtype('U100,U100,U100,f8,U10')
-    stats = np.fromregex(seg_stats_file, wb_regex_pattern, dtype=datatypes)
-    wb_data = np.array([seg[3] for seg in stats])
+    _, measures = read_freesurfer_stats(seg_stats_file)
 
-    return wb_data.flatten()
+    return measures['value']
 
 
 def read_aparc_stats_wholebrain(fs_dir, subject_id, subset=None):
@@ -93,23 +161,6 @@ def read_aparc_stats_in_hemi(stats_file,
     file_path would contain whether it is from the right or left hemisphere.
     """
 
-    stats_file = realpath(stats_file)
-    if not pexists(stats_file):
-        raise IOError('given path does not exist : {}'.format(stats_file))
-
-    # ColHeaders
-    # StructName NumVert SurfArea GrayVol ThickAvg ThickStd MeanCurv GausCurv FoldInd CurvInd
-    aparc_roi_dtype = [('StructName', 'S50'),
-                       ('NumVert', '<i4'),
-                       ('SurfArea', '<i4'),
-                       ('GrayVol', '<i4'),
-                       ('ThickAvg', '<f4'),
-                       ('ThickStd', '<f4'),
-                       ('MeanCurv', '<f4'),
-                       ('GausCurv', '<f4'),
-                       ('FoldInd', '<f4'),
-                       ('CurvInd', '<f4')]
-
     subset_all = ['SurfArea', 'GrayVol',
                   'ThickAvg', 'ThickStd',
                   'MeanCurv', 'GausCurv',
@@ -122,15 +173,11 @@ def read_aparc_stats_in_hemi(stats_file,
             raise ValueError('Atleast 1 valid stat must be chosen! '
                              'From: \n{}'.format(subset_all))
 
-    roi_stats = np.genfromtxt(stats_file, dtype=aparc_roi_dtype, filling_values=np.NaN)
-    roi_stats_values = np.full((len(roi_stats), len(subset_return)), np.NaN)
-    for idx, stat in enumerate(roi_stats):
-        roi_stats_values[idx, :] = [stat[feat] for feat in subset_return]
-
-    stats = roi_stats_values.flatten()
+    roi_stats, measures = read_freesurfer_stats(stats_file)
+    # ROI-wise: all stats for first ROI, followed by those for the next etc
+    stats = np.column_stack([roi_stats[feat] for feat in subset_return]).flatten()
     if include_whole_brain_stats:
-        wb_stats = read_global_mean_surf_area_thickness(stats_file)
-        stats = np.hstack((stats, wb_stats))
+        stats = np.hstack((stats, _mean_surf_area_thickness(measures)))
 
     return stats
 
@@ -138,29 +185,31 @@ def read_aparc_stats_in_hemi(stats_file,
 def read_global_mean_surf_area_thickness(stats_file):
     """Returns total surface area of white surface, global mean cortical thickness"""
 
-    # Snippet from the relevant part of aparc.stats
-    # Measure Cortex, NumVert, Number of Vertices, 120233, unitless
-    # Measure Cortex, WhiteSurfArea, White Surface Total Area, 85633.5, mm^2
-    # Measure Cortex, MeanThickness, Mean Thickness, 2.59632, mm
-    wb_regex_pattern = r'# Measure Cortex, ([\w/+_\- ]+), ([\w/+_\- ]+), ([\d\.]+),' \
-                       r' ([\w/+_\-^]+)'
-    wb_aparc_dtype = np.dtype('U100,U100,f8,U10')
-    # wb_aparc_dtype = [('f0', '<U100'), ('f1', '<U100'), ('f2', '<f8'), ('f3', '<U10')]
-    wb_stats = np.fromregex(stats_file, wb_regex_pattern, dtype=wb_aparc_dtype)
+    _, measures = read_freesurfer_stats(stats_file)
 
-    # concatenating while surf total area and global mean thickness
-    stats = [wb_stats[1][2], wb_stats[2][2]]
+    return _mean_surf_area_thickness(measures)
 
-    return stats
+
+def _mean_surf_area_thickness(measures):
+    """Picks the total area of white surface, and global mean cortical thickness."""
+
+    value_by_name = dict(zip(measures['name'], measures['value']))
+
+    return [value_by_name['WhiteSurfArea'], value_by_name['MeanThickness']]
 
 
 def gather_freesurfer_data(qcw,
-                           feature_type='whole_brain'):
+                           feature_type='whole_brain',
+                           num_workers=cfg.default_num_workers_gather_features):
     """
     Reads all the relevant features to perform outlier detection on.
 
     feature_type could be cortical, subcortical, or whole_brain.
 
+    Subjects are read in parallel, with at most num_workers at a time.
+    Subjects whose features could not be read are reported, and their rows
+    are filled with NaN, instead of aborting the whole process.
+
     """
 
     if qcw.source_of_features not in cfg.avail_OLD_source_of_features:
@@ -169,30 +218,64 @@ def gather_freesurfer_data(qcw,
             qcw.source_of_features))
 
     feature_type = feature_type.lower()
-    if feature_type in ['cortical', ]:
-        features = np.vstack(
-            [read_aparc_stats_wholebrain(qcw.in_dir, id) for id in qcw.id_list])
-    elif feature_type in ['subcortical', ]:
-        features = np.vstack([read_aseg_stats(qcw.fs_dir, id) for id in qcw.id_list])
-    elif feature_type in ['whole_brain', 'wholebrain']:
-        cortical = np.vstack(
-            [read_aparc_stats_wholebrain(qcw.in_dir, id) for id in qcw.id_list])
-        sub_ctx = np.vstack([read_aseg_stats(qcw.fs_dir, id) for id in qcw.id_list])
-        features = np.hstack((cortical, sub_ctx))
-    else:
+    if feature_type not in ('cortical', 'subcortical', 'whole_brain', 'wholebrain'):
         raise ValueError('Invalid type of features requested.')
 
+    reader = partial(read_freesurfer_features, qcw.in_dir, feature_type=feature_type)
+    features_by_id = dict()
+    failed = dict()
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        future_to_id = {executor.submit(reader, sid): sid for sid in qcw.id_list}
+        for future in as_completed(future_to_id):
+            sid = future_to_id[future]
+            try:
+                features_by_id[sid] = future.result()
+            except Exception as exc:
+                failed[sid] = exc
+
+    if len(failed) > 0:
+        print('Unable to read {} features for {} subjects:'
+              ''.format(feature_type, len(failed)))
+        for sid, exc in failed.items():
+            print('\t{} : {}'.format(sid, exc))
+
+    if len(features_by_id) < 1:
+        raise IOError('{} features could not be read for any subject!'
+                      ''.format(feature_type))
+
+    num_features = len(next(iter(features_by_id.values())))
+    features = np.full((len(qcw.id_list), num_features), np.nan)
+    for row, sid in enumerate(qcw.id_list):
+        if sid in features_by_id:
+            features[row, :] = features_by_id[sid]
+
     return features
 
 
+def read_freesurfer_features(fs_dir, subject_id, feature_type='whole_brain'):
+    """Reads the features of a given type for one subject, reading each file once."""
+
+    if feature_type in ('cortical', ):
+        return read_aparc_stats_wholebrain(fs_dir, subject_id)
+    elif feature_type in ('subcortical', ):
+        return read_aseg_stats(fs_dir, subject_id)
+    else:
+        return np.hstack((read_aparc_stats_wholebrain(fs_dir, subject_id),
+                          read_aseg_stats(fs_dir, subject_id)))
+
+
 def gather_data(path_list, id_list):
     """
-    Takes in a list of CSVs, and return a table of features.
+    Takes in a feature store (or a dict of CSVs), and returns a table of features.
 
     id_list is to ensure the row order in the matrix.
 
     """
 
+    from visualqc.feature_store import CohortFeatureStore
+    if isinstance(path_list, CohortFeatureStore):
+        return path_list.rows(id_list)
+
     features = np.vstack([np.genfromtxt(path_list[sid]) for sid in id_list])
 
     return features
@@ -211,8 +294,8 @@ def anatomical_traverse_bids(bids_layout,
 
     meta_types = {'datatype'  : modalities,
                   'extension' : extension,
-                  'subjects'  : subjects,
-                  'sessions'  : sessions}
+                  'subject'   : subjects,
+                  'session'   : sessions}
 
     meta_types.update(kwargs)
     non_empty_types = {type_: values for type_, values in meta_types.items() if values}
@@ -220,50 +303,30 @@ def anatomical_traverse_bids(bids_layout,
     __FIELDS_TO_IGNORE__ = ('filename', 'modality', 'type')
     __TYPES__ = ['subjects', 'sessions',]
 
-    results = bids_layout.get(**non_empty_types)
-    if len(results) < 1:
+    files_by_unit = _group_bids_files_by_unit(bids_layout.get(**non_empty_types),
+                                              bids_layout.get_sessions())
+    if len(files_by_unit) < 1:
         print('No results found!')
         return None, None
 
-    all_subjects = bids_layout.get_subjects()
-    all_sessions = bids_layout.get_sessions()
-    if len(all_sessions) > 1:
-        sessions_exist = True
-        combinations = product(all_subjects, all_sessions)
-    else:
-        sessions_exist = False
-        combinations = all_subjects
-
-
     reqd_exts_params = ('.json', )
     named_exts_params = ('params', )
     reqd_exts_images = ('.nii', '.gz')
     named_exts_images = ('image', 'image')
 
     files_by_id = dict()
-    for sub in combinations:
-        if sessions_exist:
-            # sub is a tuple of subject,session
-            results = bids_layout.get(subject=sub[0], session=sub[1],
-                                      datatype='anat')
-            final_sub_id = '_'.join(sub)
-        else:
-            results = bids_layout.get(subject=sub,  datatype='anat')
-            final_sub_id = sub
-
-        temp = {splitext(file.filename)[-1] : realpath(file.path)
-                for file in results}
+    for final_sub_id, temp in files_by_unit.items():
 
         param_files_exist = all([file_ext in temp for file_ext in reqd_exts_params])
         image_files_exist = any([file_ext in temp for file_ext in reqd_exts_images])
         if param_files_required and (not param_files_exist):
             print('parameter files are required, but do not exist for {}'
-                  ' - skipping it.'.format(sub))
+                  ' - skipping it.'.format(final_sub_id))
             continue
 
         if not image_files_exist:
             print('Image file is required, but does not exist for {}'
-                  ' - skipping it.'.format(sub))
+                  ' - skipping it.'.format(final_sub_id))
             continue
 
         files_by_id[final_sub_id] = dict()
@@ -283,11 +346,104 @@ def anatomical_traverse_bids(bids_layout,
     return files_by_id
 
 
-def find_anatomical_images_in_BIDS(bids_dir):
-    """Traverses the BIDS structure to find all the relevant anatomical images."""
+def _group_bids_files_by_unit(bids_files, all_sessions):
+    """
+    Groups the paths of the given files (keyed by extension) by subject,
+    or by subject and session if the dataset has more than one session,
+    even when the files given are all from the same session.
+    """
+
+    sessions_exist = len(all_sessions) > 1
+
+    files_by_unit = dict()
+    for file in bids_files:
+        subject = file.entities.get('subject', None)
+        if subject is None:
+            continue
+        if sessions_exist:
+            session = file.entities.get('session', None)
+            if session is None:
+                continue
+            unit = (subject, session)
+        else:
+            unit = (subject, )
+        files_by_unit.setdefault(unit, dict())[splitext(file.filename)[-1]] = \
+            realpath(file.path)
+
+    return {'_'.join(unit): files_by_unit[unit] for unit in sorted(files_by_unit)}
+
+
+def load_bids_layout(bids_dir, out_dir=None):
+    """
+    Returns the BIDS layout for a dataset, reusing the index saved in out_dir
+    (if specified) from a previous session, when the dataset has not changed.
+    """
 
     from bids import BIDSLayout
-    bids_layout = BIDSLayout(bids_dir)
+    if out_dir is None:
+        return BIDSLayout(bids_dir)
+
+    db_path = pjoin(out_dir, cfg.bids_layout_db_name)
+    fingerprint_path = pjoin(db_path, cfg.file_name_bids_layout_fingerprint)
+    fingerprint = _bids_dir_fingerprint(bids_dir, out_dir)
+    saved = None
+    if pexists(fingerprint_path):
+        with open(fingerprint_path) as fpf:
+            saved = fpf.read().strip()
+
+    reuse = saved == fingerprint
+    if reuse:
+        print('Reusing the index of the BIDS dataset from\n\t{}'.format(db_path))
+    bids_layout = BIDSLayout(bids_dir, database_path=db_path,
+                             reset_database=not reuse)
+    if not reuse:
+        with open(fingerprint_path, 'w') as fpf:
+            fpf.write(fingerprint)
+
+    return bids_layout
+
+
+def _bids_dir_fingerprint(bids_dir, out_dir=None):
+    """
+    Identifies the state of a dataset by the names of the entries in each of
+    its folders, which change when files are added, removed or renamed, and
+    the modification time of its metadata (.json, .tsv) files, without having
+    to stat every image.
+
+    Hidden entries and folders not indexed by pybids are skipped, as is out_dir
+    (which is within the dataset by default), as they change with every review.
+    """
+
+    from bids import __version__ as pybids_version
+
+    bids_dir = realpath(bids_dir)
+    skipped = set()
+    if out_dir is not None:
+        skipped.add(realpath(out_dir))
+
+    digest = hashlib.sha1(pybids_version.encode())
+    for folder, sub_dirs, files in os.walk(bids_dir):
+        sub_dirs[:] = sorted(sd for sd in sub_dirs
+                             if not sd.startswith('.') and
+                             pjoin(folder, sd) not in skipped and
+                             not (folder == bids_dir and
+                                  sd in cfg.bids_folders_not_indexed))
+        files = sorted(fn for fn in files if not fn.startswith('.'))
+        digest.update('{}:{}:{}\n'.format(relpath(folder, bids_dir),
+                                          '/'.join(sub_dirs),
+                                          '/'.join(files)).encode())
+        for fn in files:
+            if fn.endswith(('.json', '.tsv')):
+                digest.update('{}:{}\n'.format(
+                    fn, os.stat(pjoin(folder, fn)).st_mtime_ns).encode())
+
+    return digest.hexdigest()
+
+
+def find_anatomical_images_in_BIDS(bids_dir, out_dir=None):
+    """Traverses the BIDS structure to find all the relevant anatomical images."""
+
+    bids_layout = load_bids_layout(bids_dir, out_dir)
     images = anatomical_traverse_bids(bids_layout)
     # file name of each scan is the unique identifier,
     #   as it essentially contains all the key info.
@@ -302,7 +458,7 @@ def func_mri_traverse_bids(bids_layout,
                            modalities='func',
                            subjects=None,
                            sessions=None,
-                           extension=('nii', 'nii.gz', 'json'),
+                           extension=('nii', 'nii.gz', 'json', 'tsv'),
                            param_files_required=False,
                            **kwargs):
     """
@@ -310,12 +466,10 @@ def func_mri_traverse_bids(bids_layout,
 
     """
 
-    modality_identifier = 'func'
-
     meta_types = {'datatype'  : modalities,
                   'extension' : extension,
-                  'subjects'  : subjects,
-                  'sessions'  : sessions}
+                  'subject'   : subjects,
+                  'session'   : sessions}
 
     meta_types.update(kwargs)
     non_empty_types = {type_: values for type_, values in meta_types.items() if values}
@@ -323,49 +477,30 @@ def func_mri_traverse_bids(bids_layout,
     __FIELDS_TO_IGNORE__ = ('filename', 'modality', 'type')
     __TYPES__ = ['subjects', 'sessions',]
 
-    results = bids_layout.get(**non_empty_types)
-    if len(results) < 1:
+    files_by_unit = _group_bids_files_by_unit(bids_layout.get(**non_empty_types),
+                                              bids_layout.get_sessions())
+    if len(files_by_unit) < 1:
         print('No results found!')
         return None, None
 
-    all_subjects = bids_layout.get_subjects()
-    all_sessions = bids_layout.get_sessions()
-    if len(all_sessions) > 1:
-        sessions_exist = True
-        combinations = product(all_subjects, all_sessions)
-    else:
-        sessions_exist = False
-        combinations = all_subjects
-
     reqd_exts_params = ('.tsv', )
     named_exts_params = ('params', )
     reqd_exts_images = ('.nii', '.gz')
     named_exts_images = ('image', 'image')
 
     files_by_id = dict()
-    for sub in combinations:
-        if sessions_exist:
-            # sub is a tuple of subject,session
-            results = bids_layout.get(subject=sub[0], session=sub[1],
-                                      datatype=modality_identifier)
-            final_sub_id = '_'.join(sub)
-        else:
-            results = bids_layout.get(subject=sub,  datatype=modality_identifier)
-            final_sub_id = sub
-
-        temp = {splitext(file.filename)[-1] : realpath(file.path)
-                for file in results}
+    for final_sub_id, temp in files_by_unit.items():
 
         param_files_exist = all([file_ext in temp for file_ext in reqd_exts_params])
         image_files_exist = any([file_ext in temp for file_ext in reqd_exts_images])
         if param_files_required and not param_files_exist:
             print('param files are required, but do not exist for {}'
-                  ' - skipping it.'.format(sub))
+                  ' - skipping it.'.format(final_sub_id))
             continue
 
         if not image_files_exist:
             print('Image file is required, but does not exist for {}'
-                  ' - skipping it.'.format(sub))
+                  ' - skipping it.'.format(final_sub_id))
             continue
 
         files_by_id[final_sub_id] = dict()
@@ -401,8 +536,8 @@ def diffusion_traverse_bids(bids_layout,
 
     meta_types = {'datatype'  : modalities,
                   'extension': extension,
-                  'subjects'  : subjects,
-                  'sessions'  : sessions}
+                  'subject'   : subjects,
+                  'session'   : sessions}
 
     meta_types.update(kwargs)
     non_empty_types = {type_: values for type_, values in meta_types.items() if values}
@@ -410,49 +545,30 @@ def diffusion_traverse_bids(bids_layout,
     __FIELDS_TO_IGNORE__ = ('filename', 'modality', 'type')
     __TYPES__ = ['subjects', 'sessions',]
 
-    results = bids_layout.get(**non_empty_types)
-    if len(results) < 1:
+    files_by_unit = _group_bids_files_by_unit(bids_layout.get(**non_empty_types),
+                                              bids_layout.get_sessions())
+    if len(files_by_unit) < 1:
         print('No results found!')
         return None, None
 
-    all_subjects = bids_layout.get_subjects()
-    all_sessions = bids_layout.get_sessions()
-    if len(all_sessions) > 1:
-        sessions_exist = True
-        combinations = product(all_subjects, all_sessions)
-    else:
-        sessions_exist = False
-        combinations = all_subjects
-
-
     reqd_exts_params = ('.bval', '.bvec', '.json')
     named_exts_params = ('bval', 'bvec', 'params')
     reqd_exts_images = ('.nii', '.gz')
     named_exts_images = ('image', 'image')
 
     files_by_id = dict()
-    for sub in combinations:
-        if sessions_exist:
-            # sub is a tuple of subject,session
-            results = bids_layout.get(subject=sub[0], session=sub[1], datatype='dwi')
-            final_sub_id = '_'.join(sub)
-        else:
-            results = bids_layout.get(subject=sub,  datatype='dwi')
-            final_sub_id = sub
-
-        temp = {splitext(file.filename)[-1] : realpath(file.path)
-                for file in results}
+    for final_sub_id, temp in files_by_unit.items():
 
         param_files_exist = all([file_ext in temp for file_ext in reqd_exts_params])
         image_files_exist = any([file_ext in temp for file_ext in reqd_exts_images])
         if param_files_required and not param_files_exist:
             print('b-value/b-vec are required, but do not exist for {}'
-                  ' - skipping it.'.format(sub))
+                  ' - skipping it.'.format(final_sub_id))
             continue
 
         if not image_files_exist:
             print('Image file is required, but does not exist for {}'
-                  ' - skipping it.'.format(sub))
+                  ' - skipping it.'.format(final_sub_id))
             continue
 
         files_by_id[final_sub_id] = dict()
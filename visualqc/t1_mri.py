@@ -9,6 +9,7 @@ import sys
 import textwrap
 import warnings
 from abc import ABC
+from functools import partial
 from os.path import join as pjoin, realpath
 
 import numpy as np
@@ -21,11 +22,11 @@ from visualqc import config as cfg
 from visualqc.image_utils import mask_image
 from visualqc.interfaces import BaseReviewInterface
 from visualqc.utils import (check_finite_int, check_id_list, check_input_dir_T1,
-                            check_out_dir, check_outlier_params, check_views,
-                            read_image, saturate_brighter_intensities, scale_0to1,
-                            check_bids_dir)
+                            check_num_bytes, check_out_dir, check_outlier_params,
+                            check_prefetch_params, check_views, read_image,
+                            saturate_brighter_intensities, scale_0to1, check_bids_dir)
 from visualqc.readers import find_anatomical_images_in_BIDS
-from visualqc.workflows import BaseWorkflowVisualQC
+from visualqc.workflows import BaseWorkflowVisualQC, add_review_session_args
 
 # each rating is a set of labels, join them with a plus delimiter
 _plus_join = lambda label_set: '+'.join(label_set)
@@ -289,12 +290,22 @@ class RatingWorkflowT1(BaseWorkflowVisualQC, ABC):
                  outlier_feat_types, disable_outlier_detection,
                  prepare_first,
                  vis_type,
-                 views, num_slices_per_view, num_rows_per_view):
+                 views, num_slices_per_view, num_rows_per_view,
+                 prefetch_depth=cfg.default_prefetch_depth,
+                 prefetch_max_memory=cfg.default_prefetch_max_memory,
+                 unit_cache_max_bytes=cfg.default_unit_cache_max_bytes,
+                 image_cache_max_bytes=cfg.default_image_cache_max_bytes,
+                 ratings_backend=cfg.default_ratings_backend):
         """Constructor"""
 
         super().__init__(id_list, in_dir, out_dir,
                          outlier_method, outlier_fraction,
-                         outlier_feat_types, disable_outlier_detection)
+                         outlier_feat_types, disable_outlier_detection,
+                         prefetch_depth=prefetch_depth,
+                         prefetch_max_memory=prefetch_max_memory,
+                         unit_cache_max_bytes=unit_cache_max_bytes,
+                         image_cache_max_bytes=image_cache_max_bytes,
+                         ratings_backend=ratings_backend)
 
         self.vis_type = vis_type
         self.issue_list = issue_list
@@ -451,19 +462,22 @@ class RatingWorkflowT1(BaseWorkflowVisualQC, ABC):
         else:
             self.current_alert_msg = None
 
+    def get_unit_reader(self, unit_id):
+        """Reader for the image data of a given unit."""
+
+        return partial(read_t1_unit, self.path_getter_inputs(unit_id), self.padding,
+                       image_cache=self.image_cache)
+
     def load_unit(self, unit_id):
         """Loads the image data for display."""
 
         # starting fresh
-        for attr in ('current_img_raw', 'current_img',
-                     'saturated_img', 'tails_trimmed_img', 'background_img'):
+        for attr in ('current_img', 'saturated_img',
+                     'tails_trimmed_img', 'background_img'):
             if hasattr(self, attr):
                 delattr(self, attr)
 
-        t1_mri_path = self.path_getter_inputs(unit_id)
-        self.current_img_raw = read_image(t1_mri_path, error_msg='T1 mri')
-        # crop and rescale
-        self.current_img = scale_0to1(crop_image(self.current_img_raw, self.padding))
+        self.current_img = self.fetch_unit(unit_id)['image']
         self.currently_showing = None
 
         skip_subject = False
@@ -562,6 +576,14 @@ class RatingWorkflowT1(BaseWorkflowVisualQC, ABC):
         plt.close('all')
 
 
+def read_t1_unit(t1_mri_path, padding=cfg.default_padding, image_cache=None):
+    """Reads the T1 mri, crops and rescales it for display."""
+
+    raw_img = read_image(t1_mri_path, error_msg='T1 mri', image_cache=image_cache)
+
+    return dict(image=scale_0to1(crop_image(raw_img, padding)))
+
+
 def get_parser():
     """Parser to specify arguments and their defaults."""
 
@@ -639,13 +661,14 @@ def get_parser():
     \n""".format(cfg.default_num_rows))
 
     help_text_prepare = textwrap.dedent("""
-    This flag enables batch-generation of 3d surface visualizations,
-    prior to starting any review and rating operations. This makes the switch
-    from one subject to the next, even more seamless (saving few seconds :) ).
+    This flag prepares the data for all the units prior to starting any review
+    and rating operations: images are read, cropped and rescaled, and stats, carpets
+    etc are computed in parallel, and saved to disk within the output folder
+    (in {}). This makes the switch from one subject to the next, even more
+    seamless, and the prepared data is reused when the review is resumed later on.
 
-    Default: False  (required visualizations are generated only on demand,
-    which can take 5-10 seconds for each subject).
-    \n""")
+    Default: False (data for each unit is prepared on demand, a few units ahead).
+    \n""".format(cfg.unit_cache_dir_name))
 
     help_text_outlier_detection_method = textwrap.dedent("""
     Method used to detect the outliers.
@@ -747,6 +770,8 @@ def get_parser():
                          dest="prepare_first",
                          help=help_text_prepare)
 
+    add_review_session_args(parser)
+
     return parser
 
 
@@ -774,14 +799,14 @@ def make_workflow_from_user_options():
     if in_dir_type.upper() in ('BIDS', ):
         mri_name = None
         in_dir, bids_dir_type = check_bids_dir(in_dir)
-        id_list, images_for_id = find_anatomical_images_in_BIDS(in_dir)
+        out_dir = check_out_dir(user_args.out_dir, in_dir)
+        id_list, images_for_id = find_anatomical_images_in_BIDS(in_dir, out_dir)
     else:
         mri_name = user_args.mri_name
         id_list, images_for_id = check_id_list(user_args.id_list, in_dir, vis_type,
                                                mri_name, seg_name=None,
                                                in_dir_type=in_dir_type)
-
-    out_dir = check_out_dir(user_args.out_dir, in_dir)
+        out_dir = check_out_dir(user_args.out_dir, in_dir)
     views = check_views(user_args.views)
 
     num_slices_per_view, num_rows_per_view = check_finite_int(user_args.num_slices,
@@ -795,6 +820,15 @@ def make_workflow_from_user_options():
         user_args.disable_outlier_detection,
         id_list, vis_type, type_of_features)
 
+    prefetch_depth, prefetch_max_memory = check_prefetch_params(
+        user_args.prefetch_depth, user_args.prefetch_max_memory)
+
+    unit_cache_max_bytes = check_num_bytes(user_args.unit_cache_max_bytes,
+                                           'unit_cache_max_bytes')
+
+    image_cache_max_bytes = check_num_bytes(user_args.image_cache_max_bytes,
+                                            'image_cache_max_bytes')
+
     wf = RatingWorkflowT1(id_list, in_dir, out_dir,
                           cfg.t1_mri_default_issue_list,
                           mri_name, in_dir_type, images_for_id,
@@ -802,7 +836,12 @@ def make_workflow_from_user_options():
                           outlier_feat_types, disable_outlier_detection,
                           user_args.prepare_first,
                           vis_type,
-                          views, num_slices_per_view, num_rows_per_view)
+                          views, num_slices_per_view, num_rows_per_view,
+                          prefetch_depth=prefetch_depth,
+                          prefetch_max_memory=prefetch_max_memory,
+                          unit_cache_max_bytes=unit_cache_max_bytes,
+                          image_cache_max_bytes=image_cache_max_bytes,
+                          ratings_backend=user_args.ratings_backend)
 
     return wf
 
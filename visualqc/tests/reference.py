@@ -0,0 +1,76 @@
+"""
+
+Random data, and the straightforward loops that optimized steps replaced,
+shared by the tests checking them against each other, and the benchmarks.
+
+"""
+
+import numpy as np
+
+from visualqc.utils import get_axis
+
+rng = np.random.default_rng(seed=42)
+
+
+def random_seg(size=40):
+
+    seg = np.zeros((size, size + 3, size + 6), dtype='float32')
+    low, high = size // 5, 4 * size // 5
+    seg[low:high, low:high + 3, low + 2:high] = rng.integers(0, 4, size=(
+        high - low, high - low + 3, high - low - 2))
+    # stray voxels, and an empty gap in between
+    seg[1, 2, 3] = 7
+    seg[:, :, high - 3] = 0
+
+    return seg
+
+
+def loop_pick_slices(img, view_set, num_slices):
+
+    slices = list()
+    for view in view_set:
+        dim_size = img.shape[view]
+        non_empty_slices = np.array([sl for sl in range(dim_size) if
+                                     np.count_nonzero(get_axis(img, view, sl)) > 0])
+        num_non_empty = len(non_empty_slices)
+
+        skip_count = max(0, np.around(num_non_empty * 0.05).astype('int16'))
+        if skip_count > 0 and (num_non_empty - 2 * skip_count > num_slices):
+            non_empty_slices = non_empty_slices[skip_count: -skip_count]
+            num_non_empty = len(non_empty_slices)
+
+        sampled_indices = np.linspace(0, num_non_empty,
+                                      num=min(num_non_empty, num_slices), endpoint=False)
+        slices_in_dim = non_empty_slices[np.around(sampled_indices).astype('int64')]
+        slices.extend([(view, slice) for slice in slices_in_dim])
+
+    return slices
+
+
+def random_run(size=12, num_frames=37):
+
+    img = 1000 + 50 * rng.standard_normal((size, size + 1, size + 2, num_frames))
+    # frames are contiguous on disk in NIfTI (Fortran order), as memory-mapped by nibabel
+    return np.asfortranarray(img.astype('float32'))
+
+
+def loop_DVARS(img4d, mask=None, standardize=False):
+
+    if mask is not None:
+        img4d = img4d[mask, :][np.newaxis, np.newaxis, :, :]
+    diffs = [img4d[:, :, :, t] - img4d[:, :, :, t - 1] for t in range(1, img4d.shape[3])]
+    dvars = np.zeros(img4d.shape[3])
+    dvars[1:] = [np.sqrt(np.mean(np.square(diff))) for diff in diffs]
+    if standardize:
+        dvars /= np.sqrt(np.mean(np.var(np.stack(diffs, axis=3), axis=3)))
+
+    return dvars
+
+
+def loop_spatial_stats(img4d):
+
+    num_frames = img4d.shape[3]
+    mean_signal = np.array([np.nanmean(img4d[:, :, :, t]) for t in range(num_frames)])
+    stdev_signal = np.array([np.nanstd(img4d[:, :, :, t]) for t in range(num_frames)])
+
+    return mean_signal, stdev_signal
@@ -0,0 +1,449 @@
+"""
+
+Headless benchmarks for the review workflows of each modality.
+
+Synthetic datasets of a chosen size are generated, and each workflow is run
+end-to-end (via its command line interface) with the Agg backend, with an
+automated rater in place of the reviewer. Time and memory spent per unit
+are reported from the timings recorded by the workflow.
+
+As they take a while, the end-to-end runs are skipped by pytest, unless
+the VISUALQC_BENCHMARKS environment variable is set:
+    VISUALQC_BENCHMARKS=1 python -m pytest visualqc/tests/test_benchmarks.py
+
+Run the full suite with a larger dataset with:
+    python -m visualqc.tests.test_benchmarks --num_units 50 --size 128
+
+The steps optimized in isolation are also benchmarked against the loops they
+replaced (checked for equivalence in their own tests), e.g. picking slices
+of a high resolution (0.7 mm) volume, and the stats of a long (multiband) run:
+    python -m visualqc.tests.test_benchmarks --modalities --kernels pick_slices --size 320
+    python -m visualqc.tests.test_benchmarks --modalities --kernels stats_over_frames --num_frames 1200
+
+"""
+
+import argparse
+import json
+import os
+import shlex
+import sys
+import tempfile
+import time
+from os import makedirs
+from os.path import join as pjoin
+from types import MethodType
+
+import matplotlib
+
+matplotlib.use('Agg')
+
+import nibabel as nib
+import numpy as np
+import pytest
+from matplotlib import pyplot as plt
+
+from visualqc import config as cfg
+
+rng = np.random.default_rng(seed=42)
+
+
+def _synthetic_head(size):
+    """3D volume with a bright ellipsoid (head) in a dark, noisy background."""
+
+    grid = np.mgrid[[slice(-1, 1, size * 1j)] * 3]
+    head = (grid ** 2).sum(axis=0) < 0.6
+    volume = 10 * rng.random((size, size, size))
+    volume[head] += 100 + 20 * rng.random(int(head.sum()))
+
+    return volume.astype('float32'), head
+
+
+def _save_nifti(volume, path):
+
+    nib.save(nib.Nifti1Image(volume, np.eye(4)), path)
+
+
+def _write_id_list(base_dir, id_list):
+
+    id_list_path = pjoin(base_dir, 'id_list.txt')
+    with open(id_list_path, 'w') as idf:
+        idf.write('\n'.join(id_list))
+
+    return id_list_path
+
+
+def _write_bids_description(bids_dir, num_units):
+
+    makedirs(bids_dir, exist_ok=True)
+    with open(pjoin(bids_dir, 'dataset_description.json'), 'w') as df:
+        json.dump(dict(Name='visualqc benchmark', BIDSVersion='1.4.0'), df)
+    with open(pjoin(bids_dir, 'participants.tsv'), 'w') as pf:
+        pf.write('participant_id\n')
+        pf.write('\n'.join(['sub-{:03d}'.format(ix) for ix in range(num_units)]))
+
+
+def make_t1_dataset(base_dir, num_units, size=64, mri_name='t1.nii.gz'):
+    """Folder per subject, with a T1 MRI in it."""
+
+    id_list = ['sub{:03d}'.format(ix) for ix in range(num_units)]
+    for sid in id_list:
+        makedirs(pjoin(base_dir, sid), exist_ok=True)
+        volume, _ = _synthetic_head(size)
+        _save_nifti(volume, pjoin(base_dir, sid, mri_name))
+
+    return _write_id_list(base_dir, id_list)
+
+
+def make_defacing_dataset(base_dir, num_units, size=64,
+                          defaced_name='defaced.nii.gz', mri_name='orig.nii.gz',
+                          render_name='render'):
+    """Folder per subject, with the original and defaced MRI, and their renders."""
+
+    id_list = ['sub{:03d}'.format(ix) for ix in range(num_units)]
+    for sid in id_list:
+        makedirs(pjoin(base_dir, sid), exist_ok=True)
+        volume, _ = _synthetic_head(size)
+        _save_nifti(volume, pjoin(base_dir, sid, mri_name))
+        # removing the front of the face
+        volume[:, int(0.8 * size):, :int(0.5 * size)] = 0
+        _save_nifti(volume, pjoin(base_dir, sid, defaced_name))
+        for view in range(3):
+            plt.imsave(pjoin(base_dir, sid, '{}_{}.png'.format(render_name, view)),
+                       volume.max(axis=view), cmap='gray')
+
+    return _write_id_list(base_dir, id_list)
+
+
+def make_freesurfer_dataset(base_dir, num_units, size=64):
+    """Freesurfer-like SUBJECTS_DIR, with MRI, segmentation and stats."""
+
+    # cortical labels, and a few subcortical ones
+    labels = np.array([1000 + ix for ix in range(1, 36)] +
+                      [2000 + ix for ix in range(1, 36)] + [10, 11, 12, 13, 17, 18])
+    id_list = ['sub{:03d}'.format(ix) for ix in range(num_units)]
+    for sid in id_list:
+        for sub_dir in ('mri', 'stats'):
+            makedirs(pjoin(base_dir, sid, sub_dir), exist_ok=True)
+
+        volume, head = _synthetic_head(size)
+        seg = np.zeros(volume.shape, dtype='int32')
+        seg[head] = rng.choice(labels, int(head.sum()))
+        nib.save(nib.MGHImage(volume, np.eye(4)), pjoin(base_dir, sid, 'mri',
+                                                        cfg.default_mri_name))
+        nib.save(nib.MGHImage(seg, np.eye(4)), pjoin(base_dir, sid, 'mri',
+                                                     cfg.default_seg_name))
+        _write_aseg_stats(pjoin(base_dir, sid, 'stats', 'aseg.stats'))
+        for hemi in ('lh', 'rh'):
+            _write_aparc_stats(pjoin(base_dir, sid, 'stats',
+                                     '{}.aparc.stats'.format(hemi)))
+
+    return _write_id_list(base_dir, id_list)
+
+
+def _write_aseg_stats(path, num_rois=45):
+    """Subcortical volumes and global measures, in the format of aseg.stats"""
+
+    measures = ['lhCortex, lhCortexVol, Left hemisphere cortical gray matter volume',
+                'rhCortex, rhCortexVol, Right hemisphere cortical gray matter volume',
+                'Cortex, CortexVol, Total cortical gray matter volume',
+                'SubCortGray, SubCortGrayVol, Subcortical gray matter volume',
+                'IntraCranialVol, ICV, Intracranial Volume']
+    lines = ['# Measure {}, {:.6f}, mm^3'.format(msr, 1e5 + 1e6 * rng.random())
+             for msr in measures]
+    lines.append('# ColHeaders  Index SegId NVoxels Volume_mm3 StructName normMean '
+                 'normStdDev normMin normMax normRange')
+    for index in range(num_rois):
+        num_voxels = rng.integers(100, 20000)
+        lines.append('{:3d} {:3d} {:9d} {:10.1f}  ROI_{:<28d} {:10.4f} {:10.4f} '
+                     '{:10.4f} {:10.4f} {:10.4f}'
+                     ''.format(index + 1, index + 2, num_voxels, num_voxels, index,
+                               *(100 * rng.random(5))))
+    with open(path, 'w') as sf:
+        sf.write('\n'.join(lines))
+
+
+def _write_aparc_stats(path, num_rois=34):
+    """Cortical ROI stats, in the format of ?h.aparc.stats"""
+
+    lines = ['# Measure Cortex, WhiteSurfArea, White Surface Total Area, '
+             '{:.1f}, mm^2'.format(8e4 + 1e4 * rng.random()),
+             '# Measure Cortex, MeanThickness, Mean Thickness, '
+             '{:.4f}, mm'.format(2 + rng.random()),
+             '# ColHeaders StructName NumVert SurfArea GrayVol ThickAvg ThickStd '
+             'MeanCurv GausCurv FoldInd CurvInd']
+    for index in range(num_rois):
+        lines.append('roi_{:<36d} {:5d} {:5d} {:6d} {:6.3f} {:5.3f} {:9.3f} {:9.3f} '
+                     '{:6d} {:7.1f}'.format(index, *rng.integers(500, 5000, 3),
+                                            *rng.random(4), rng.integers(1, 50),
+                                            rng.random()))
+    with open(path, 'w') as sf:
+        sf.write('\n'.join(lines))
+
+
+def make_func_mri_dataset(bids_dir, num_units, size=32, num_frames=100, TR=2.0):
+    """BIDS dataset with one BOLD run per subject."""
+
+    _write_bids_description(bids_dir, num_units)
+    for ix in range(num_units):
+        sub = 'sub-{:03d}'.format(ix)
+        func_dir = pjoin(bids_dir, sub, 'func')
+        makedirs(func_dir, exist_ok=True)
+
+        volume, head = _synthetic_head(size)
+        signal = 1 + 0.01 * rng.standard_normal((1, 1, 1, num_frames))
+        bold = volume[..., np.newaxis] * signal
+        bold_img = nib.Nifti1Image(bold.astype('float32'), np.eye(4))
+        bold_img.header.set_zooms((3.0, 3.0, 3.0, TR))
+        nib.save(bold_img, pjoin(func_dir, '{}_task-rest_bold.nii.gz'.format(sub)))
+        with open(pjoin(func_dir, '{}_task-rest_bold.json'.format(sub)), 'w') as jf:
+            json.dump(dict(RepetitionTime=TR, TaskName='rest'), jf)
+
+
+def make_diffusion_dataset(bids_dir, num_units, size=32, num_gradients=30, b_value=1000):
+    """BIDS dataset with one DWI scan (with bval/bvec) per subject."""
+
+    _write_bids_description(bids_dir, num_units)
+    for ix in range(num_units):
+        sub = 'sub-{:03d}'.format(ix)
+        dwi_dir = pjoin(bids_dir, sub, 'dwi')
+        makedirs(dwi_dir, exist_ok=True)
+
+        volume, head = _synthetic_head(size)
+        # first volume is b=0
+        attenuation = np.hstack((1, 0.3 + 0.1 * rng.random(num_gradients)))
+        dwi = volume[..., np.newaxis] * attenuation.reshape(1, 1, 1, -1)
+        _save_nifti(dwi.astype('float32'), pjoin(dwi_dir, '{}_dwi.nii.gz'.format(sub)))
+
+        bvals = np.hstack((0, np.full(num_gradients, b_value)))
+        bvecs = rng.standard_normal((3, num_gradients + 1))
+        bvecs[:, 0] = 0
+        bvecs[:, 1:] /= np.linalg.norm(bvecs[:, 1:], axis=0)
+        np.savetxt(pjoin(dwi_dir, '{}_dwi.bval'.format(sub)), bvals[np.newaxis, :],
+                   fmt='%d')
+        np.savetxt(pjoin(dwi_dir, '{}_dwi.bvec'.format(sub)), bvecs, fmt='%.6f')
+        with open(pjoin(dwi_dir, '{}_dwi.json'.format(sub)), 'w') as jf:
+            json.dump(dict(PhaseEncodingDirection='j-'), jf)
+
+
+def attach_automated_rater(wf):
+    """
+    Replaces the interactive review in a workflow with an automated rater,
+    which renders the figure (as it would be for the reviewer), checks the
+    first rating available, and advances to the next unit right away.
+    """
+
+    def show_fig_and_wait(self):
+
+        self.fig.canvas.draw()
+        if hasattr(self.UI, 'checkbox'):
+            self.UI.checkbox.set_active(0)
+        else:
+            self.UI.radio_bt_rating.set_active(0)
+        self.next()
+
+    wf.show_fig_and_wait = MethodType(show_fig_and_wait, wf)
+
+    return wf
+
+
+def run_benchmark(module, cmd_args):
+    """
+    Creates the workflow from given command line args, rates all the units
+    automatically, and returns the time and memory spent per unit.
+    """
+
+    sys.argv = shlex.split('visualqc {}'.format(cmd_args))
+    wf = module.make_workflow_from_user_options()
+    attach_automated_rater(wf)
+    wf.run()
+    plt.close('all')
+
+    return per_unit_stats(wf.timer.records)
+
+
+def per_unit_stats(records):
+    """Latency (time to load and display) and peak memory, per unit."""
+
+    stats = dict()
+    for rec in records:
+        if rec['unit_id'] is None:
+            continue
+        unit = stats.setdefault(rec['unit_id'], dict(latency=0.0, peak_rss_mb=0.0))
+        if rec['stage'] != cfg.stage_waiting_for_reviewer:
+            unit['latency'] += rec['wall_time']
+        unit['peak_rss_mb'] = max(unit['peak_rss_mb'], rec['peak_rss_mb'] or 0)
+
+    return stats
+
+
+def report(name, stats):
+    """Prints the summary of time and memory spent per unit."""
+
+    latency = np.array([unit['latency'] for unit in stats.values()])
+    peak_rss = max(unit['peak_rss_mb'] for unit in stats.values())
+    print('\n{:>12} : {:4d} units, latency p50 {:.3f}s p95 {:.3f}s, '
+          'peak memory {:.0f} MB'.format(name, len(stats),
+                                         np.percentile(latency, 50),
+                                         np.percentile(latency, 95), peak_rss))
+
+
+def benchmark_t1_mri(base_dir, num_units, size):
+
+    from visualqc import t1_mri
+    in_dir = pjoin(base_dir, 't1_mri')
+    id_list = make_t1_dataset(in_dir, num_units, size)
+    return run_benchmark(t1_mri, '-u {} -i {} -m t1.nii.gz -o {} -old'
+                                 ''.format(in_dir, id_list, pjoin(in_dir, 'vqc')))
+
+
+def benchmark_defacing(base_dir, num_units, size):
+
+    from visualqc import defacing
+    in_dir = pjoin(base_dir, 'defacing')
+    id_list = make_defacing_dataset(in_dir, num_units, size)
+    return run_benchmark(defacing, '-u {} -i {} -d defaced.nii.gz -m orig.nii.gz '
+                                   '-r render -o {}'
+                                   ''.format(in_dir, id_list, pjoin(in_dir, 'vqc')))
+
+
+def benchmark_freesurfer(base_dir, num_units, size):
+
+    from visualqc import freesurfer
+    in_dir = pjoin(base_dir, 'freesurfer')
+    id_list = make_freesurfer_dataset(in_dir, num_units, size)
+    return run_benchmark(freesurfer, '-f {} -i {} -o {} -ns'
+                                     ''.format(in_dir, id_list, pjoin(in_dir, 'vqc')))
+
+
+def benchmark_func_mri(base_dir, num_units, size):
+
+    from visualqc import functional_mri
+    in_dir = pjoin(base_dir, 'func_mri')
+    make_func_mri_dataset(in_dir, num_units, size=max(16, size // 2))
+    return run_benchmark(functional_mri, '-b {} -o {} -old'
+                                         ''.format(in_dir, pjoin(in_dir, 'vqc')))
+
+
+def benchmark_diffusion(base_dir, num_units, size):
+
+    from visualqc import diffusion
+    in_dir = pjoin(base_dir, 'diffusion')
+    make_diffusion_dataset(in_dir, num_units, size=max(16, size // 2))
+    # outlier detection is disabled by default for DWI
+    return run_benchmark(diffusion, '-b {} -o {}'
+                                    ''.format(in_dir, pjoin(in_dir, 'vqc')))
+
+
+benchmarks = dict(t1_mri=benchmark_t1_mri,
+                  defacing=benchmark_defacing,
+                  freesurfer=benchmark_freesurfer,
+                  func_mri=benchmark_func_mri,
+                  diffusion=benchmark_diffusion)
+
+
+def _best_time(func, *args, repeats=3):
+    """Shortest time taken by a call, over a few repeats."""
+
+    times = list()
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+
+def benchmark_pick_slices(size, num_frames):
+    """Picking slices via projections, against the loop over slices it replaced."""
+
+    from visualqc.tests.reference import loop_pick_slices, random_seg
+    from visualqc.utils import pick_slices
+
+    seg = random_seg(size)
+    print('Picking 12 slices in each of 3 views of a {} volume:'.format(seg.shape))
+    for name, func in (('loop over slices', loop_pick_slices),
+                       ('projections', pick_slices)):
+        print('\t{:>17} : {:.3f} s'.format(name, _best_time(func, seg, (0, 1, 2), 12)))
+
+
+def benchmark_stats_over_frames(size, num_frames):
+    """All the stats over frames in one chunked pass, against the loops it replaced."""
+
+    from visualqc.image_stats import stats_over_frames
+    from visualqc.tests.reference import loop_DVARS, loop_spatial_stats, random_run
+
+    img = random_run(size, num_frames)
+    loops = lambda img4d: (np.mean(img4d, axis=3), np.std(img4d, axis=3),
+                           loop_spatial_stats(img4d), loop_DVARS(img4d))
+    print('Stats over the frames of a {} run:'.format(img.shape))
+    for name, func in (('loops', loops), ('chunked', stats_over_frames)):
+        print('\t{:>17} : {:.3f} s'.format(name, _best_time(func, img)))
+
+
+kernel_benchmarks = dict(pick_slices=benchmark_pick_slices,
+                         stats_over_frames=benchmark_stats_over_frames)
+
+
+# end-to-end runs of each workflow, only on request
+end_to_end = pytest.mark.skipif('VISUALQC_BENCHMARKS' not in os.environ,
+                                reason='set VISUALQC_BENCHMARKS to run the '
+                                       'end-to-end benchmarks')
+
+
+def _check_all_units_reviewed(stats, num_units):
+
+    assert len(stats) == num_units
+    assert all(unit['latency'] > 0 for unit in stats.values())
+
+
+@end_to_end
+def test_benchmark_t1_mri(tmp_path):
+    _check_all_units_reviewed(benchmark_t1_mri(str(tmp_path), 3, 32), 3)
+
+
+@end_to_end
+def test_benchmark_defacing(tmp_path):
+    _check_all_units_reviewed(benchmark_defacing(str(tmp_path), 3, 32), 3)
+
+
+@end_to_end
+def test_benchmark_freesurfer(tmp_path):
+    _check_all_units_reviewed(benchmark_freesurfer(str(tmp_path), 3, 32), 3)
+
+
+@end_to_end
+def test_benchmark_func_mri(tmp_path):
+    _check_all_units_reviewed(benchmark_func_mri(str(tmp_path), 3, 32), 3)
+
+
+@end_to_end
+def test_benchmark_diffusion(tmp_path):
+    _check_all_units_reviewed(benchmark_diffusion(str(tmp_path), 3, 32), 3)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog='test_benchmarks')
+    parser.add_argument('--num_units', type=int, default=10,
+                        help='Number of units (subjects or runs) per dataset.')
+    parser.add_argument('--size', type=int, default=64,
+                        help='Size of each (isotropic) volume in voxels.')
+    parser.add_argument('--modalities', nargs='*', default=list(benchmarks),
+                        choices=list(benchmarks))
+    parser.add_argument('--kernels', nargs='*', default=list(),
+                        choices=list(kernel_benchmarks))
+    parser.add_argument('--num_frames', type=int, default=1200,
+                        help='Number of frames in each run, for the kernels.')
+    parser.add_argument('--work_dir', default=None,
+                        help='Folder to generate the datasets in. '
+                             'Default: a temporary folder.')
+    args = parser.parse_args()
+
+    work_dir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp()
+    results = {name: benchmarks[name](work_dir, args.num_units, args.size)
+               for name in args.modalities}
+    for name, stats in results.items():
+        report(name, stats)
+
+    for name in args.kernels:
+        kernel_benchmarks[name](args.size, args.num_frames)
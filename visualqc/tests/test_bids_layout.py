@@ -0,0 +1,98 @@
+"""
+
+Checks the index of a BIDS dataset is reused when resuming a review,
+and the files found in it are grouped by subject (and session).
+
+"""
+
+import json
+from os import makedirs
+from os.path import join as pjoin
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+pytest.importorskip('bids')
+
+from visualqc.readers import anatomical_traverse_bids, load_bids_layout
+from visualqc.utils import check_out_dir
+
+
+def _add_subject(bids_dir, ix, session=None):
+
+    unit_dir = pjoin(bids_dir, 'sub-{:02d}'.format(ix))
+    prefix = 'sub-{:02d}'.format(ix)
+    if session is not None:
+        unit_dir = pjoin(unit_dir, 'ses-{}'.format(session))
+        prefix = '{}_ses-{}'.format(prefix, session)
+    anat_dir = pjoin(unit_dir, 'anat')
+    makedirs(anat_dir)
+    nib.save(nib.Nifti1Image(np.zeros((4, 4, 4), dtype='float32'), np.eye(4)),
+             pjoin(anat_dir, '{}_T1w.nii.gz'.format(prefix)))
+
+
+def _make_bids_dataset(bids_dir, num_subjects=3):
+
+    makedirs(bids_dir, exist_ok=True)
+    with open(pjoin(bids_dir, 'dataset_description.json'), 'w') as df:
+        json.dump(dict(Name='visualqc test', BIDSVersion='1.4.0'), df)
+    for ix in range(num_subjects):
+        _add_subject(bids_dir, ix)
+
+
+def test_index_reused_with_default_out_dir(tmp_path, capsys):
+
+    bids_dir = str(tmp_path / 'bids')
+    _make_bids_dataset(bids_dir)
+    # within the dataset, as by default
+    out_dir = check_out_dir(None, bids_dir)
+
+    layout = load_bids_layout(bids_dir, out_dir)
+    assert len(layout.get_subjects()) == 3
+    assert 'Reusing' not in capsys.readouterr().out
+
+    # files written to out_dir during the review must not invalidate the index
+    with open(pjoin(out_dir, 'ratings.csv'), 'w') as rf:
+        rf.write('sub-00,Pass,\n')
+    makedirs(pjoin(bids_dir, 'derivatives', 'fmriprep'))
+
+    layout = load_bids_layout(bids_dir, out_dir)
+    assert 'Reusing' in capsys.readouterr().out
+    assert len(layout.get_subjects()) == 3
+
+    # but new subjects do
+    _add_subject(bids_dir, 10)
+    layout = load_bids_layout(bids_dir, out_dir)
+    assert 'Reusing' not in capsys.readouterr().out
+    assert len(layout.get_subjects()) == 4
+
+
+def test_units_grouped_by_session(tmp_path):
+
+    bids_dir = str(tmp_path / 'bids')
+    _make_bids_dataset(bids_dir, num_subjects=0)
+    for ix, session in ((1, 'pre'), (1, 'post'), (2, 'pre')):
+        _add_subject(bids_dir, ix, session)
+    with open(pjoin(bids_dir, 'sub-01', 'ses-pre', 'anat',
+                    'sub-01_ses-pre_T1w.json'), 'w') as jf:
+        json.dump(dict(), jf)
+
+    units = anatomical_traverse_bids(load_bids_layout(bids_dir))
+
+    assert sorted(units) == ['01_post', '01_pre', '02_pre']
+    assert units['01_pre']['params'].endswith('sub-01_ses-pre_T1w.json')
+    assert units['01_post']['params'] == 'None'
+    assert units['02_pre']['image'].endswith('sub-02_ses-pre_T1w.nii.gz')
+
+
+def test_session_kept_when_filtered_to_one(tmp_path):
+
+    bids_dir = str(tmp_path / 'bids')
+    _make_bids_dataset(bids_dir, num_subjects=0)
+    for ix, session in ((1, 'pre'), (1, 'post'), (2, 'pre')):
+        _add_subject(bids_dir, ix, session)
+
+    # ids must not depend on the sessions selected, as ratings are saved by id
+    units = anatomical_traverse_bids(load_bids_layout(bids_dir), sessions='pre')
+    assert sorted(units) == ['01_pre', '02_pre']
@@ -0,0 +1,120 @@
+"""
+
+Checks the carpet is binned down to the pixels available, without losing spikes.
+
+"""
+
+import numpy as np
+import pytest
+
+from visualqc.carpet import bin_carpet, carpet_of_frames, detrend_carpet, quantize_carpet, \
+    rescale_rows
+
+rng = np.random.default_rng(seed=42)
+
+
+def test_bins_match_loops():
+
+    carpet = rng.random((53, 40))
+    num_bins = 7
+    starts = np.linspace(0, carpet.shape[1], num_bins, endpoint=False).astype(int)
+    edges = np.append(starts, carpet.shape[1])
+    for method, func in (('mean', np.mean), ('min', np.min), ('max', np.max)):
+        binned = bin_carpet(carpet, (100, num_bins), col_method=method)
+        expected = np.column_stack([func(carpet[:, start:end], axis=1)
+                                    for start, end in zip(edges[:-1], edges[1:])])
+        assert np.allclose(binned, expected)
+
+
+def test_spikes_are_kept():
+
+    carpet = 0.5 + 0.01 * rng.standard_normal((2000, 1200))
+    carpet[:, 345] = 1.0
+    carpet[:, 901] = 0.0
+    binned = bin_carpet(carpet, (300, 400))
+    assert binned.shape == (300, 400)
+    assert np.isclose(binned.max(), 1.0) and np.isclose(binned.min(), 0.0)
+
+    # smaller carpets are shown as they are
+    assert np.array_equal(bin_carpet(carpet[:10, :20], (300, 400)), carpet[:10, :20])
+
+    with pytest.raises(ValueError):
+        bin_carpet(carpet, (300, 400), col_method='median')
+
+
+def test_rescale_rows():
+
+    carpet = 100 * rng.standard_normal((500, 60)).astype('float32')
+    carpet[7, :] = 3.0
+    range_ = np.ptp(carpet, axis=1, keepdims=True)
+    range_[7] = 1.0
+    expected = (carpet - carpet.min(axis=1, keepdims=True)) / range_
+
+    rescaled = rescale_rows(carpet, num_rows_per_chunk=64)
+    # in place, without any copies
+    assert rescaled is carpet
+    assert np.allclose(rescaled, expected, atol=1e-6)
+
+    integers = rescale_rows(np.arange(12).reshape(3, 4))
+    assert integers.dtype == np.float32
+    assert np.allclose(integers, [[0, 1 / 3, 2 / 3, 1]] * 3)
+
+
+def test_quantize():
+
+    quantized = quantize_carpet(np.array([[-0.1, 0.0, 0.5, 1.0, 1.2]]))
+    assert quantized.dtype == np.uint8
+    assert np.array_equal(quantized, [[0, 0, 128, 255, 255]])
+
+
+def test_detrend_matches_least_squares():
+
+    num_time_points = 150
+    time_points = np.arange(num_time_points)
+    carpet = (1000 + 0.3 * time_points + 10 * np.sin(time_points / 20.0)
+              + rng.standard_normal((300, num_time_points)))
+
+    expected = np.array([row - np.polyval(np.polyfit(time_points, row, 1), time_points)
+                         for row in carpet])
+    detrended = detrend_carpet(carpet.astype('float32'), TR=2.0, num_rows_per_chunk=64)
+    assert np.allclose(detrended, expected, atol=1e-2)
+
+    # high-pass filtering removes the slow oscillation too
+    filtered = detrend_carpet(carpet.copy(), TR=2.0, high_pass=0.01)
+    assert filtered.std() < 0.5 * expected.std()
+
+    with pytest.raises(ValueError):
+        detrend_carpet(carpet, TR=None, high_pass=0.01)
+
+
+def test_carpet_of_frames_matches_in_memory():
+
+    num_frames = 90
+    img = 1000 + 0.5 * np.arange(num_frames) + rng.standard_normal((9, 10, 11, num_frames))
+    img = np.asfortranarray(img.astype('float32'))
+    mask = rng.random(img.shape[:3]) > 0.3
+    for detrend in (False, True):
+        in_memory = img[mask, :].copy()
+        if detrend:
+            detrend_carpet(in_memory, TR=2.0)
+        rescale_rows(in_memory)
+        for carpet_size in ((40, 200), (40, 25), (500, 13)):
+            expected = quantize_carpet(bin_carpet(in_memory, carpet_size))
+            for num_frames_per_chunk in (1, 7, 100):
+                carpet = carpet_of_frames(img, mask, carpet_size, detrend=detrend,
+                                          TR=2.0, num_frames_per_chunk=num_frames_per_chunk)
+                assert carpet.shape == expected.shape
+                # rounding to 8 bits may differ, after detrending in float64
+                assert np.abs(carpet.astype(int) - expected).max() <= 1
+
+
+def test_carpet_of_frames_with_extrema():
+
+    img = rng.standard_normal((9, 10, 11, 40)).astype('float32')
+    mask = rng.random(img.shape[:3]) > 0.3
+    extrema = (img.min(axis=3), img.max(axis=3))
+    for detrend in (False, True):
+        expected = carpet_of_frames(img, mask, (40, 25), detrend=detrend, TR=2.0)
+        with_extrema = carpet_of_frames(img, mask, (40, 25), detrend=detrend, TR=2.0,
+                                        extrema=extrema)
+        assert np.array_equal(with_extrema, expected)
@@ -0,0 +1,90 @@
+"""
+
+Checks the DWI is read in chunks of gradients, decompressed only once, and that
+only the derived arrays are returned, never the DW volumes.
+
+"""
+
+import time
+
+import nibabel as nib
+import numpy as np
+
+from visualqc.carpet import bin_carpet, quantize_carpet, rescale_rows
+from visualqc.diffusion import read_dwi_unit
+from visualqc.image_utils import mask_image
+
+rng = np.random.default_rng(seed=13)
+
+flipped_affine = np.diag([2.0, -2.0, -2.0, 1.0])
+
+
+def save_dwi(tmp_path, shape=(16, 17, 18), b_values=(0, 1000, 1000, 0, 2000) * 6):
+
+    b_values = np.array(b_values)
+    axes = np.meshgrid(*[np.linspace(-1, 1, size) for size in shape], indexing='ij')
+    blob = sum(np.square(axis) for axis in axes) < 0.6
+    attenuation = np.exp(-b_values / 1000 * rng.uniform(0.5, 1.5, len(b_values)))
+    img = 1000 * blob[:, :, :, np.newaxis] * attenuation + \
+          10 * rng.standard_normal(shape + (len(b_values),))
+    img_path = str(tmp_path / 'dwi.nii.gz')
+    nib.save(nib.Nifti1Image(img.astype('float32'), flipped_affine), img_path)
+    bval_path = str(tmp_path / 'dwi.bval')
+    np.savetxt(bval_path, b_values[np.newaxis, :], fmt='%d')
+
+    return img_path, bval_path
+
+
+def test_read_matches_in_memory(tmp_path):
+
+    img_path, bval_path = save_dwi(tmp_path)
+    carpet_size = (50, 100)
+    unit_data = read_dwi_unit(img_path, bval_path, carpet_size=carpet_size)
+    assert 'dw_volumes' not in unit_data
+    assert all(not (isinstance(value, np.ndarray) and value.ndim > 3)
+               for value in unit_data.values())
+
+    img = np.asanyarray(nib.as_closest_canonical(nib.load(img_path)).dataobj)
+    b_values = np.loadtxt(bval_path)
+    dw_volumes = img[:, :, :, b_values != 0].astype('float64')
+    assert np.array_equal(unit_data['b0_indices'], np.flatnonzero(b_values == 0))
+    assert np.array_equal(unit_data['b0_volume'], img[:, :, :, 0])
+    assert not unit_data['is_empty']
+    assert np.allclose(unit_data['mean_img'], dw_volumes.mean(axis=3))
+    assert np.allclose(unit_data['stdev_img'], dw_volumes.std(axis=3))
+    assert np.allclose(unit_data['mean_signal_spatial'], dw_volumes.mean(axis=(0, 1, 2)))
+
+    mask = mask_image(unit_data['mean_img'], update_factor=0.9, init_percentile=5)
+    carpet = dw_volumes[mask > 0, :].astype('float32')
+    expected = quantize_carpet(bin_carpet(rescale_rows(carpet), carpet_size))
+    assert np.abs(unit_data['carpet'].astype(int) - expected).max() <= 1
+
+
+def test_no_b0(tmp_path):
+
+    img_path, bval_path = save_dwi(tmp_path, b_values=(1000, 2000) * 3)
+    unit_data = read_dwi_unit(img_path, bval_path)
+    assert len(unit_data['b0_indices']) == 0
+    assert 'carpet' not in unit_data
+
+
+def test_empty_dwi(tmp_path):
+
+    img_path = str(tmp_path / 'empty.nii.gz')
+    nib.save(nib.Nifti1Image(np.zeros((5, 6, 7, 4), dtype='int16'), np.eye(4)), img_path)
+    bval_path = str(tmp_path / 'empty.bval')
+    np.savetxt(bval_path, np.array([[0, 1000, 1000, 1000]]), fmt='%d')
+    assert read_dwi_unit(img_path, bval_path)['is_empty']
+
+
+def test_compressed_dwi_decompressed_once(tmp_path):
+
+    img_path, bval_path = save_dwi(tmp_path, (40, 40, 30), (0, 1000, 2000, 3000) * 50)
+    start = time.perf_counter()
+    np.asanyarray(nib.load(img_path).dataobj)
+    full_read = time.perf_counter() - start
+
+    start = time.perf_counter()
+    read_dwi_unit(img_path, bval_path, carpet_size=(100, 50))
+    # decompressing in each of the (up to 3) passes takes 3 times as long
+    assert time.perf_counter() - start < 2.5 * full_read
@@ -0,0 +1,64 @@
+"""
+
+Checks the store of cohort features keeps the rows of all subjects intact,
+while they are added in batches.
+
+"""
+
+import numpy as np
+import pytest
+
+from visualqc.feature_store import CohortFeatureStore
+
+num_features = 7
+
+
+def _store(tmp_path):
+
+    return CohortFeatureStore(str(tmp_path / 'features.npy'),
+                              str(tmp_path / 'features_ids.txt'))
+
+
+def _features(sid):
+
+    return np.arange(num_features) + 100.0 * int(sid.split('_')[1])
+
+
+def test_rows_added_in_batches(tmp_path):
+
+    ids = ['sub_{}'.format(ix) for ix in range(50)]
+    store = _store(tmp_path)
+    for start in range(0, len(ids), 7):
+        store.update({sid: _features(sid) for sid in ids[start:start + 7]})
+
+    # room is left for more subjects, without exceeding twice the number stored
+    num_rows = np.load(store.matrix_path, mmap_mode='r').shape[0]
+    assert len(ids) <= num_rows <= 2 * len(ids)
+
+    reopened = _store(tmp_path)
+    assert len(reopened) == len(ids)
+    assert reopened.matrix().shape == (len(ids), num_features)
+    query = ids[::-3] + ['sub_unknown']
+    rows = reopened.rows(query)
+    for sid, row in zip(query[:-1], rows[:-1]):
+        assert np.array_equal(row, _features(sid))
+    assert np.all(np.isnan(rows[-1]))
+
+
+def test_features_replaced(tmp_path):
+
+    store = _store(tmp_path)
+    store.update({sid: _features(sid) for sid in ('sub_1', 'sub_2')})
+    store.update({'sub_1': -np.ones(num_features), 'sub_3': _features('sub_3')})
+
+    assert store.ids == ['sub_1', 'sub_2', 'sub_3']
+    assert np.array_equal(store.rows(['sub_1'])[0], -np.ones(num_features))
+    assert np.array_equal(store.rows(['sub_2'])[0], _features('sub_2'))
+
+
+def test_number_of_features_checked(tmp_path):
+
+    store = _store(tmp_path)
+    store.update({'sub_1': _features('sub_1')})
+    with pytest.raises(ValueError):
+        store.update({'sub_2': np.zeros(num_features + 1)})
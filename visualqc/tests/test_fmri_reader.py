@@ -0,0 +1,96 @@
+"""
+
+Checks the BOLD scan is read in chunks of frames, and never held in memory
+as a whole, even when compressed and not cached, nor decompressed more than once.
+
+"""
+
+import time
+import tracemalloc
+
+import nibabel as nib
+import numpy as np
+
+from visualqc.carpet import bin_carpet, detrend_carpet, quantize_carpet, rescale_rows
+from visualqc.functional_mri import read_fmri_unit
+
+rng = np.random.default_rng(seed=11)
+
+# axes flipped, relative to the canonical (RAS) orientation
+flipped_affine = np.diag([-3.0, 3.0, -3.0, 1.0])
+
+
+def save_run(path, shape, TR=2.0):
+
+    # a bright blob with a slow drift, in a dark background
+    axes = np.meshgrid(*[np.linspace(-1, 1, size) for size in shape[:3]], indexing='ij')
+    blob = sum(np.square(axis) for axis in axes) < 0.6
+    img = blob[:, :, :, np.newaxis] * (1000 + 0.2 * np.arange(shape[3])) + \
+          20 * rng.standard_normal(shape)
+    nifti = nib.Nifti1Image(img.astype('float32'), flipped_affine)
+    nifti.header.set_zooms((3.0, 3.0, 3.0, TR))
+    nib.save(nifti, str(path))
+
+    return str(path)
+
+
+def test_read_matches_in_memory(tmp_path):
+
+    path = save_run(tmp_path / 'bold.nii.gz', (16, 17, 18, 60))
+    # time points are not binned, as min and max are tied in bins of two
+    carpet_size = (50, 100)
+    unit_data = read_fmri_unit(path, drop_start=2, drop_end=3, carpet_size=carpet_size)
+
+    func_img = np.asanyarray(nib.as_closest_canonical(nib.load(path)).dataobj)
+    func_img = func_img[:, :, :, 2:-3].astype('float64')
+    assert unit_data['TR'] == 2.0
+    assert unit_data['num_frames'] == func_img.shape[3]
+    assert not unit_data['is_empty']
+    assert np.allclose(unit_data['mean_img'], func_img.mean(axis=3))
+    assert np.allclose(unit_data['stdev_img'], func_img.std(axis=3))
+    assert np.allclose(unit_data['mean_signal_spatial'], func_img.mean(axis=(0, 1, 2)))
+
+    from visualqc.image_utils import mask_image
+    mask = mask_image(unit_data['mean_img'], update_factor=0.9, init_percentile=5)
+    carpet = func_img[mask > 0, :].astype('float32')
+    expected = quantize_carpet(bin_carpet(rescale_rows(detrend_carpet(carpet, 2.0)),
+                                          carpet_size))
+    assert np.abs(unit_data['carpet'].astype(int) - expected).max() <= 1
+
+
+def test_empty_run(tmp_path):
+
+    path = str(tmp_path / 'empty.nii.gz')
+    nib.save(nib.Nifti1Image(np.zeros((5, 6, 7, 10), dtype='int16'), np.eye(4)), path)
+    assert read_fmri_unit(path)['is_empty']
+
+
+def test_peak_memory_independent_of_length(tmp_path):
+
+    peaks = list()
+    for num_frames in (100, 400):
+        path = save_run(tmp_path / 'bold{}.nii.gz'.format(num_frames),
+                        (32, 32, 24, num_frames))
+        tracemalloc.start()
+        read_fmri_unit(path, carpet_size=(100, 50))
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    # a few chunks of frames, whatever the number of frames
+    size_of_long_run = 32 * 32 * 24 * 400 * 4
+    assert peaks[1] < 1.2 * peaks[0]
+    assert peaks[1] < 0.15 * size_of_long_run
+
+
+def test_compressed_run_decompressed_once(tmp_path):
+
+    path = save_run(tmp_path / 'bold.nii.gz', (40, 40, 30, 200))
+    start = time.perf_counter()
+    np.asanyarray(nib.load(path).dataobj)
+    full_read = time.perf_counter() - start
+
+    for no_preproc in (False, True):
+        start = time.perf_counter()
+        read_fmri_unit(path, no_preproc=no_preproc, carpet_size=(100, 50))
+        # decompressing in each of the (up to 4) passes takes 4 times as long
+        assert time.perf_counter() - start < 3 * full_read
@@ -0,0 +1,54 @@
+"""
+
+Checks the parsing of the stats files produced by Freesurfer.
+
+"""
+
+import numpy as np
+import pytest
+
+from visualqc.readers import read_freesurfer_stats
+
+_header = ('# Measure Cortex, MeanThickness, Mean Thickness, 2.59632, mm\n'
+           '# ColHeaders  Index SegId NVoxels Volume_mm3 StructName\n')
+
+
+def _write_stats(tmp_path, rows):
+
+    stats_file = tmp_path / 'aseg.stats'
+    stats_file.write_text(_header + ''.join(row + '\n' for row in rows))
+    return str(stats_file)
+
+
+def test_integer_columns(tmp_path):
+
+    roi_stats, measures = read_freesurfer_stats(_write_stats(
+        tmp_path, [' 1  4  100  101.5  Left-Lateral-Ventricle',
+                   ' 2  5  200  202.5  Left-Inf-Lat-Vent']))
+
+    assert roi_stats.dtype['NVoxels'] == np.dtype('int64')
+    assert list(roi_stats['SegId']) == [4, 5]
+    assert list(roi_stats['StructName']) == ['Left-Lateral-Ventricle',
+                                             'Left-Inf-Lat-Vent']
+    assert measures['value'][0] == pytest.approx(2.59632)
+
+
+def test_short_rows_filled_with_nan(tmp_path):
+
+    roi_stats, _ = read_freesurfer_stats(_write_stats(
+        tmp_path, [' 1  4  100  101.5  Left-Lateral-Ventricle',
+                   ' 2  5']))
+
+    # integer columns with missing values can only be floats
+    assert roi_stats.dtype['SegId'] == np.dtype('int64')
+    assert roi_stats.dtype['NVoxels'] == np.dtype('float64')
+    assert roi_stats['NVoxels'][0] == 100
+    assert np.isnan(roi_stats['NVoxels'][1])
+    assert np.isnan(roi_stats['Volume_mm3'][1])
+
+
+def test_non_numeric_values(tmp_path):
+
+    with pytest.raises(ValueError, match='NVoxels'):
+        read_freesurfer_stats(_write_stats(
+            tmp_path, [' 1  4  many  101.5  Left-Lateral-Ventricle']))
@@ -0,0 +1,149 @@
+"""
+
+Checks the cache of decompressed images: reuse, invalidation, eviction,
+and that each cache is used only where it is passed.
+
+"""
+
+import os
+import pickle
+import tempfile
+from functools import partial
+
+import nibabel as nib
+import numpy as np
+
+from visualqc import cache as vqc_cache
+from visualqc.cache import DecompressedImageCache, reader_key, uncompressed_copy, \
+    uncompressed_path
+from visualqc.utils import read_image
+
+rng = np.random.default_rng(seed=3)
+
+flipped_affine = np.diag([-2.0, 2.0, 2.0, 1.0])
+
+
+def save_compressed(path, shape=(5, 6, 7)):
+
+    data = rng.integers(1, 1000, size=shape).astype('int16')
+    nib.save(nib.Nifti1Image(data, flipped_affine), str(path))
+
+    return str(path)
+
+
+def canonical_data(path):
+
+    return np.asanyarray(nib.as_closest_canonical(nib.load(path)).dataobj)
+
+
+def test_copy_reused(tmp_path, monkeypatch):
+
+    img_path = save_compressed(tmp_path / 'img.nii.gz')
+    image_cache = DecompressedImageCache(str(tmp_path / 'cache'), max_bytes=10 ** 6)
+
+    assert uncompressed_path(img_path) == img_path
+    cached_path = uncompressed_path(img_path, image_cache)
+    assert cached_path.startswith(image_cache.cache_dir)
+    assert cached_path.endswith('.nii')
+    assert np.array_equal(np.asanyarray(nib.load(cached_path).dataobj),
+                          canonical_data(img_path))
+
+    def decompress_again(*args):
+        raise AssertionError('decompressed again!')
+
+    monkeypatch.setattr(vqc_cache, 'decompress_canonical', decompress_again)
+    assert uncompressed_path(img_path, image_cache) == cached_path
+    assert np.allclose(read_image(img_path, image_cache=image_cache),
+                       canonical_data(img_path))
+
+
+def test_uncompressed_not_copied(tmp_path):
+
+    img_path = str(tmp_path / 'img.nii')
+    nib.save(nib.Nifti1Image(np.ones((3, 4, 5)), np.eye(4)), img_path)
+    image_cache = DecompressedImageCache(str(tmp_path / 'cache'), max_bytes=10 ** 6)
+    assert uncompressed_path(img_path, image_cache) == img_path
+    assert len(os.listdir(image_cache.cache_dir)) == 0
+
+
+def test_changed_image_copied_again(tmp_path):
+
+    img_path = save_compressed(tmp_path / 'img.nii.gz')
+    image_cache = DecompressedImageCache(str(tmp_path / 'cache'), max_bytes=10 ** 6)
+    first = uncompressed_path(img_path, image_cache)
+
+    save_compressed(img_path, shape=(5, 6, 8))
+    second = uncompressed_path(img_path, image_cache)
+    assert second != first
+    assert np.array_equal(np.asanyarray(nib.load(second).dataobj),
+                          canonical_data(img_path))
+
+
+def test_least_recently_used_evicted(tmp_path):
+
+    paths = [save_compressed(tmp_path / 'img{}.nii.gz'.format(index), (20, 20, 20))
+             for index in range(3)]
+    image_cache = DecompressedImageCache(str(tmp_path / 'cache'), max_bytes=10 ** 6)
+    copies = list()
+    for index, img_path in enumerate(paths[:2]):
+        copies.append(uncompressed_path(img_path, image_cache))
+        os.utime(copies[-1], (index, index))
+    # using the first again
+    assert uncompressed_path(paths[0], image_cache) == copies[0]
+
+    # room for only two copies
+    image_cache.max_bytes = 2.5 * os.path.getsize(copies[0])
+    copies.append(uncompressed_path(paths[2], image_cache))
+    assert [os.path.exists(path) for path in copies] == [True, False, True]
+
+    # the copy just made is kept, even when over the budget
+    image_cache.max_bytes = 0
+    image_cache.evict(keep=copies[2])
+    assert [os.path.exists(path) for path in copies] == [False, False, True]
+
+
+def test_caches_independent(tmp_path):
+
+    img_path = save_compressed(tmp_path / 'img.nii.gz')
+    one = DecompressedImageCache(str(tmp_path / 'one'), max_bytes=10 ** 6)
+    two = DecompressedImageCache(str(tmp_path / 'two'), max_bytes=10 ** 6)
+    uncompressed_path(img_path, one)
+    assert len(os.listdir(one.cache_dir)) == 1
+    assert len(os.listdir(two.cache_dir)) == 0
+    # without a cache, nothing is read from, or left in, the other caches
+    assert uncompressed_path(img_path) == img_path
+
+
+def test_picklable_and_not_in_reader_key(tmp_path):
+
+    img_path = save_compressed(tmp_path / 'img.nii.gz')
+    image_cache = DecompressedImageCache(str(tmp_path / 'cache'), max_bytes=10 ** 6)
+    restored = pickle.loads(pickle.dumps(image_cache))
+    assert restored.cache_dir == image_cache.cache_dir
+    assert restored.max_bytes == image_cache.max_bytes
+    assert uncompressed_path(img_path, restored).startswith(image_cache.cache_dir)
+
+    assert reader_key(partial(read_image, img_path, image_cache=image_cache)) == \
+           reader_key(partial(read_image, img_path, image_cache=None))
+
+
+def test_temporary_copy_removed(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    img_path = save_compressed(tmp_path / 'img.nii.gz')
+    with uncompressed_copy(img_path) as copy_path:
+        assert copy_path.endswith('img.nii')
+        img = nib.load(copy_path)
+        assert np.array_equal(np.asanyarray(img.dataobj),
+                              np.asanyarray(nib.load(img_path).dataobj))
+        assert np.array_equal(img.affine, flipped_affine)
+    assert not os.path.exists(copy_path)
+    assert os.listdir(str(tmp_path)) == ['img.nii.gz']
+
+    # cached or uncompressed images are not copied
+    image_cache = DecompressedImageCache(str(tmp_path / 'cache'), max_bytes=10 ** 6)
+    with uncompressed_copy(img_path, image_cache) as copy_path:
+        assert copy_path == uncompressed_path(img_path, image_cache)
+    assert os.path.exists(copy_path)
+    with uncompressed_copy(copy_path) as same_path:
+        assert same_path == copy_path
@@ -0,0 +1,90 @@
+"""
+
+Checks the stats of 4D images against straightforward loops over frames,
+which they replaced.
+
+The benchmark against those loops is in test_benchmarks.
+
+"""
+
+import numpy as np
+
+from visualqc.image_stats import SelectedFrames, stats_over_frames
+from visualqc.tests.reference import loop_DVARS, loop_spatial_stats, random_run
+
+rng = np.random.default_rng(seed=42)
+
+
+def test_stats_match_loops():
+
+    img = random_run()
+    img[1, 2, 3, 4] = np.nan
+    # noise of different variance in each voxel, as well as the same everywhere
+    varying = np.asfortranarray(img * rng.uniform(0.1, 10, size=img.shape[:3] + (1, ))
+                                ).astype('float32')
+    for run in (img, varying):
+        for num_frames_per_chunk in (1, 5, 8, 100):
+            mean_img, stdev_img, mean_signal, stdev_signal, dvars = \
+                stats_over_frames(run, num_frames_per_chunk)
+            assert np.allclose(mean_img, np.mean(run, axis=3), equal_nan=True)
+            assert np.allclose(stdev_img, np.std(run, axis=3), equal_nan=True)
+            assert np.allclose((mean_signal, stdev_signal), loop_spatial_stats(run))
+            assert np.allclose(dvars, loop_DVARS(run), equal_nan=True)
+
+
+def test_DVARS_masked_and_standardized():
+
+    img = random_run()
+    # noise of different variance in each voxel
+    varying = np.asfortranarray(img * rng.uniform(0.1, 10, size=img.shape[:3] + (1, ))
+                                ).astype('float32')
+    mask = np.zeros(img.shape[:3], dtype=bool)
+    mask[2:7, 3:9, 1:5] = True
+    for run in (img, varying):
+        for num_frames_per_chunk in (1, 5, 8, 100):
+            for roi in (None, mask):
+                for standardize in (False, True):
+                    dvars = stats_over_frames(run, num_frames_per_chunk, mask=roi,
+                                              standardize_dvars=standardize)[-1]
+                    assert np.allclose(dvars, loop_DVARS(run, roi, standardize))
+
+        # white noise over time: expected to be close to 1
+        std_dvars = stats_over_frames(run, 4, standardize_dvars=True)[-1]
+        assert std_dvars[0] == 0
+        assert np.allclose(std_dvars[1:].mean(), 1, atol=0.05)
+
+
+def test_stats_precise_with_large_offset():
+
+    # long run with a large DC offset, relative to the noise
+    run = np.asfortranarray((1e5 + rng.standard_normal((4, 5, 6, 3000))).astype('float32'))
+    in_double = run.astype('float64')
+    mean_img, stdev_img, mean_signal, stdev_signal, dvars = stats_over_frames(run, 1000)
+    assert np.allclose(mean_img, in_double.mean(axis=3), rtol=0, atol=1e-6)
+    assert np.allclose(stdev_img, in_double.std(axis=3), rtol=1e-6, atol=0)
+    assert np.allclose(mean_signal, in_double.mean(axis=(0, 1, 2)), rtol=0, atol=1e-6)
+    assert np.allclose(stdev_signal, in_double.std(axis=(0, 1, 2)), rtol=1e-6, atol=0)
+
+
+def test_extrema():
+
+    img = random_run()
+    img[1, 2, 3, 4] = np.nan
+    for num_frames_per_chunk in (1, 5, 100):
+        stats = stats_over_frames(img, num_frames_per_chunk, extrema=True)
+        assert len(stats) == 7
+        assert np.allclose(stats[5], np.nanmin(img, axis=3))
+        assert np.allclose(stats[6], np.nanmax(img, axis=3))
+
+
+def test_selected_frames():
+
+    img = random_run()
+    frame_indices = [0, 1, 2, 5, 9, 10, 30]
+    selected = SelectedFrames(img, frame_indices)
+    assert selected.shape == img.shape[:3] + (len(frame_indices), )
+    assert np.array_equal(selected[:, :, :, 1:6], img[:, :, :, frame_indices[1:6]])
+    assert np.array_equal(selected[2, :, 3, ::2], img[:, :, :, frame_indices[::2]][2, :, 3])
+    assert np.array_equal(selected[:, :, :, 4], img[:, :, :, 9])
+    assert np.allclose(stats_over_frames(selected, 3)[-1],
+                       loop_DVARS(img[:, :, :, frame_indices]))
@@ -0,0 +1,119 @@
+"""
+
+Checks the remapping of labels in segmentations against the per-label loops
+they replaced, for integer and float labels, and their colors against matplotlib.
+
+"""
+
+import numpy as np
+
+from matplotlib import cm, colors
+
+from visualqc.utils import get_label_set, intensities_to_rgba, labels_to_rgba, \
+    read_image, remap_labels_1toN, rgba_lookup_table, void_subcortical_symmetrize_cortical
+
+rng = np.random.default_rng(seed=42)
+
+
+def _random_aseg(shape=(20, 21, 22)):
+
+    labels = np.array([0, 2, 4, 10, 17, 41, 53, 1000, 1003, 1035, 2000, 2003, 2035, 3005])
+    return labels[rng.integers(0, labels.size, size=shape)]
+
+
+def loop_remap_labels_1toN(in_seg, background=0):
+
+    out_seg = np.full_like(in_seg, background)
+    unique_labels = np.setdiff1d(np.unique(in_seg), background)
+    for index, label in enumerate(unique_labels):
+        out_seg[in_seg == label] = index + 1
+
+    return out_seg
+
+
+def loop_get_label_set(seg, label_set, background=0):
+
+    mask = np.full_like(seg, False, dtype=bool)
+    for label in label_set:
+        mask = np.logical_or(mask, seg == label)
+    masked_seg = np.full_like(seg, background)
+    masked_seg[mask] = seg[mask]
+
+    return loop_remap_labels_1toN(masked_seg, background)
+
+
+def loop_symmetrize_cortical(aseg, null_label=0):
+
+    symmetric_aseg = np.full_like(aseg, null_label)
+    left_ctx = np.logical_and(aseg >= 1000, aseg < 2000)
+    right_ctx = np.logical_and(aseg >= 2000, aseg < 3000)
+    symmetric_aseg[left_ctx] = aseg[left_ctx] - 1000
+    symmetric_aseg[right_ctx] = aseg[right_ctx] - 2000
+
+    return symmetric_aseg
+
+
+def test_remapping_matches_loops():
+
+    aseg = _random_aseg()
+    # float labels (as read before), and arbitrary ones needing a fallback
+    for seg in (aseg, aseg.astype('float32'), aseg - 7, aseg + 0.5):
+        remapped = remap_labels_1toN(seg)
+        assert np.array_equal(remapped, loop_remap_labels_1toN(seg))
+
+        label_set = np.array([2, 17, 53, 1003, 9999]) + (seg.flat[0] - aseg.flat[0])
+        selected, is_empty = get_label_set(seg, label_set)
+        assert np.array_equal(selected, loop_get_label_set(seg, label_set))
+        assert not is_empty
+
+        symmetric, _ = void_subcortical_symmetrize_cortical(seg)
+        assert np.array_equal(symmetric, loop_symmetrize_cortical(seg))
+
+
+def test_compact_dtype():
+
+    aseg = _random_aseg()
+    selected, _ = get_label_set(aseg.astype('float32'), [2, 17, 53])
+    assert selected.dtype == np.uint8
+    assert np.array_equal(np.unique(selected), [0, 1, 2, 3])
+
+    symmetric, _ = void_subcortical_symmetrize_cortical(aseg)
+    assert symmetric.dtype == np.uint8
+
+    _, is_empty = get_label_set(aseg, [9999])
+    assert is_empty
+
+
+def test_read_labels_in_integer_type():
+
+    aseg = _random_aseg()
+    for seg, dtype in ((aseg.astype('float32'), np.uint16), (aseg - 1007, np.int16),
+                       (np.minimum(aseg, 255), np.uint8)):
+        labels = read_image(seg, labels=True)
+        assert labels.dtype == dtype
+        assert np.array_equal(labels, seg)
+
+    # labels that are not whole numbers are left as they are
+    assert read_image(aseg + 0.5, labels=True).dtype == np.float64
+    assert read_image(aseg, labels=False).dtype == np.float32
+
+
+def test_colors_match_to_rgba():
+
+    mri_mapper = cm.ScalarMappable(norm=colors.Normalize(vmin=0, vmax=1, clip=True),
+                                   cmap='gray')
+    mri = np.append(rng.random(1000), [-0.5, 0, 1 / 256, 0.5, 1, 1.5])
+    mri = mri.astype('float32').reshape(-1, 2)
+    mri_lut = rgba_lookup_table(mri_mapper, alpha=0.8)
+    assert mri_lut.dtype == np.uint8
+    assert np.array_equal(intensities_to_rgba(mri, mri_lut, 0, 1),
+                          mri_mapper.to_rgba(mri, alpha=0.8, bytes=True))
+
+    num_labels = 5
+    seg_mapper = cm.ScalarMappable(norm=colors.Normalize(vmin=0, vmax=num_labels,
+                                                         clip=True), cmap='tab20')
+    seg = rng.integers(0, num_labels + 3, size=(30, 40)).astype('uint8')
+    seg_lut = rgba_lookup_table(seg_mapper, np.arange(num_labels + 1), alpha=0.7)
+    out = np.empty(seg.shape + (4, ), dtype='uint8')
+    labels_to_rgba(seg, seg_lut, out=out)
+    assert np.array_equal(out, seg_mapper.to_rgba(seg, alpha=0.7, bytes=True))
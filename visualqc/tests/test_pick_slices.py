@@ -0,0 +1,27 @@
+"""
+
+Checks the slices picked for display against the loop over slices they replaced.
+
+The benchmark against that loop is in test_benchmarks.
+
+"""
+
+import numpy as np
+
+from visualqc.tests.reference import loop_pick_slices, random_seg
+from visualqc.utils import pick_slices
+
+
+def test_slices_match_loop():
+
+    seg = random_seg()
+    for view_set in ((0, 1, 2), (2,), (1, 0)):
+        for num_slices in (1, 5, 12, 100):
+            assert pick_slices(seg, view_set, num_slices) == \
+                   loop_pick_slices(seg, view_set, num_slices)
+
+    # NaNs count as non-empty
+    seg[0, 0, 0] = np.nan
+    assert pick_slices(seg, (0, 1, 2), 12) == loop_pick_slices(seg, (0, 1, 2), 12)
+
+    assert pick_slices(np.zeros((5, 6, 7)), (0, 1, 2), 3) == list()
@@ -0,0 +1,117 @@
+"""
+
+Checks loading units in the background: reuse of scheduled loads, errors,
+and the memory budget, counting the units still loading.
+
+"""
+
+import threading
+
+import numpy as np
+import pytest
+
+from visualqc.prefetch import UnitPrefetcher
+
+unit_bytes = 1000 * 8
+
+
+class Readers(object):
+    """Readers returning an array of fixed size per unit, blocked until released."""
+
+
+    def __init__(self, fail=()):
+
+        self.started = list()
+        self.release = threading.Event()
+        self.fail = fail
+
+
+    def __call__(self, unit_id):
+
+        def read():
+            self.started.append(unit_id)
+            self.release.wait(timeout=10)
+            if unit_id in self.fail:
+                raise ValueError('unable to read {}'.format(unit_id))
+            return dict(data=np.zeros(unit_bytes // 8), unit_id=unit_id)
+
+        return read
+
+
+def make_prefetcher(readers, depth=3, max_memory=10 * unit_bytes):
+
+    prefetcher = UnitPrefetcher(readers, depth=depth, max_memory=max_memory)
+    # size of units is learnt from the first one read
+    readers.release.set()
+    prefetcher.get('first')
+    readers.release.clear()
+    readers.started.clear()
+
+    return prefetcher
+
+
+def test_scheduled_reused():
+
+    readers = Readers()
+    prefetcher = make_prefetcher(readers)
+    prefetcher.schedule(['a', 'b', 'c', 'd'])
+    prefetcher.schedule(['a', 'b', 'c', 'd'])
+    readers.release.set()
+    assert [prefetcher.get(unit_id)['unit_id'] for unit_id in 'abcd'] == list('abcd')
+    # beyond the depth, read on demand
+    assert sorted(readers.started) == list('abcd')
+    prefetcher.shutdown()
+
+
+def test_errors_raised_on_get():
+
+    readers = Readers(fail=('b', ))
+    prefetcher = make_prefetcher(readers)
+    prefetcher.schedule(['a', 'b'])
+    readers.release.set()
+    assert prefetcher.get('a')['unit_id'] == 'a'
+    with pytest.raises(ValueError):
+        prefetcher.get('b')
+    prefetcher.shutdown()
+
+
+def test_loading_units_counted():
+
+    readers = Readers()
+    prefetcher = make_prefetcher(readers, max_memory=int(2.5 * unit_bytes))
+    # none loaded yet, all still loading
+    prefetcher.schedule(['a', 'b', 'c'])
+    assert prefetcher.memory_in_use() == 2 * unit_bytes
+    prefetcher.schedule(['a', 'b', 'c'])
+    assert len(prefetcher._pending) == 2
+
+    readers.release.set()
+    prefetcher.get('a')
+    prefetcher.schedule(['b', 'c'])
+    assert len(prefetcher._pending) == 2
+    prefetcher.shutdown()
+
+
+def test_one_at_a_time_until_size_known():
+
+    readers = Readers()
+    prefetcher = UnitPrefetcher(readers, depth=3, max_memory=10 * unit_bytes)
+    prefetcher.schedule(['a', 'b', 'c'])
+    assert list(prefetcher._pending) == ['a']
+
+    readers.release.set()
+    prefetcher._pending['a'].result()
+    prefetcher.schedule(['a', 'b', 'c'])
+    assert list(prefetcher._pending) == ['a', 'b', 'c']
+    prefetcher.shutdown()
+
+
+def test_disabled():
+
+    readers = Readers()
+    readers.release.set()
+    prefetcher = UnitPrefetcher(readers, depth=0)
+    prefetcher.schedule(['a', 'b'])
+    assert readers.started == []
+    assert prefetcher.get('a')['unit_id'] == 'a'
+    prefetcher.shutdown()
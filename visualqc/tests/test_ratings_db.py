@@ -0,0 +1,75 @@
+"""
+
+Checks the SQLite store of ratings: saving, replacing, loading per reviewer,
+summaries and export to CSV.
+
+"""
+
+from os.path import join as pjoin
+
+from visualqc.ratings_db import RatingsDatabase
+from visualqc.utils import load_ratings_csv, summarize_ratings
+
+
+def test_save_replace_load(tmp_path):
+
+    db_path = str(tmp_path / 'ratings.db')
+    db = RatingsDatabase(db_path, reviewer='one')
+    db.save('sub01', 'Pass', 'fine')
+    db.save('sub02', ['Fail', 'Motion'], 'notes, with commas')
+    db.save('sub01', 'Fail+Artefact', 'changed my mind')
+    db.close()
+
+    # persisted, and the last rating kept
+    db = RatingsDatabase(db_path, reviewer='one')
+    ratings, notes = db.load()
+    assert ratings == {'sub01': 'Fail+Artefact', 'sub02': 'Fail+Motion'}
+    assert notes == {'sub01': 'changed my mind', 'sub02': 'notes, with commas'}
+    db.close()
+
+
+def test_reviewers_separate(tmp_path):
+
+    db_path = str(tmp_path / 'ratings.db')
+    one = RatingsDatabase(db_path, reviewer='one')
+    two = RatingsDatabase(db_path, reviewer='two')
+    one.save('sub01', 'Pass', '')
+    two.save('sub01', 'Fail', '')
+    two.save('sub02', 'Pass', '')
+
+    assert one.load()[0] == {'sub01': 'Pass'}
+    assert two.load()[0] == {'sub01': 'Fail', 'sub02': 'Pass'}
+    one.close()
+    two.close()
+
+
+def test_summary_matches_csv(tmp_path):
+
+    db = RatingsDatabase(str(tmp_path / 'ratings.db'), reviewer='one')
+    for unit_id, rating in (('sub01', 'Pass'), ('sub02', 'Fail+Motion'),
+                            ('sub03', 'Fail'), ('sub02', 'Fail+Skull strip')):
+        db.save(unit_id, rating, 'note for {}'.format(unit_id))
+
+    db_dir = tmp_path / 'db'
+    db_dir.mkdir()
+    counter, id_lists = db.summarize(str(db_dir))
+    assert counter == {'fail': 2, 'pass': 1, 'skull_strip': 1}
+    assert sorted(id_lists['fail']) == ['sub02', 'sub03']
+    with open(pjoin(str(db_dir), 'id_list_rating_skull_strip.txt')) as lf:
+        assert lf.read() == 'sub02'
+
+    csv_path = str(tmp_path / 'ratings.csv')
+    db.export_csv(csv_path)
+    assert load_ratings_csv(csv_path) == db.load()
+    csv_counter, csv_id_lists = summarize_ratings(csv_path)
+    assert csv_counter == counter
+    assert {label: sorted(ids) for label, ids in csv_id_lists.items()} == \
+           {label: sorted(ids) for label, ids in id_lists.items()}
+    db.close()
+
+
+def test_summary_empty(tmp_path):
+
+    db = RatingsDatabase(str(tmp_path / 'ratings.db'), reviewer='one')
+    assert db.summarize() == (dict(), dict())
+    db.close()
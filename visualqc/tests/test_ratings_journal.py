@@ -0,0 +1,116 @@
+"""
+
+Checks ratings recorded to the journal are recovered after a crash,
+merged into the ratings file, and the journal compacted.
+
+"""
+
+from visualqc import config as cfg
+from visualqc.utils import append_to_ratings_journal, get_ratings_journal_path, \
+    get_ratings_path_info, load_ratings_csv, replay_ratings_journal
+from visualqc.workflows import BaseWorkflowVisualQC
+
+
+class JournalWorkflow(BaseWorkflowVisualQC):
+    """Workflow without any UI, to record and restore ratings only."""
+
+
+    def __init__(self, out_dir, id_list):
+
+        super().__init__(id_list, out_dir, out_dir, None, None, None, True,
+                         ratings_backend='csv')
+        self.vis_type = 'test'
+        self.suffix = 'journal'
+
+
+    def preprocess(self): pass
+
+    def prepare_UI(self): pass
+
+    def load_unit(self, unit_id): pass
+
+    def get_unit_reader(self, unit_id): pass
+
+    def display_unit(self): pass
+
+    def add_alerts(self): pass
+
+    def cleanup(self): pass
+
+
+def rate(workflow, unit_id, rating, note):
+
+    workflow.ratings[unit_id] = rating
+    workflow.notes[unit_id] = note
+    workflow.record_rating(unit_id)
+
+
+def test_replay_skips_partial_line(tmp_path):
+
+    journal_file = str(tmp_path / 'ratings.journal')
+    with open(journal_file, 'w') as journal:
+        append_to_ratings_journal(journal, 'sub01', 'Pass', 'fine')
+        append_to_ratings_journal(journal, 'sub02', 'Fail+Motion', 'notes, with commas')
+        append_to_ratings_journal(journal, 'sub01', 'Fail', 'changed my mind')
+        # crashed while writing the last one
+        journal.write('sub03,Pa')
+
+    ratings, notes = {'sub00': 'Pass'}, {'sub00': ''}
+    assert replay_ratings_journal(journal_file, ratings, notes) == 3
+    assert ratings == {'sub00': 'Pass', 'sub01': 'Fail', 'sub02': 'Fail+Motion'}
+    assert notes['sub01'] == 'changed my mind'
+    assert notes['sub02'] == 'notes, with commas'
+
+    assert replay_ratings_journal(str(tmp_path / 'missing'), ratings, notes) == 0
+
+
+def test_recovered_and_compacted_after_crash(tmp_path):
+
+    out_dir = str(tmp_path)
+    id_list = ['sub{:02d}'.format(ix) for ix in range(5)]
+    workflow = JournalWorkflow(out_dir, id_list)
+    workflow.restore_ratings()
+    rate(workflow, 'sub00', 'Pass', 'first')
+    workflow.compact_ratings()
+    rate(workflow, 'sub01', 'Fail', 'second')
+    rate(workflow, 'sub02', 'Pass', '')
+    # crashed, without saving: ratings file has only the first
+    ratings_file, _ = get_ratings_path_info(workflow)
+    assert list(load_ratings_csv(ratings_file)[0]) == ['sub00']
+
+    restored = JournalWorkflow(out_dir, id_list)
+    restored.restore_ratings()
+    assert restored.ratings == {'sub00': 'Pass', 'sub01': 'Fail', 'sub02': 'Pass'}
+    assert restored.notes['sub01'] == 'second'
+    assert restored.incomplete_list == ['sub03', 'sub04']
+
+    # merged into the ratings file, and the journal started afresh
+    assert load_ratings_csv(ratings_file)[0] == restored.ratings
+    with open(get_ratings_journal_path(restored)) as journal:
+        assert journal.read() == ''
+    restored.ratings_journal.close()
+
+
+def test_compacted_periodically(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(cfg, 'num_ratings_between_compaction', 2)
+    id_list = ['sub{:02d}'.format(ix) for ix in range(5)]
+    workflow = JournalWorkflow(str(tmp_path), id_list)
+    workflow.restore_ratings()
+    ratings_file, _ = get_ratings_path_info(workflow)
+
+    rate(workflow, 'sub00', 'Pass', '')
+    assert workflow.num_ratings_journaled == 1
+    rate(workflow, 'sub01', 'Fail', '')
+    assert workflow.num_ratings_journaled == 0
+    assert sorted(load_ratings_csv(ratings_file)[0]) == ['sub00', 'sub01']
+    with open(get_ratings_journal_path(workflow)) as journal:
+        assert journal.read() == ''
+
+    # compacted ratings are not lost, nor replayed again
+    rate(workflow, 'sub02', 'Pass', '')
+    workflow.ratings_journal.close()
+    restored = JournalWorkflow(str(tmp_path), id_list)
+    restored.restore_ratings()
+    assert sorted(restored.ratings) == ['sub00', 'sub01', 'sub02']
+    restored.ratings_journal.close()
@@ -0,0 +1,59 @@
+"""
+
+Checks reading images via a proxy against loading them fully.
+
+"""
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from visualqc.utils import read_image
+
+rng = np.random.default_rng(seed=7)
+
+# axes permuted and flipped, relative to the canonical (RAS) orientation
+oblique_affine = np.array([[0, 0, -2, 10],
+                           [1, 0, 0, -5],
+                           [0, -3, 0, 7],
+                           [0, 0, 0, 1]], dtype=float)
+
+
+def save_image(tmp_path, shape, name='img.nii'):
+
+    data = rng.uniform(1, 100, size=shape).astype('float32')
+    path = str(tmp_path / name)
+    nib.save(nib.Nifti1Image(data, oblique_affine), path)
+
+    return path
+
+
+def test_proxy_matches_canonical(tmp_path):
+
+    path = save_image(tmp_path, (6, 7, 8, 5))
+    canonical = np.asanyarray(nib.as_closest_canonical(nib.load(path)).dataobj)
+    proxy = read_image(path, num_dims=4, proxy=True)
+    assert proxy.shape == canonical.shape
+    assert np.array_equal(proxy[:, :, :, 1:4], canonical[:, :, :, 1:4])
+    assert np.array_equal(proxy[2, :, 1:5:2], canonical[2, :, 1:5:2])
+    assert np.array_equal(proxy[:, -1, :, 0], canonical[:, -1, :, 0])
+
+
+def test_proxy_single_volume_as_3d(tmp_path):
+
+    path = save_image(tmp_path, (6, 7, 8, 1))
+    canonical = np.asanyarray(nib.as_closest_canonical(nib.load(path)).dataobj)
+    proxy = read_image(path, proxy=True)
+    assert proxy.shape == canonical.shape[:3]
+    assert np.array_equal(proxy[:, 3, :], canonical[:, 3, :, 0])
+
+
+def test_proxy_dims_checked(tmp_path):
+
+    path_4d = save_image(tmp_path, (6, 7, 8, 5), 'four.nii')
+    path_3d = save_image(tmp_path, (6, 7, 8), 'three.nii')
+    for path, num_dims in ((path_4d, 3), (path_3d, 4)):
+        with pytest.raises(ValueError):
+            read_image(path, num_dims=num_dims)
+        with pytest.raises(ValueError):
+            read_image(path, num_dims=num_dims, proxy=True)
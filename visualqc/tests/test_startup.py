@@ -0,0 +1,67 @@
+"""
+
+Checks the command line interfaces start quickly, and do not import the
+libraries needed only for optional steps (outlier detection, signal cleaning,
+BIDS input etc) at startup.
+
+"""
+
+import subprocess
+import sys
+import time
+
+import pytest
+
+# seconds, including the interpreter startup and importing matplotlib and mrivis
+startup_budget = 3.0
+
+entry_points = ('__t1_mri__', '__func_mri__', '__diffusion__',
+                '__freesurfer__', '__defacing__', '__alignment__')
+
+libraries_imported_on_demand = ('sklearn', 'nilearn', 'bids',
+                                'scipy.stats', 'scipy.signal')
+
+
+def _modules_imported_by(module):
+
+    out = subprocess.run([sys.executable, '-c',
+                          'import sys, {}; print(" ".join(sys.modules))'
+                          ''.format(module)],
+                         check=True, stdout=subprocess.PIPE, universal_newlines=True)
+
+    return set(out.stdout.split())
+
+
+@pytest.mark.parametrize('module', ('visualqc', ) +
+                         tuple('visualqc.{}'.format(ep) for ep in entry_points))
+def test_heavy_libraries_imported_on_demand(module):
+
+    imported = _modules_imported_by(module)
+    assert not imported.intersection(libraries_imported_on_demand)
+
+
+@pytest.mark.parametrize('entry_point', entry_points)
+def test_help_within_budget(entry_point):
+
+    start = time.perf_counter()
+    out = subprocess.run([sys.executable, '-m', 'visualqc.{}'.format(entry_point),
+                          '--help'],
+                         stdout=subprocess.PIPE, universal_newlines=True)
+    elapsed = time.perf_counter() - start
+
+    assert 'usage' in out.stdout
+    assert elapsed < startup_budget
+
+
+def test_public_functions_available():
+
+    import visualqc
+    for name in visualqc._lazy_attributes:
+        assert callable(getattr(visualqc, name))
+
+    # imported eagerly where module-level __getattr__ is not supported (< 3.7)
+    out = subprocess.run([sys.executable, '-c',
+                          'import sys; sys.version_info = (3, 6); import visualqc; '
+                          'print(" ".join(sorted(vars(visualqc))))'],
+                         check=True, stdout=subprocess.PIPE, universal_newlines=True)
+    assert set(visualqc._lazy_attributes).issubset(out.stdout.split())
@@ -0,0 +1,137 @@
+"""
+
+Checks the on-disk cache of the data prepared for each unit: reuse,
+invalidation when inputs change, eviction and read-only memory-mapped hits.
+
+"""
+
+import os
+from functools import partial
+
+import numpy as np
+import pytest
+
+from visualqc.cache import UnitDataCache
+
+calls = list()
+
+
+def read_unit(in_path, scale=1.0, num_items=100):
+    """Reader counting its calls, returning the data derived from a file."""
+
+    calls.append(in_path)
+    with open(in_path) as in_file:
+        value = float(in_file.read())
+
+    return dict(values=scale * value * np.arange(num_items, dtype='float64'),
+                pieces=[np.full(3, value), np.zeros((2, 2))],
+                name=os.path.basename(in_path), is_empty=False)
+
+
+def write_input(path, value):
+
+    with open(str(path), 'w') as out_file:
+        out_file.write(str(value))
+
+    return str(path)
+
+
+@pytest.fixture(autouse=True)
+def reset_calls():
+
+    calls.clear()
+
+
+def test_hit_after_miss(tmp_path):
+
+    in_path = write_input(tmp_path / 'unit.txt', 2)
+    cache = UnitDataCache(str(tmp_path / 'cache'), max_bytes=10 ** 6)
+    reader = partial(read_unit, in_path)
+    assert cache.get(reader) is None
+
+    first = cache.read(reader)
+    second = cache.read(reader)
+    assert len(calls) == 1
+    assert np.array_equal(second['values'], first['values'])
+    assert all(np.array_equal(one, two) for one, two in zip(first['pieces'],
+                                                            second['pieces']))
+    assert second['name'] == 'unit.txt'
+    assert second['is_empty'] is False
+
+    # persists across sessions
+    assert UnitDataCache(cache.cache_dir).get(reader) is not None
+    assert len(calls) == 1
+
+
+def test_hit_is_read_only_memmap(tmp_path):
+
+    in_path = write_input(tmp_path / 'unit.txt', 3)
+    cache = UnitDataCache(str(tmp_path / 'cache'), max_bytes=10 ** 6)
+    reader = partial(read_unit, in_path)
+    cache.read(reader)
+
+    unit_data = cache.get(reader)
+    for array in [unit_data['values'], ] + unit_data['pieces']:
+        assert isinstance(array, np.memmap)
+        assert not array.flags.writeable
+        with pytest.raises(ValueError):
+            array[0] = 0
+
+
+def test_changed_input_invalidates(tmp_path):
+
+    in_path = write_input(tmp_path / 'unit.txt', 2)
+    cache = UnitDataCache(str(tmp_path / 'cache'), max_bytes=10 ** 6)
+    reader = partial(read_unit, in_path)
+    cache.read(reader)
+
+    # same size, newer modification time
+    write_input(in_path, 5)
+    stat = os.stat(in_path)
+    os.utime(in_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert cache.get(reader) is None
+    assert cache.read(reader)['values'][1] == 5
+
+    # different size, same modification time
+    stat = os.stat(in_path)
+    write_input(in_path, 50)
+    os.utime(in_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert cache.get(reader) is None
+    assert cache.read(reader)['values'][1] == 50
+    assert len(calls) == 3
+
+
+def test_changed_params_invalidate(tmp_path):
+
+    in_path = write_input(tmp_path / 'unit.txt', 2)
+    cache = UnitDataCache(str(tmp_path / 'cache'), max_bytes=10 ** 6)
+    cache.read(partial(read_unit, in_path, scale=1.0))
+    assert cache.get(partial(read_unit, in_path, scale=2.0)) is None
+    assert cache.get(partial(read_unit, in_path, scale=1.0)) is not None
+
+
+def test_least_recently_used_evicted(tmp_path):
+
+    readers = [partial(read_unit, write_input(tmp_path / 'unit{}.txt'.format(index),
+                                              index + 1), num_items=10000)
+               for index in range(3)]
+    cache = UnitDataCache(str(tmp_path / 'cache'), max_bytes=10 ** 6)
+    for reader in readers[:2]:
+        cache.read(reader)
+    # using the first again
+    cache.get(readers[0])
+
+    # room for only two entries
+    entry_size = sum(entry.stat().st_size
+                     for entry in os.scandir(cache.entry_path(readers[0])))
+    cache.max_bytes = 2.5 * entry_size
+    cache.read(readers[2])
+    assert [os.path.exists(cache.entry_path(reader)) for reader in readers] == \
+           [True, False, True]
+
+    # the order of last use persists across sessions
+    cache.get(readers[0])
+    reopened = UnitDataCache(cache.cache_dir, max_bytes=1.5 * entry_size)
+    reopened.evict()
+    assert [os.path.exists(cache.entry_path(reader)) for reader in readers] == \
+           [True, False, False]
@@ -0,0 +1,133 @@
+"""
+
+Module to record the time spent (and memory used) in different stages of the review,
+to find out where reviewers are waiting.
+
+"""
+
+import json
+import sys
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+import numpy as np
+
+from visualqc import config as cfg
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+class StageTimer(object):
+    """
+    Records the wall time and peak memory (resident set size) for each stage
+    of the review e.g. loading or displaying a unit, per unit.
+
+    Records are kept in memory for the summary at the end, and are also written
+    to a log (JSON lines, one record per stage per unit), once it is opened.
+
+    """
+
+
+    def __init__(self):
+        """Constructor"""
+
+        self.records = list()
+        self._log = None
+
+
+    def open_log(self, log_path):
+        """Starts writing the records to the given file (appending to it)."""
+
+        self.close()
+        self._log = open(log_path, 'a')
+
+
+    @contextmanager
+    def stage(self, name, unit_id=None):
+        """Context manager to time the code block within, as the given stage."""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record = dict(stage=name,
+                          unit_id=unit_id,
+                          wall_time=time.perf_counter() - start,
+                          peak_rss_mb=peak_rss_mb(),
+                          timestamp=time.time())
+            self.records.append(record)
+            if self._log is not None:
+                self._log.write('{}\n'.format(json.dumps(record)))
+                self._log.flush()
+
+
+    def durations(self, name):
+        """Wall times recorded so far for a given stage."""
+
+        return np.array([rec['wall_time'] for rec in self.records
+                         if rec['stage'] == name])
+
+
+    def summarize(self):
+        """Prints the latency of loading units, and time spent computing vs waiting."""
+
+        if len(self.records) < 1:
+            return
+
+        print('\nTime spent (seconds) in different stages of the review:')
+        load_times = self.durations('load_unit')
+        if len(load_times) > 0:
+            print('\tloading a unit : p50 {:.3f}, p95 {:.3f}, max {:.3f} (n={})'
+                  ''.format(np.percentile(load_times, 50),
+                            np.percentile(load_times, 95),
+                            load_times.max(), len(load_times)))
+
+        wait_time = self.durations(cfg.stage_waiting_for_reviewer).sum()
+        compute_time = sum(rec['wall_time'] for rec in self.records
+                           if rec['stage'] != cfg.stage_waiting_for_reviewer)
+        print('\tcomputing : {:.1f}, waiting for the reviewer : {:.1f}'
+              ''.format(compute_time, wait_time))
+        print('\tpeak memory used : {:.0f} MB'
+              ''.format(max(rec['peak_rss_mb'] or 0 for rec in self.records)))
+
+
+    def close(self):
+        """Closes the log, if open."""
+
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+
+def timed_stage(name):
+    """Decorator to time a method of a workflow as the given stage."""
+
+    def decorator(method):
+
+        @wraps(method)
+        def timed_method(self, *args, **kwargs):
+            with self.timer.stage(name):
+                return method(self, *args, **kwargs)
+
+        return timed_method
+
+    return decorator
+
+
+def peak_rss_mb():
+    """Peak resident set size of the current process so far, in MB."""
+
+    if resource is None:
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # in bytes on Mac OS, and kilobytes on Linux
+    if sys.platform == 'darwin':
+        return max_rss / 1024 ** 2
+
+    return max_rss / 1024
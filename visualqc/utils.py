@@ -9,7 +9,6 @@ from os.path import realpath
 from os import makedirs
 from shutil import copyfile, which
 
-import nibabel as nib
 import numpy as np
 from os.path import basename, join as pjoin, realpath, splitext
 from pathlib import Path
@@ -21,16 +20,44 @@ from visualqc.config import default_out_dir_name, freesurfer_vis_cmd, \
 def read_image(img_spec,
                error_msg='image',
                num_dims=3,
-               reorient_canonical=True):
-    """Image reader. Removes stray values close to zero (smaller than 5 %ile)."""
+               reorient_canonical=True,
+               proxy=False,
+               labels=False,
+               image_cache=None):
+    """
+    Image reader. Removes stray values close to zero (smaller than 5 %ile).
+
+    When proxy=True, returns an ImageProxy instead, which reads only the parts
+    of the image that are accessed (by indexing or slicing) from the disk.
+    Its dims are checked from the header, but not whether it is empty.
+
+    When labels=True, the image is a segmentation, and is returned in the
+    smallest integer type holding its labels, instead of float32.
+
+    Compressed images are read from their uncompressed copies in the given
+    image_cache (a DecompressedImageCache), if any.
+    """
 
     if isinstance(img_spec, str):
         if pexists(realpath(img_spec)):
-            hdr = nib.load(img_spec)
+            import nibabel as nib
+            from visualqc.cache import uncompressed_path
+            if proxy:
+                # keeping compressed files open, to not decompress them again
+                #   from the start for each part read
+                hdr = nib.load(uncompressed_path(img_spec, image_cache),
+                               keep_file_open=True)
+                # dims are checked from the header, as the data is not read yet
+                check_num_dims(hdr.shape, num_dims)
+                return ImageProxy(hdr, reorient_canonical=reorient_canonical,
+                                  num_dims=num_dims)
+            hdr = nib.load(uncompressed_path(img_spec, image_cache))
+            # memory-mapped when uncompressed, without copying
+            img = np.asanyarray(hdr.dataobj)
             # trying to stick to an orientation
             if reorient_canonical:
-                hdr = nib.as_closest_canonical(hdr)
-            img = hdr.get_data()
+                # flips and transposes are views, instead of a copy of the data
+                img = nib.apply_orientation(img, nib.io_orientation(hdr.affine))
         else:
             raise IOError('Given path to {} does not exist!\n\t{}'
                           ''.format(error_msg, img_spec))
@@ -48,12 +75,95 @@ def read_image(img_spec,
     else:
         raise ValueError('Requested check for {} dims - allowed: 3 or 4!')
 
+    if labels:
+        img = compact_labels(img)
+        if np.issubdtype(img.dtype, np.integer):
+            return img
+
     if not np.issubdtype(img.dtype, np.float64):
         img = img.astype('float32')
 
     return img
 
 
+class ImageProxy(object):
+    """
+    Image on disk, indexed in the closest canonical orientation (if requested)
+    like a numpy array, reading only the slices accessed.
+
+    Reorientation is mapped to flips and transposes of the indices into the
+    image on disk, so the full image is never loaded. Trailing dims beyond
+    num_dims (e.g. a single volume in 4D) are dropped.
+
+    """
+
+
+    def __init__(self, nib_image, reorient_canonical=True, num_dims=None):
+        """Constructor"""
+
+        import nibabel as nib
+
+        self.dataobj = nib_image.dataobj
+        self.header = nib_image.header
+        shape_on_disk = self.dataobj.shape
+        self._shape_on_disk = shape_on_disk
+        num_spatial = min(3, len(shape_on_disk))
+        if reorient_canonical:
+            ornt = nib.io_orientation(nib_image.affine)[:num_spatial]
+        else:
+            ornt = np.column_stack((np.arange(num_spatial), np.ones(num_spatial)))
+        # axis on disk for each axis in canonical orientation
+        self._disk_axis = list(np.argsort(ornt[:, 0])) + \
+                          list(range(num_spatial, len(shape_on_disk)))
+        self._flipped = [ax < num_spatial and ornt[ax, 1] < 0
+                         for ax in range(len(shape_on_disk))]
+        self.shape = tuple(shape_on_disk[ax] for ax in self._disk_axis)[:num_dims]
+        self.ndim = len(self.shape)
+        self.dtype = np.dtype('float32')
+
+
+    def __getitem__(self, index):
+        """Reads the data for the given index (ints and slices only)."""
+
+        if not isinstance(index, tuple):
+            index = (index, )
+        index = index + (slice(None), ) * (self.ndim - len(index))
+        # the only element along the dims dropped
+        index = index + (0, ) * (len(self._shape_on_disk) - self.ndim)
+
+        disk_index = [slice(None)] * len(self._shape_on_disk)
+        for axis, idx in enumerate(index):
+            disk_axis = self._disk_axis[axis]
+            size = self._shape_on_disk[disk_axis]
+            if self._flipped[disk_axis]:
+                if isinstance(idx, slice):
+                    positions = range(*idx.indices(size))
+                    start = size - 1 - positions.start
+                    stop = size - 1 - positions.stop
+                    idx = slice(start, stop if stop >= 0 else None, -positions.step)
+                else:
+                    idx = size - 1 - (idx % size)
+            disk_index[disk_axis] = idx
+
+        data = self.dataobj[tuple(disk_index)]
+        # axes remaining after indexing, ordered as on disk
+        kept = [self._disk_axis[axis] for axis, idx in enumerate(index)
+                if isinstance(idx, slice)]
+        data = data.transpose(np.argsort(np.argsort(kept)))
+
+        return data.astype('float32')
+
+
+    def sample(self, max_voxels=cfg.max_num_voxels_intensity_sample):
+        """A regular sample of voxels across the image (flattened)."""
+
+        step = int(np.ceil((np.prod(self.shape) / max_voxels) ** (1 / self.ndim)))
+        if step <= 1:
+            return self[(slice(None), ) * self.ndim].flatten()
+
+        return self[(slice(None, None, step), ) * self.ndim].flatten()
+
+
 def scale_0to1(image_in,
                exclude_outliers_below=False,
                exclude_outliers_above=False
@@ -106,22 +216,54 @@ def saturate_brighter_intensities(img,
     return saturated
 
 
+def rgba_lookup_table(mapper, values=None, alpha=None):
+    """
+    Colors (uint8 RGBA) of a ScalarMappable, for each of the given values,
+    or for each color of its colormap if values are not given.
+    """
+
+    if values is None:
+        return mapper.cmap(np.arange(mapper.cmap.N), alpha=alpha, bytes=True)
+
+    return mapper.to_rgba(values, alpha=alpha, bytes=True)
+
+
+def intensities_to_rgba(img, lut, vmin, vmax, out=None):
+    """
+    Maps intensities to the colors in a lookup table (one per color of the
+    colormap), clipping them to [vmin, vmax], just as a ScalarMappable would.
+    """
+
+    index = np.multiply(np.subtract(img, vmin, dtype='float32'),
+                        lut.shape[0] / (vmax - vmin))
+    np.floor(index, out=index)
+
+    return np.take(lut, index.astype(np.intp), axis=0, mode='clip', out=out)
+
+
+def labels_to_rgba(seg, lut, out=None):
+    """
+    Maps labels to the colors in a lookup table indexed by label,
+    and labels beyond the table to its last color.
+    """
+
+    if not np.issubdtype(seg.dtype, np.integer):
+        seg = seg.astype(np.intp)
+
+    return np.take(lut, seg, axis=0, mode='clip', out=out)
+
+
 def get_label_set(seg, label_set, background=cfg.background_value):
     """Extracts only the required labels, and remaps the labels from 1 to n"""
 
     if label_set is None:
         out_seg = seg
     else:
-        # get the mask picking up all labels
-        mask = np.full_like(seg, False)
-        for label in label_set:
-            mask = np.logical_or(mask, seg == label)
-
-        masked_seg = np.full_like(seg, background)
-        masked_seg[mask] = seg[mask]
-
-        # remap labels from arbitrary range to 1:N
-        out_seg = remap_labels_1toN(masked_seg, background)
+        # labels present, other than background, are remapped to 1:N in one pass
+        seg = _as_integer_labels(seg)
+        present = np.intersect1d(unique_labels(seg), label_set)
+        present = np.setdiff1d(present, background)
+        out_seg = relabel(seg, present, np.arange(1, present.size + 1), background)
 
     roi_set_empty = False
     if np.count_nonzero(out_seg) < 1:
@@ -133,18 +275,117 @@ def get_label_set(seg, label_set, background=cfg.background_value):
 def remap_labels_1toN(in_seg, background=cfg.background_value):
     """Remap [arbitrary] labels in a volumetric seg to range from 1 to N."""
 
-    out_seg = np.full_like(in_seg, background)
-
     # remap labels from arbitrary range to 1:N
     # helps to facilitate distinguishable colors
-    unique_labels = np.unique(in_seg.flatten())
     # removing background - 0 stays 0
-    unique_labels = np.setdiff1d(unique_labels, background)
-    for index, label in enumerate(unique_labels):
-        # index=0 would make it background, so using index+1
-        out_seg[in_seg == label] = index + 1
+    in_seg = _as_integer_labels(in_seg)
+    labels = np.setdiff1d(unique_labels(in_seg), background)
+
+    # index=0 would make it background, so using index+1
+    return relabel(in_seg, labels, np.arange(1, labels.size + 1), background)
+
+
+def unique_labels(seg):
+    """Sorted unique labels in a segmentation, counted in a single pass if possible."""
+
+    int_seg = _as_lookup_index(seg)
+    if int_seg is not None:
+        is_present = np.zeros(int_seg.max(initial=0) + 1, dtype=bool)
+        is_present[int_seg] = True
+        return np.flatnonzero(is_present).astype(seg.dtype)
+
+    return np.unique(seg)
+
+
+def relabel(seg, labels, new_labels, background=cfg.background_value):
+    """
+    Maps the given labels in a segmentation to new labels, and everything else
+    to background, in a single pass over the voxels.
+
+    The output is of the smallest integer type holding all the new labels.
+    """
+
+    labels = np.asarray(labels)
+    new_labels = np.asarray(new_labels)
+    if not np.issubdtype(new_labels.dtype, np.integer) and \
+            np.array_equal(new_labels, np.around(new_labels)):
+        new_labels = new_labels.astype('int64')
+    if np.issubdtype(new_labels.dtype, np.integer):
+        out_dtype = np.result_type(np.min_scalar_type(background), *[
+            np.min_scalar_type(val) for val in (new_labels.min(initial=0),
+                                                new_labels.max(initial=0))])
+    else:
+        out_dtype = new_labels.dtype
+
+    int_seg = _as_lookup_index(seg)
+    if int_seg is not None:
+        lut = np.full(int_seg.max(initial=0) + 1, background, dtype=out_dtype)
+        in_range = np.logical_and(labels >= 0, labels < lut.size)
+        lut[labels[in_range].astype('int64')] = new_labels[in_range]
+        return lut[int_seg]
+
+    # arbitrary labels: via the index of each voxel into the sorted unique labels
+    present, index_into_present = np.unique(seg, return_inverse=True)
+    lut = np.full(present.size, background, dtype=out_dtype)
+    if present.size > 0:
+        position = np.searchsorted(present, labels).clip(max=present.size - 1)
+        found = present[position] == labels
+        lut[position[found]] = new_labels[found]
+
+    return lut[index_into_present].reshape(seg.shape)
+
+
+def compact_labels(seg):
+    """
+    Segmentation in the smallest integer type holding its labels, as long as
+    they are all whole numbers. Returned as it is otherwise.
+    """
+
+    if seg.size < 1 or not (np.issubdtype(seg.dtype, np.integer) or
+                            np.issubdtype(seg.dtype, np.floating)):
+        return seg
+
+    min_label, max_label = seg.min(), seg.max()
+    if not (np.isfinite(min_label) and np.isfinite(max_label)):
+        return seg
+
+    min_label, max_label = int(np.floor(min_label)), int(np.ceil(max_label))
+    if min_label < 0:
+        # signed, and wide enough for the largest label as well
+        compact_dtype = np.result_type(np.min_scalar_type(min_label),
+                                       np.min_scalar_type(-max_label - 1))
+    else:
+        compact_dtype = np.min_scalar_type(max_label)
+    int_seg = seg.astype(compact_dtype, copy=False)
+    # float labels are accepted as long as they are whole numbers
+    if np.issubdtype(seg.dtype, np.floating) and not np.array_equal(int_seg, seg):
+        return seg
+
+    return int_seg
+
+
+def _as_integer_labels(seg):
+    """Segmentation with integer labels, if its labels are all whole numbers."""
+
+    int_seg = _as_lookup_index(seg)
+
+    return int_seg if int_seg is not None else seg
 
-    return out_seg
+
+def _as_lookup_index(seg):
+    """
+    Segmentation as (non-negative) integers usable to index a lookup table,
+    or None if its labels are not, or are too large for a table.
+    """
+
+    int_seg = compact_labels(seg)
+    if int_seg.size < 1 or not np.issubdtype(int_seg.dtype, np.integer):
+        return None
+
+    if int_seg.min() < 0 or int_seg.max() > cfg.max_label_for_lookup_table:
+        return None
+
+    return int_seg
 
 
 def get_axis(array, axis, slice_num):
@@ -169,11 +410,11 @@ def pick_slices(img, view_set, num_slices):
 
     """
 
+    non_empty_by_view = non_empty_slices_by_view(img, view_set)
+
     slices = list()
     for view in view_set:
-        dim_size = img.shape[view]
-        non_empty_slices = np.array([sl for sl in range(dim_size) if
-                                     np.count_nonzero(get_axis(img, view, sl)) > 0])
+        non_empty_slices = non_empty_by_view[view]
         num_non_empty = len(non_empty_slices)
 
         # trying to 5% slices at the tails (bottom clipping at 0)
@@ -196,6 +437,31 @@ def pick_slices(img, view_set, num_slices):
     return slices
 
 
+def non_empty_slices_by_view(img, view_set=(0, 1, 2)):
+    """
+    Indices of the slices with at least one non-zero voxel, in each view.
+
+    Computed from projections of a single non-zero mask onto each axis,
+    instead of counting the non-zero voxels slice by slice.
+    """
+
+    non_zero = img != 0
+    # collapsing any dimensions beyond the three spatial ones
+    if non_zero.ndim > 3:
+        non_zero = non_zero.reshape(non_zero.shape[:3] + (-1,)).any(axis=3)
+
+    non_empty = dict()
+    # projecting onto the plane of the first two axes serves both of them
+    if 0 in view_set or 1 in view_set:
+        plane01 = non_zero.any(axis=2)
+        non_empty[0] = np.flatnonzero(plane01.any(axis=1))
+        non_empty[1] = np.flatnonzero(plane01.any(axis=0))
+    if 2 in view_set:
+        non_empty[2] = np.flatnonzero(non_zero.any(axis=(0, 1)))
+
+    return non_empty
+
+
 def check_layout(total_num_slices, num_views, num_rows_per_view, num_rows_for_surf_vis):
     """Ensures all odd cases are dealt with"""
 
@@ -252,6 +518,28 @@ def check_image_is_3d(img):
     return img
 
 
+def check_num_dims(shape, num_dims):
+    """
+    Ensures an image of the given shape is 3D (or 4D with a single volume),
+    or 4D, as requested, without needing its data.
+    """
+
+    if num_dims == 3:
+        if len(shape) == 4 and shape[3] != 1:
+            raise ValueError('Input volume is 4D with more than one volume!')
+        elif not 3 <= len(shape) <= 4:
+            raise ValueError('Invalid shape of image : {}'.format(shape))
+    elif num_dims == 4:
+        if len(shape) != 4:
+            raise ValueError('Input image must be 4D, not of shape {}'.format(shape))
+    else:
+        raise ValueError('Requested check for {} dims - allowed: 3 or 4!'
+                         ''.format(num_dims))
+
+    if min(shape) < 1:
+        raise ValueError('Atleast one slice must exist in each dimension')
+
+
 def check_image_is_4d(img, min_num_volumes=1, name='4D image'):
     """Ensures the image loaded is 4d and nothing else."""
 
@@ -281,18 +569,21 @@ def void_subcortical_symmetrize_cortical(aseg, null_label=0):
     """
 
     aseg = check_image_is_3d(aseg)
-    symmetric_aseg = np.full_like(aseg, null_label)
 
     left_baseline = 1000
     right_baseline = 2000
 
-    left_ctx = np.logical_and(aseg >= left_baseline, aseg < 2000)
-    right_ctx = np.logical_and(aseg >= right_baseline, aseg < 3000)
+    aseg = _as_integer_labels(aseg)
+    labels = unique_labels(aseg)
+    left_ctx = np.logical_and(labels >= left_baseline, labels < 2000)
+    right_ctx = np.logical_and(labels >= right_baseline, labels < 3000)
 
     # labels 1000 and 2000 are unknown, so making them background is okay!
     # if not we need to make the baselines smaller by 1, to map 1000 and 2000 to 1
-    symmetric_aseg[left_ctx] = aseg[left_ctx] - left_baseline
-    symmetric_aseg[right_ctx] = aseg[right_ctx] - right_baseline
+    new_labels = np.full(labels.shape, null_label, dtype=np.result_type(labels, 'int16'))
+    new_labels[left_ctx] = labels[left_ctx] - left_baseline
+    new_labels[right_ctx] = labels[right_ctx] - right_baseline
+    symmetric_aseg = relabel(aseg, labels, new_labels, null_label)
 
     roi_set_empty = False
     if np.count_nonzero(symmetric_aseg) < 1:
@@ -389,14 +680,18 @@ def load_ratings_csv(prev_ratings_file):
 
     """
 
+    ratings = dict()
+    notes = dict()
     if pexists(prev_ratings_file):
-        csv_values = [line.strip().split(',') for line in
-                      open(prev_ratings_file).readlines()]
-        ratings = {item[0]: item[1] for item in csv_values}
-        notes = {item[0]: item[2] for item in csv_values}
-    else:
-        ratings = dict()
-        notes = dict()
+        with open(prev_ratings_file) as rf:
+            for line in rf:
+                line = line.strip()
+                if not line:
+                    continue
+                # notes are last, so any delimiters within them are retained
+                unit_id, rating, note = line.split(cfg.delimiter, 2)
+                ratings[unit_id] = rating
+                notes[unit_id] = note
 
     return ratings, notes
 
@@ -422,6 +717,46 @@ def save_ratings_to_disk(ratings, notes, qcw):
     return
 
 
+def append_to_ratings_journal(journal, unit_id, rating, notes):
+    """
+    Appends a single rating to an open journal file, and forces it to disk,
+    so it survives a crash of the session.
+
+    Format of each line is the same as the ratings CSV: subject_id,ratings,notes
+    """
+
+    journal.write('{},{},{}\n'.format(unit_id, rating, notes))
+    journal.flush()
+    os.fsync(journal.fileno())
+
+
+def replay_ratings_journal(journal_file, ratings, notes):
+    """
+    Applies the ratings recorded in a journal (in order) on top of the given
+    ratings and notes, which are updated in-place.
+
+    Returns the number of ratings replayed.
+    """
+
+    if not pexists(journal_file):
+        return 0
+
+    with open(journal_file) as jf:
+        lines = jf.read().split('\n')
+
+    # last element is either empty, or a line partially written during a crash
+    num_replayed = 0
+    for line in lines[:-1]:
+        items = line.split(cfg.delimiter, 2)
+        if len(items) < 3:
+            continue
+        ratings[items[0]] = items[1]
+        notes[items[0]] = items[2]
+        num_replayed += 1
+
+    return num_replayed
+
+
 def summarize_ratings(ratings_file, out_dir=None):
     """
     Summarizes the counts and ID for different unique ratings
@@ -500,6 +835,24 @@ def get_ratings_path_info(qcw):
     return ratings_file, prev_ratings_backup
 
 
+def get_ratings_db_path(qcw):
+    """Database of ratings, when the SQLite backend is chosen."""
+
+    ratings_file, _ = get_ratings_path_info(qcw)
+    ratings_dir = os.path.dirname(ratings_file)
+
+    return pjoin(ratings_dir, '{}_{}_{}'.format(qcw.vis_type, qcw.suffix,
+                                                cfg.file_name_ratings_db))
+
+
+def get_ratings_journal_path(qcw):
+    """Journal of ratings recorded since the ratings file was last saved."""
+
+    ratings_file, _ = get_ratings_path_info(qcw)
+
+    return '{}{}'.format(ratings_file, cfg.suffix_ratings_journal)
+
+
 def check_input_dir(fs_dir, user_dir, vis_type,
                     freesurfer_install_required=True):
     """Ensures proper input is specified."""
@@ -833,6 +1186,42 @@ def check_time(time_interval, var_name='time interval'):
     return time_interval
 
 
+def check_num_bytes(num_bytes, var_name='size'):
+    """
+    Validates a size in bytes, given as an integer or
+    with a suffix K, M or G for multiples of 1024 e.g. 500M or 2G.
+    """
+
+    size_str = str(num_bytes).strip().upper()
+    multiplier = 1
+    if size_str[-1:] in ('K', 'M', 'G'):
+        multiplier = 1024 ** ('KMG'.index(size_str[-1]) + 1)
+        size_str = size_str[:-1]
+
+    try:
+        num_bytes = float(size_str) * multiplier
+    except ValueError:
+        raise ValueError('Invalid {}: {}. Specify the number of bytes, or use a '
+                         'suffix K, M or G e.g. 2G'.format(var_name, num_bytes))
+
+    if not np.isfinite(num_bytes) or num_bytes < 0:
+        raise ValueError('Value of {} must be >= 0 and be finite.'.format(var_name))
+
+    return int(num_bytes)
+
+
+def check_prefetch_params(prefetch_depth, prefetch_max_memory):
+    """Validates parameters related to loading the upcoming units in advance."""
+
+    prefetch_depth = int(prefetch_depth)
+    if prefetch_depth < 0:
+        raise ValueError('Prefetch depth must be >= 0 (0 disables it).')
+
+    prefetch_max_memory = check_num_bytes(prefetch_max_memory, 'prefetch_max_memory')
+
+    return prefetch_depth, prefetch_max_memory
+
+
 def check_outlier_params(method, fraction, feat_types, disable_outlier_detection,
                          id_list, vis_type, type_of_features):
     """Validates parameters related to outlier detection"""
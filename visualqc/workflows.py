@@ -4,15 +4,24 @@ Module to define base classes.
 
 """
 
+import os
 import sys
+import textwrap
 import traceback
 from abc import ABC, abstractmethod
+from functools import partial
 from shutil import copyfile
 
 from os.path import exists as pexists, join as pjoin
 
 from visualqc import config as cfg
-from visualqc.utils import get_ratings_path_info, load_ratings_csv, summarize_ratings
+from visualqc.cache import DecompressedImageCache, UnitDataCache
+from visualqc.prefetch import UnitPrefetcher
+from visualqc.ratings_db import RatingsDatabase
+from visualqc.timing import StageTimer, timed_stage
+from visualqc.utils import append_to_ratings_journal, get_ratings_db_path, \
+    get_ratings_journal_path, get_ratings_path_info, load_ratings_csv, \
+    replay_ratings_journal, summarize_ratings
 
 
 class DummyCallable(object):
@@ -39,7 +48,12 @@ class BaseWorkflowVisualQC(ABC):
                  outlier_fraction,
                  outlier_feat_types,
                  disable_outlier_detection,
-                 show_unit_id=True):
+                 show_unit_id=True,
+                 prefetch_depth=cfg.default_prefetch_depth,
+                 prefetch_max_memory=cfg.default_prefetch_max_memory,
+                 unit_cache_max_bytes=cfg.default_unit_cache_max_bytes,
+                 image_cache_max_bytes=cfg.default_image_cache_max_bytes,
+                 ratings_backend=cfg.default_ratings_backend):
         """Constructor"""
 
         # super().__init__()
@@ -51,6 +65,15 @@ class BaseWorkflowVisualQC(ABC):
 
         self.ratings = dict()
         self.notes = dict()
+        # journal to record each rating to disk right away
+        self.ratings_journal = None
+        self.num_ratings_journaled = 0
+        # or, a database to record them in (when chosen)
+        if ratings_backend not in cfg.ratings_backends:
+            raise ValueError('Invalid ratings backend: {}. Choose one of {}'
+                             ''.format(ratings_backend, cfg.ratings_backends))
+        self.ratings_backend = ratings_backend
+        self.ratings_db = None
 
         self.outlier_method = outlier_method
         self.outlier_fraction = outlier_fraction
@@ -61,6 +84,23 @@ class BaseWorkflowVisualQC(ABC):
         # hiding ID reduces bias or batch effects
         self.show_unit_id = show_unit_id
 
+        # loading the upcoming units in the background, while reviewing current
+        self.prefetch_depth = prefetch_depth
+        self.prefetch_max_memory = prefetch_max_memory
+        self.prefetcher = None
+
+        # caching the data prepared for each unit on disk, to reuse across sessions
+        self.unit_cache_max_bytes = unit_cache_max_bytes
+        self.unit_cache = None
+        # uncompressed copies of compressed images, to avoid decompressing again
+        self.image_cache_max_bytes = image_cache_max_bytes
+        self.image_cache = None
+        # preparing all the units in advance, before the review starts
+        self.prepare_first = False
+
+        # time spent in different stages of the review
+        self.timer = StageTimer()
+
         # following properties must be instantiated
         self.feature_extractor = DummyCallable()
         self.fig = None
@@ -72,11 +112,19 @@ class BaseWorkflowVisualQC(ABC):
     def run(self):
         """Entry point after init."""
 
+        self.timer.open_log(pjoin(self.out_dir, cfg.file_name_timings))
+        self.init_image_cache()
         self.preprocess()
         self.restore_ratings()
+        self.init_unit_cache()
+        if self.prepare_first:
+            with self.timer.stage('prepare_units'):
+                self.prepare_units()
         self.prepare_UI()
         self.loop_through_units()
         self.cleanup()
+        self.timer.summarize()
+        self.timer.close()
 
         print('\nAll Done - results are available in:\n\t{}'.format(self.out_dir))
 
@@ -110,20 +158,29 @@ class BaseWorkflowVisualQC(ABC):
 
         print('Restoring ratings from previous session(s), if they exist ..')
 
-        # making a copy
-        self.incomplete_list = list(self.id_list)
-        prev_done = []  # empty list
+        if self.ratings_backend == 'sqlite':
+            self.ratings_db = RatingsDatabase(get_ratings_db_path(self))
+            self.ratings, self.notes = self.ratings_db.load()
+            num_replayed = 0
+        else:
+            ratings_file, backup_name_ratings = get_ratings_path_info(self)
+            journal_file = get_ratings_journal_path(self)
 
-        ratings_file, backup_name_ratings = get_ratings_path_info(self)
+            if pexists(ratings_file):
+                self.ratings, self.notes = load_ratings_csv(ratings_file)
+            else:
+                self.ratings = dict()
+                self.notes = dict()
 
-        if pexists(ratings_file):
-            self.ratings, self.notes = load_ratings_csv(ratings_file)
-            # finding the remaining
-            prev_done = set(self.ratings.keys())
-            self.incomplete_list = list(set(self.id_list) - prev_done)
-        else:
-            self.ratings = dict()
-            self.notes = dict()
+            # ratings recorded after the last save e.g. before a crash
+            num_replayed = replay_ratings_journal(journal_file, self.ratings,
+                                                  self.notes)
+            if num_replayed > 0:
+                print('{} ratings recovered from the journal.'.format(num_replayed))
+
+        prev_done = set(self.ratings.keys())
+        # finding the remaining, retaining the order of review
+        self.incomplete_list = [uid for uid in self.id_list if uid not in prev_done]
 
         if len(prev_done) > 0:
             print('\nRatings for {}/{} subjects were restored.'
@@ -136,6 +193,12 @@ class BaseWorkflowVisualQC(ABC):
             self.num_units_to_review = len(self.incomplete_list)
             print('To be reviewed : {}\n'.format(self.num_units_to_review))
 
+        if self.ratings_backend == 'csv':
+            # merging the replayed ratings into the ratings file, and starting afresh
+            if num_replayed > 0:
+                self.compact_ratings()
+            self.ratings_journal = open(journal_file, 'w')
+
 
     def save_ratings(self):
         """Saves ratings to disk """
@@ -146,23 +209,60 @@ class BaseWorkflowVisualQC(ABC):
         if pexists(ratings_file):
             copyfile(ratings_file, prev_ratings_backup)
 
-        # add column names: subject_id,issue1:issue2:issue3,...,notes etc
-        # TODO add path(s) to data (images etc) that produced the review
-        lines = '\n'.join(['{},{},{}'.format(sid, self._join_ratings(rating_set),
-                                             self.notes[sid])
-                           for sid, rating_set in self.ratings.items()])
+        if self.ratings_db is not None:
+            # ratings are in the database already: exporting them for convenience
+            self.ratings_db.export_csv(ratings_file)
+            self.ratings_db.summarize(os.path.dirname(ratings_file))
+            self.ratings_db.close()
+            self.ratings_db = None
+            return
+
         try:
-            with open(ratings_file, 'w') as cf:
-                cf.write(lines)
+            self.compact_ratings()
         except:
             raise IOError(
                 'Error in saving ratings to file!!\n'
                 'Backup might be helpful at:\n\t{}'.format(prev_ratings_backup))
 
+        if self.ratings_journal is not None:
+            self.ratings_journal.close()
+            self.ratings_journal = None
+
         # summarize ratings to stdout and id lists
         summarize_ratings(ratings_file)
 
 
+    def compact_ratings(self):
+        """
+        Writes all the ratings to the ratings file, and truncates the journal,
+        as all the ratings in it are now saved in the ratings file.
+
+        The ratings file is replaced atomically, so a crash at any point leaves
+        either the old or the new version in place, with the journal intact.
+        """
+
+        ratings_file, _ = get_ratings_path_info(self)
+
+        # add column names: subject_id,issue1:issue2:issue3,...,notes etc
+        # TODO add path(s) to data (images etc) that produced the review
+        lines = '\n'.join(['{},{},{}'.format(sid, self._join_ratings(rating_set),
+                                             self.notes[sid])
+                           for sid, rating_set in self.ratings.items()])
+        tmp_file = '{}.tmp'.format(ratings_file)
+        with open(tmp_file, 'w') as cf:
+            cf.write(lines)
+            cf.flush()
+            os.fsync(cf.fileno())
+        os.replace(tmp_file, ratings_file)
+
+        if self.ratings_journal is not None:
+            self.ratings_journal.seek(0)
+            self.ratings_journal.truncate()
+        else:
+            open(get_ratings_journal_path(self), 'w').close()
+        self.num_ratings_journaled = 0
+
+
     @staticmethod
     def _join_ratings(str_list):
 
@@ -172,9 +272,57 @@ class BaseWorkflowVisualQC(ABC):
             return str_list
 
 
+    def init_image_cache(self):
+        """
+        Sets up the on-disk cache of decompressed images, unless disabled.
+        It must be passed on to the readers (as image_cache) to be used.
+        """
+
+        if self.image_cache_max_bytes > 0:
+            self.image_cache = DecompressedImageCache(
+                pjoin(self.out_dir, cfg.image_cache_dir_name),
+                max_bytes=self.image_cache_max_bytes)
+
+
+    def init_unit_cache(self):
+        """Sets up the on-disk cache for the data prepared for each unit, unless disabled."""
+
+        if self.unit_cache_max_bytes > 0:
+            self.unit_cache = UnitDataCache(pjoin(self.out_dir, cfg.unit_cache_dir_name),
+                                            max_bytes=self.unit_cache_max_bytes)
+
+
+    def prepare_units(self):
+        """
+        Prepares the data for all the units yet to be reviewed in parallel,
+        and saves it to disk (in the output folder), to be reused during the review.
+        """
+
+        if self.unit_cache is None:
+            print('Cache for the prepared data is disabled - '
+                  'units will be prepared on demand during the review.')
+            return
+
+        reader_by_unit = {unit_id: self.get_unit_reader(unit_id)
+                          for unit_id in self.incomplete_list}
+        self.unit_cache.precompute(reader_by_unit)
+
+
     def loop_through_units(self):
         """Method to loop through the units (subject, session or run) to make it all work."""
 
+        self.prefetcher = UnitPrefetcher(self._get_unit_reader_with_cache,
+                                         depth=self.prefetch_depth,
+                                         max_memory=self.prefetch_max_memory)
+        try:
+            self._loop_through_units()
+        finally:
+            self.prefetcher.shutdown()
+
+
+    def _loop_through_units(self):
+        """Actual loop, reviewing one unit at a time."""
+
         for counter, unit_id in enumerate(self.incomplete_list):
 
             print('\nReviewing {}'.format(unit_id))
@@ -182,15 +330,19 @@ class BaseWorkflowVisualQC(ABC):
             self.identify_unit(unit_id, counter)
             self.add_alerts()
 
-            skip_subject = self.load_unit(unit_id)
+            with self.timer.stage('load_unit', unit_id):
+                skip_subject = self.load_unit(unit_id)
+            # next few are loaded in the background, while this one is reviewed
+            self.prefetcher.schedule(self.incomplete_list[counter + 1:])
 
             if skip_subject:
                 print('Skipping current subject ..')
                 continue
 
-            self.display_unit()
-            self.show_fig_and_wait()
-            # TODO save each rating to disk right away to avoid loss of work due to crach etc
+            with self.timer.stage('display_unit', unit_id):
+                self.display_unit()
+            with self.timer.stage(cfg.stage_waiting_for_reviewer, unit_id):
+                self.show_fig_and_wait()
             self.print_rating(unit_id)
 
             if self.quit_now:
@@ -247,6 +399,42 @@ class BaseWorkflowVisualQC(ABC):
         """
 
 
+    @abstractmethod
+    def get_unit_reader(self, unit_id):
+        """
+        Returns a callable (taking no args) to read and preprocess the data for
+        a given unit, returning a dict of named arrays.
+
+        As this could be run outside the main thread (to load upcoming units in
+        advance), it must not modify the state of the workflow or touch the UI.
+        Hence, this is typically a partial of a module-level function,
+        with all the necessary paths and parameters bound to it.
+
+        """
+
+
+    def fetch_unit(self, unit_id):
+        """
+        Returns the data for a given unit, read via the reader from
+        :meth:`get_unit_reader`, possibly loaded already in the background.
+        """
+
+        if self.prefetcher is not None:
+            return self.prefetcher.get(unit_id)
+
+        return self._get_unit_reader_with_cache(unit_id)()
+
+
+    def _get_unit_reader_with_cache(self, unit_id):
+        """Reader for the given unit, reusing the data cached already, if any."""
+
+        reader = self.get_unit_reader(unit_id)
+        if self.unit_cache is None:
+            return reader
+
+        return partial(self.unit_cache.read, reader)
+
+
     @abstractmethod
     def display_unit(self):
         """Display routine."""
@@ -298,6 +486,28 @@ class BaseWorkflowVisualQC(ABC):
 
         self.ratings[self.current_unit_id] = self.UI.get_ratings()
         self.notes[self.current_unit_id] = self.UI.user_notes
+        self.record_rating(self.current_unit_id)
+
+
+    def record_rating(self, unit_id):
+        """Records the rating to disk right away, to avoid loss of work due to crash etc"""
+
+        if self.ratings[unit_id] in cfg.ratings_not_to_be_recorded:
+            return
+
+        if self.ratings_db is not None:
+            self.ratings_db.save(unit_id, self.ratings[unit_id], self.notes[unit_id])
+            return
+
+        if self.ratings_journal is None:
+            return
+
+        append_to_ratings_journal(self.ratings_journal, unit_id,
+                                  self._join_ratings(self.ratings[unit_id]),
+                                  self.notes[unit_id])
+        self.num_ratings_journaled += 1
+        if self.num_ratings_journaled >= cfg.num_ratings_between_compaction:
+            self.compact_ratings()
 
 
     def print_rating(self, subject_id):
@@ -349,6 +559,7 @@ class BaseWorkflowVisualQC(ABC):
         pass
 
 
+    @timed_stage('extract_features')
     def extract_features(self):
         """
         Feature extraction method (as part of pre-processing),
@@ -368,6 +579,7 @@ class BaseWorkflowVisualQC(ABC):
                 print('Unable to extract {} features - skipping them.'.format(feat_type))
 
 
+    @timed_stage('detect_outliers')
     def detect_outliers(self):
         """Runs outlier detection and reports the ids flagged as outliers."""
 
@@ -435,3 +647,83 @@ class BaseWorkflowVisualQC(ABC):
             traceback.print_exc()
 
         return
+
+
+def add_review_session_args(parser):
+    """Adds the options controlling how the data is loaded during the review."""
+
+    help_text_prefetch_depth = textwrap.dedent("""
+    Number of upcoming units to be loaded in the background,
+    while the current unit is being reviewed. 0 disables it.
+
+    Default: {}
+    \n""".format(cfg.default_prefetch_depth))
+
+    help_text_prefetch_max_memory = textwrap.dedent("""
+    Max. memory to be held by the units loaded in advance, in bytes,
+    or with a suffix K, M or G e.g. 500M.
+
+    Default: {}
+    \n""".format(cfg.default_prefetch_max_memory))
+
+    help_text_unit_cache_max_bytes = textwrap.dedent("""
+    Max. disk space for the data prepared for the review of each unit
+    (cropped and rescaled images, stats etc), cached in the output folder
+    (in {}) to be reused when the review is resumed later on.
+    Least recently used units are removed to stay within it.
+    In bytes, or with a suffix K, M or G e.g. 5G. 0 disables the cache.
+
+    Default: {}
+    \n""".format(cfg.unit_cache_dir_name, cfg.default_unit_cache_max_bytes))
+
+    help_text_image_cache_max_bytes = textwrap.dedent("""
+    Max. disk space for the uncompressed copies of compressed images
+    (.nii.gz, .mgz), saved in the output folder (in {}) on first read,
+    to avoid decompressing them again in later reads and sessions.
+    Least recently used images are removed to stay within it.
+    In bytes, or with a suffix K, M or G e.g. 5G. 0 disables the cache.
+
+    Default: {} (disabled)
+    \n""".format(cfg.image_cache_dir_name, cfg.default_image_cache_max_bytes))
+
+    help_text_ratings_backend = textwrap.dedent("""
+    Where the ratings are recorded during the review.
+    csv : a CSV file in the output folder, with a journal of the ratings
+          recorded since it was last saved.
+    sqlite : a SQLite database in the output folder (*_{}), with ratings
+          of each reviewer saved separately. The ratings are also exported
+          to the CSV file at the end of the session.
+
+    Default: {}
+    \n""".format(cfg.file_name_ratings_db, cfg.default_ratings_backend))
+
+    session_args = parser.add_argument_group('Review session',
+                                             'Options related to loading and caching '
+                                             'the data during the review')
+
+    session_args.add_argument("--prefetch_depth", action="store",
+                              dest="prefetch_depth",
+                              default=cfg.default_prefetch_depth, required=False,
+                              help=help_text_prefetch_depth)
+
+    session_args.add_argument("--prefetch_max_memory", action="store",
+                              dest="prefetch_max_memory",
+                              default=cfg.default_prefetch_max_memory, required=False,
+                              help=help_text_prefetch_max_memory)
+
+    session_args.add_argument("--unit_cache_max_bytes", action="store",
+                              dest="unit_cache_max_bytes",
+                              default=cfg.default_unit_cache_max_bytes, required=False,
+                              help=help_text_unit_cache_max_bytes)
+
+    session_args.add_argument("--image_cache_max_bytes", action="store",
+                              dest="image_cache_max_bytes",
+                              default=cfg.default_image_cache_max_bytes, required=False,
+                              help=help_text_image_cache_max_bytes)
+
+    session_args.add_argument("--ratings_backend", action="store",
+                              dest="ratings_backend", choices=cfg.ratings_backends,
+                              default=cfg.default_ratings_backend, required=False,
+                              help=help_text_ratings_backend)
+
+    return parser